@@ -1,12 +1,15 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 
-import tabix  
-import sys, subprocess, os
+import sys, os, gzip, struct, shutil, tempfile
+import collections, hashlib, json
 import multiprocessing as mp
-import collections, itertools
-import ConfigParser
 import argparse
 import time
+import numpy as np
+try:
+  import tabix
+except ImportError:
+  tabix = None
 
 parser = argparse.ArgumentParser(description="Annotate VCF with RefSeq Genes Example: ./VarRefSeqAnnotation.py -feature gene -gff test_RefSeq.gff -vcf dbSNP_147_GRCh38.vcf.gz -asm GCF_000001405.35.assembly.txt")
 parser.add_argument("-gff", help="input RefSeq gff file")
@@ -15,8 +18,9 @@ parser.add_argument("-feature", help="feature name to Annotate, must be in gff f
 parser.add_argument("-np", help="number of processes",type=int,default=2)
 parser.add_argument("-asm", help="input assembly info text file (ie. /home/data/GCF_000001405.35.assembly.txt", type=str,default=None)
 parser.add_argument("-chr", help="VCF use chr (chr1, chr2, etc.) instead of (1, 2, etc.)", type=str,default=None)
+parser.add_argument("-chunk", help="number of VCF records to annotate at a time", type=int, default=100000)
+parser.add_argument("-cache", help="directory for the compiled feature index of the gff (default: <gff>.featidx)", type=str, default=None)
 parser.add_argument("-debug", help="debug flag", type=str,default=None)
-preChrStart, preChrEnd = 0, 0
 
 args = parser.parse_args()
 
@@ -33,95 +37,314 @@ def getAsmInfo():
     if line[0] == "#" or len(line.strip()) == 0:
       continue
     d = splitline(line)
-    asminfo[d[6]] = d[0] 
+    asminfo[d[6]] = d[0]
   return asminfo
 
-class gffChunk:
-  def __init__(self, gff, vcf, feature):
-    self.vcf = vcf
-    self.gff = open(gff, 'r')
-    self.feature = feature
-    self.preChrStart = 0
-    self.preChrEnd = 0
-    self.preChr = ''
-
-  def __iter__(self):
-    return self
-
-  def next(self):
-    line = self.gff.readline()
-    while line:
-      if line[0] == "#" or len(line.strip()) == 0:
-        line = self.gff.readline()
-        continue
-      data = line.strip().split("\t")
-      chrom, chrStart, chrEnd = data[0], int(data[3]),int(data[4])
-      #print(chrStart, chrEnd, self.preChrStart, self.preChrEnd )
-      if (chrStart == self.preChrStart): # and (chrEnd == self.preChrEnd):
-        line = self.gff.readline()
-        #print("skip...\n")
+class Attributes:
+  """GFF attribute strings stored back to back in one byte array."""
+  def __init__(self, blob, offsets):
+    self.blob = blob
+    self.offsets = offsets
+
+  def __getitem__(self, i):
+    return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode()
+
+class FeatureSet:
+  """Features of one chromosome, as NumPy arrays sorted by start.
+
+  maxEnds[i] is the largest end of features 0..i, so the features that can
+  overlap a position p all lie in [searchsorted(maxEnds, p), searchsorted(starts, p)).
+  """
+  def __init__(self, starts, ends, maxEnds, attrs):
+    self.starts = starts
+    self.ends = ends
+    self.maxEnds = maxEnds
+    self.attrs = attrs
+
+  def overlaps(self, pos, end):
+    """Find all (variant, feature) pairs where the variant [pos, end] overlaps
+    the feature. Both arrays are 1-based and inclusive.
+
+    Returns two index arrays, sorted by variant.
+    """
+    lo = np.searchsorted(self.maxEnds, pos, side='left')
+    hi = np.searchsorted(self.starts, end, side='right')
+    n = np.maximum(hi - lo, 0)
+    varIdx = np.repeat(np.arange(len(pos)), n)
+    # arange within each variant's candidate range [lo, hi)
+    featIdx = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n) + np.repeat(lo, n)
+    keep = self.ends[featIdx] >= pos[varIdx]
+    return varIdx[keep], featIdx[keep]
+
+INDEX_COLUMNS = ('seqids', 'starts', 'ends', 'maxEnds', 'chromOffsets', 'attrOffsets', 'attrs')
+
+def fileChecksum(path):
+  sha = hashlib.sha1()
+  with open(path, 'rb') as inp:
+    for block in iter(lambda: inp.read(1 << 20), b''):
+      sha.update(block)
+  return sha.hexdigest()
+
+def gffChecksum(gff, cacheDir):
+  """Checksum of the GFF. It is only recomputed when the file's size or
+  modification time differ from the last run on the same path. Each GFF path
+  has its own stamp, so several GFFs can share a cache directory."""
+  path = os.path.abspath(gff)
+  st = os.stat(path)
+  stampFile = os.path.join(cacheDir, 'source.{}.json'.format(
+    hashlib.sha1(path.encode()).hexdigest()[:16]))
+  stamp = None
+  try:
+    with open(stampFile, 'r') as inp:
+      stamp = json.load(inp)
+    if stamp['path'] == path and stamp['size'] == st.st_size and stamp['mtime'] == st.st_mtime_ns:
+      return stamp['sha1']
+  except (IOError, ValueError, KeyError, TypeError):
+    pass
+  checksum = fileChecksum(path)
+  with open(stampFile + '.tmp', 'w') as out:
+    json.dump(dict(path=path, size=st.st_size, mtime=st.st_mtime_ns, sha1=checksum), out)
+  os.replace(stampFile + '.tmp', stampFile)
+  if isinstance(stamp, dict) and stamp.get('path') == path and stamp.get('sha1') not in (None, checksum):
+    dropIndexes(cacheDir, stamp['sha1'])
+  return checksum
+
+def dropIndexes(cacheDir, checksum):
+  """Drop the indexes of an older version of a GFF, unless another GFF in the
+  cache still has that content."""
+  for name in os.listdir(cacheDir):
+    if not (name.startswith('source.') and name.endswith('.json')):
+      continue
+    try:
+      with open(os.path.join(cacheDir, name), 'r') as inp:
+        if json.load(inp)['sha1'] == checksum:
+          return
+    except (IOError, ValueError, KeyError, TypeError):
+      pass
+  for name in os.listdir(cacheDir):
+    indexDir = os.path.join(cacheDir, name)
+    if name.startswith(checksum + '.') and os.path.isdir(indexDir):
+      shutil.rmtree(indexDir, ignore_errors=True)
+
+def buildFeatureIndex(gff, feature, indexDir):
+  """Parse the features of the given type from the GFF into columnar .npy
+  files: one row per feature, grouped by seqid and sorted by start.
+
+  As before, a feature with the same start as the previous feature is skipped.
+  """
+  data = collections.OrderedDict()
+  preChr, preChrStart = None, None
+  for line in open(gff, 'r'):
+    if line[0] == "#" or len(line.strip()) == 0:
+      continue
+    d = line.rstrip("\n").split("\t")
+    if d[2] != feature:
+      continue
+    chrom, chrStart, chrEnd = d[0], int(d[3]), int(d[4])
+    if chrom != preChr:
+      preChr, preChrStart = chrom, None
+    if chrStart == preChrStart:
+      continue
+    preChrStart = chrStart
+    starts, ends, attrs = data.setdefault(chrom, ([], [], []))
+    starts.append(chrStart)
+    ends.append(chrEnd)
+    attrs.append(d[8].encode())
+  columns = dict((c, []) for c in INDEX_COLUMNS)
+  chromOffsets, attrOffsets = [0], [0]
+  for code, (starts, ends, attrs) in enumerate(data.values()):
+    order = np.argsort(starts, kind='mergesort')
+    ends = np.asarray(ends, dtype=np.int64)[order]
+    columns['seqids'].append(np.full(len(order), code, dtype=np.int32))
+    columns['starts'].append(np.asarray(starts, dtype=np.int64)[order])
+    columns['ends'].append(ends)
+    columns['maxEnds'].append(np.maximum.accumulate(ends))
+    chromOffsets.append(chromOffsets[-1] + len(order))
+    for i in order:
+      columns['attrs'].append(attrs[i])
+      attrOffsets.append(attrOffsets[-1] + len(attrs[i]))
+  columns['chromOffsets'] = np.asarray(chromOffsets, dtype=np.int64)
+  columns['attrOffsets'] = np.asarray(attrOffsets, dtype=np.int64)
+  columns['attrs'] = np.frombuffer(b''.join(columns['attrs']), dtype=np.uint8)
+  tmpDir = tempfile.mkdtemp(prefix='.build.', dir=os.path.dirname(indexDir))
+  try:
+    for name in ('seqids', 'starts', 'ends', 'maxEnds'):
+      np.save(os.path.join(tmpDir, name + '.npy'),
+              np.concatenate(columns[name]) if columns[name] else np.zeros(0, dtype=np.int64))
+    for name in ('chromOffsets', 'attrOffsets', 'attrs'):
+      np.save(os.path.join(tmpDir, name + '.npy'), columns[name])
+    with open(os.path.join(tmpDir, 'names.json'), 'w') as out:
+      json.dump(list(data.keys()), out)
+    os.rename(tmpDir, indexDir)
+  except OSError:
+    # Another run built the same index first
+    if not os.path.isdir(indexDir):
+      raise
+  finally:
+    shutil.rmtree(tmpDir, ignore_errors=True)
+
+def openFeatureIndex(indexDir, chrAcc):
+  """Memory-map a feature index, keyed by VCF chromosome name."""
+  cols = dict((name, np.load(os.path.join(indexDir, name + '.npy'), mmap_mode='r'))
+              for name in INDEX_COLUMNS)
+  with open(os.path.join(indexDir, 'names.json'), 'r') as inp:
+    names = json.load(inp)
+  attrs = Attributes(cols['attrs'], cols['attrOffsets'])
+  offsets = cols['chromOffsets']
+  features = {}
+  for code, chrom in enumerate(names):
+    if chrom not in chrAcc:
+      continue
+    chrnum = chrAcc[chrom]
+    if (args.chr):
+      chrnum = 'chr' + chrnum
+    lo, hi = int(offsets[code]), int(offsets[code + 1])
+    features[chrnum] = FeatureSet(
+      cols['starts'][lo:hi], cols['ends'][lo:hi], cols['maxEnds'][lo:hi],
+      Attributes(attrs.blob, attrs.offsets[lo:hi + 1]))
+  return features
+
+def loadFeatures(gff, feature, chrAcc):
+  """Load the features of the given type, keyed by VCF chromosome name, from
+  the compiled feature index of the GFF, building it first if needed."""
+  cacheDir = args.cache or gff + '.featidx'
+  os.makedirs(cacheDir, exist_ok=True)
+  indexDir = os.path.join(cacheDir, '{}.{}'.format(gffChecksum(gff, cacheDir), feature))
+  if not os.path.isdir(indexDir):
+    if (args.debug):
+      print ('building feature index', indexDir)
+    buildFeatureIndex(gff, feature, indexDir)
+  return openFeatureIndex(indexDir, chrAcc)
+
+def readTabixNames(tbi):
+  """Read the sequence names from a tabix index, with the number of 16 kb
+  windows each one spans (a rough measure of how much work it is)."""
+  with gzip.open(tbi, 'rb') as inp:
+    data = inp.read()
+  nref, lnm = struct.unpack_from('<i', data, 4)[0], struct.unpack_from('<i', data, 32)[0]
+  names = data[36:36 + lnm].split(b'\0')[:nref]
+  offset = 36 + lnm
+  sizes = []
+  for i in range(nref):
+    nbin = struct.unpack_from('<i', data, offset)[0]
+    offset += 4
+    for j in range(nbin):
+      nchunk = struct.unpack_from('<i', data, offset + 4)[0]
+      offset += 8 + 16 * nchunk
+    nintv = struct.unpack_from('<i', data, offset)[0]
+    offset += 4 + 8 * nintv
+    sizes.append(nintv)
+  return [(n.decode(), s) for n, s in zip(names, sizes)]
+
+def karyotypeOrder(names, chrAcc):
+  """Order chromosome names as in the assembly report, followed by any others
+  in their original order."""
+  rank = {}
+  for chrnum in chrAcc.values():
+    rank.setdefault(('chr' + chrnum) if args.chr else chrnum, len(rank))
+  return sorted(names, key=lambda n: (rank.get(n, len(rank)), names.index(n)))
+
+def vcfChunks(vcf, size):
+  """Stream VCF records in chunks of at most `size` lines from one chromosome."""
+  chunk, chunkChr = [], None
+  with gzip.open(vcf, 'rt') if vcf.endswith('.gz') else open(vcf, 'r') as inp:
+    for line in inp:
+      if line[0] == "#":
         continue
-     
-
-      if (chrom != self.preChr):
-        self.preChrStart = 0
-        self.preChrEnd = 0
-        self.preChr = chrom
-      #print (data[2], self.feature)
-      if data[2] == self.feature:
-        lines = []
-        if chrom in chrAcc:
-          chrnum = chrAcc[chrom]
-          if (args.chr):
-            chrnum = 'chr' + chrnum
-
-          if (args.debug): 
-              print ('NoFeat',chrnum,self.preChrEnd + 1,chrStart - 1)
-              print ('Feat',chrnum,chrStart,chrEnd)
-
-          resNoAnnot, res = [], []
-          try:
-            resNoAnnot = tb.query(chrnum,self.preChrEnd + 1,chrStart - 1)
-          except:
-            e = sys.exc_info()[0]
-            print(e,  'NoFeat',chrnum,self.preChrEnd + 1,chrStart - 1)
-          res = tb.query(chrnum,chrStart,chrEnd)
-          
-          for r in resNoAnnot:
-            lines.append(r)
-          for r in res:
-            r[7] = r[7] + ';' + data[8]
-            lines.append(r)
-          self.preChrStart = chrStart
-          self.preChrEnd = chrEnd
-          return (lines)
-
-      line = self.gff.readline()
-    raise StopIteration
-
-
-def process_chunk(chunk):
-  return chunk
-  
- 
-results = None
+      chrom = line[:line.index("\t")]
+      if chunk and (chrom != chunkChr or len(chunk) >= size):
+        yield chunkChr, chunk
+        chunk = []
+      chunkChr = chrom
+      chunk.append(line.rstrip("\n").split("\t"))
+  if chunk:
+    yield chunkChr, chunk
+
+def annotateChunk(chrom, records, features):
+  """Annotate a chunk of records. A record that overlaps no feature is written
+  as is; a record that overlaps several features is written once per feature."""
+  fs = features.get(chrom)
+  if fs is None:
+    return ["\t".join(r) + "\n" for r in records]
+  pos = np.fromiter((int(r[1]) for r in records), dtype=np.int64, count=len(records))
+  end = pos + np.fromiter((len(r[3]) for r in records), dtype=np.int64, count=len(records)) - 1
+  varIdx, featIdx = fs.overlaps(pos, end)
+  counts = np.bincount(varIdx, minlength=len(records))
+  lines = []
+  hit = 0
+  for i, r in enumerate(records):
+    if counts[i] == 0:
+      lines.append("\t".join(r) + "\n")
+      continue
+    info = r[7]
+    for j in featIdx[hit:hit + counts[i]]:
+      r[7] = info + ';' + fs.attrs[j]
+      lines.append("\t".join(r) + "\n")
+    hit += counts[i]
+  return lines
+
+def chunked(records, size):
+  chunk = []
+  for r in records:
+    chunk.append(r)
+    if len(chunk) >= size:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
+
+def annotateChromosome(job):
+  """Worker: annotate the variants of one chromosome, read through this
+  worker's own tabix handle, into a shard file."""
+  chrom, shard = job
+  tb = tabix.open(args.vcf)
+  with open(shard, 'w') as out:
+    for records in chunked(tb.querys(chrom), args.chunk):
+      out.writelines(annotateChunk(chrom, records, features))
+  return chrom
+
+def annotateParallel(chroms, outfile):
+  """Annotate each chromosome in a separate worker and concatenate the shards
+  in karyotype order. The largest chromosomes are started first."""
+  order = karyotypeOrder([c for c, size in chroms], chrAcc)
+  sizes = dict(chroms)
+  shardDir = tempfile.mkdtemp(prefix='annot.', dir=os.path.dirname(os.path.abspath(args.vcf)))
+  shards = dict((c, os.path.join(shardDir, '{}.part'.format(i))) for i, c in enumerate(order))
+  jobs = sorted(order, key=lambda c: -sizes[c])
+  try:
+    # Workers are forked, so they share the features loaded by the parent
+    with mp.get_context('fork').Pool(processes=args.np) as p:
+      for chrom in p.imap_unordered(annotateChromosome, [(c, shards[c]) for c in jobs]):
+        if (args.debug):
+          print ('annotated', chrom, time.time() - start)
+    for chrom in order:
+      with open(shards[chrom], 'r') as shard:
+        shutil.copyfileobj(shard, outfile)
+  finally:
+    shutil.rmtree(shardDir)
+
 start = time.time()
-print ("loading and annotating variants..." + str(args.np) + ' processes' )
-tb = tabix.open(args.vcf)
-chrAcc = getAsmInfo()
+print ("loading and annotating variants..." + str(args.np) + ' processes')
 
 if (args.gff and not args.feature) or (args.feature and not args.gff):
   print ("Must specify both gff and feature if either argument is used")
   print ("Use -feature and -gff arguments")
   sys.exit(0)
 
-
+chrAcc = getAsmInfo()
 outfile = open(args.vcf + '.out', 'w')
-p = mp.Pool(processes = args.np)
 if args.feature:
-  for r in p.map(process_chunk, gffChunk(args.gff, args.vcf, args.feature), 100):
-      for l in r:
-        outfile.write("\t".join(l) + "\n")
- 
-        
-print "time to finish: " + str(time.time() - start)
\ No newline at end of file
+  features = loadFeatures(args.gff, args.feature, chrAcc)
+  if (args.debug):
+    print ('features loaded', sum(len(f.starts) for f in features.values()), time.time() - start)
+  tbi = args.vcf + '.tbi'
+  if args.np > 1 and tabix is not None and os.path.exists(tbi):
+    annotateParallel(readTabixNames(tbi), outfile)
+  else:
+    if args.np > 1:
+      print ("Annotating in one process: needs pytabix and a tabix index of the VCF")
+    for chrom, records in vcfChunks(args.vcf, args.chunk):
+      outfile.writelines(annotateChunk(chrom, records, features))
+outfile.close()
+
+print ("time to finish: " + str(time.time() - start))
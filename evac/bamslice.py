@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""Reading only the parts of an indexed BAM file that overlap a set of regions.
+
+A caller that reads a BAM from a pipe (e.g. ``samtools mpileup -l regions.bed
+-``) reads every byte of it, even if the regions cover a tiny part of the
+genome. Instead, the regions are resolved against the BAM index (BAI or CSI)
+into chunks of virtual offsets, and a slice is written: the BAM header,
+followed by the records in those chunks, in order. Blocks that lie entirely
+within a chunk are copied without decompressing them; only the first and last
+block of each chunk are recompressed. Chunks that are less than ``gap`` bytes
+apart are read as one, so that a panel of many small regions does not turn
+into a seek per region.
+
+A slice holds every record that overlaps the regions, along with some that
+don't (from the same BGZF blocks), so the caller must still be told the
+regions.
+"""
+import logging
+import os
+import struct
+from evac.bgzf import (
+    BgzfWriter, decompress_block, merge_chunks, read_block, read_index)
+
+log = logging.getLogger()
+
+BAM_MAGIC = b'BAM\1'
+
+# Chunks closer than this (in compressed bytes) are read as one
+MERGE_GAP = 64 * 1024
+
+def find_index(bam):
+    """Returns the path of the index of a BAM file (``.bam.bai``, ``.bai`` or
+    ``.bam.csi``), or None if it has none.
+    """
+    candidates = [bam + '.bai', bam + '.csi']
+    if bam.endswith('.bam'):
+        candidates.append(bam[:-4] + '.bai')
+    for path in candidates:
+        if os.path.exists(path):
+            return path
+    return None
+
+class BamSlicer(object):
+    """Writes the parts of a coordinate-sorted, indexed BAM file that overlap
+    sets of regions.
+
+    Args:
+        bam: Path of the BAM file
+        index: Path of its index; found next to the BAM by default
+        gap: Read chunks that are less than this many compressed bytes apart
+            as one
+    """
+    def __init__(self, bam, index=None, gap=MERGE_GAP):
+        self.bam = bam
+        index = index or find_index(bam)
+        if index is None:
+            raise ValueError("{} has no index".format(bam))
+        self.index = read_index(index)
+        self.gap = gap
+        self.header, self.refids = self._read_header()
+
+    def _read_header(self):
+        """Returns the bytes of the BAM header (uncompressed), and a dict
+        mapping each reference name to its ID.
+        """
+        data = bytearray()
+        with open(self.bam, 'rb') as inp:
+            def need(size):
+                while len(data) < size:
+                    block = read_block(inp)
+                    if not block:
+                        raise ValueError("Truncated BAM file")
+                    data.extend(decompress_block(block))
+            need(8)
+            if data[:4] != BAM_MAGIC:
+                raise ValueError("{} is not a BAM file".format(self.bam))
+            offset = 8 + struct.unpack_from('<i', data, 4)[0]
+            need(offset + 4)
+            n_refs = struct.unpack_from('<i', data, offset)[0]
+            offset += 4
+            refids = {}
+            for refid in range(n_refs):
+                need(offset + 4)
+                l_name = struct.unpack_from('<i', data, offset)[0]
+                need(offset + 8 + l_name)
+                name = bytes(data[offset + 4:offset + 3 + l_name]).decode()
+                refids[name] = refid
+                offset += 8 + l_name
+        return bytes(data[:offset]), refids
+
+    def chunks(self, intervals):
+        """Returns the chunks (vstart, vend) that hold the records overlapping
+        intervals (contig, start, end), merged and sorted. Intervals on
+        contigs that are not in the BAM are ignored.
+        """
+        found = []
+        for contig, start, end in intervals:
+            refid = self.refids.get(contig)
+            if refid is None or refid >= len(self.index):
+                continue
+            found.extend(self.index[refid].chunks(start, end))
+        return merge_chunks(found, self.gap)
+
+    def write(self, intervals, out):
+        """Write a BAM file of the header and the chunks that overlap
+        ``intervals`` to ``out``, which is closed at the end.
+
+        Returns:
+            The number of compressed bytes read from the BAM
+        """
+        total = 0
+        with BgzfWriter(out, level=1) as writer:
+            writer.write(self.header)
+            for block, start, end in self.blocks(intervals):
+                total += len(block)
+                if start == 0 and end is None:
+                    writer.write_compressed(block)
+                else:
+                    writer.write(decompress_block(block)[start:end])
+        return total
+
+    def records(self, intervals):
+        """Yields the records (with their size prefix) in the chunks that
+        overlap ``intervals``, in order.
+        """
+        data = bytearray()
+        for block, start, end in self.blocks(intervals):
+            data.extend(decompress_block(block)[start:end])
+            offset = 0
+            while offset + 4 <= len(data):
+                size = 4 + struct.unpack_from('<i', data, offset)[0]
+                if offset + size > len(data):
+                    break
+                yield bytes(data[offset:offset + size])
+                offset += size
+            del data[:offset]
+
+    def blocks(self, intervals):
+        """Yields the compressed blocks of the chunks that overlap
+        ``intervals``, each with the (start, end) of the part of its data that
+        is in the chunk (end is None for the rest of the block).
+        """
+        with open(self.bam, 'rb') as inp:
+            for vstart, vend in self.chunks(intervals):
+                offset, start = vstart >> 16, vstart & 0xffff
+                last, stop = vend >> 16, vend & 0xffff
+                inp.seek(offset)
+                while offset < last or (offset == last and stop):
+                    block = read_block(inp)
+                    if not block:
+                        break
+                    yield block, start, stop if offset == last else None
+                    start = 0
+                    offset += len(block)
@@ -0,0 +1,637 @@
+# -*- coding: utf-8 -*-
+"""Coordinate sorting of alignments into an indexed BAM file, with bounded
+memory.
+
+:class:`BamSorter` reads SAM (or BAM) records, as an aligner writes them, and
+collects them in memory until they take up a share of the memory limit. Each
+full run is then sorted and spilled to a temporary BGZF file in a pool of
+threads, while the next run is collected. At the end the runs are merged
+(k-way), and the output is compressed by a pool of threads and indexed (BAI)
+as it is written. A run that fits in memory is never spilled. Encoding SAM as
+BAM is the slowest part, so with more than one thread, blocks of SAM lines are
+encoded by a pool of worker processes (see :func:`open_records`).
+
+With ``split``, the records of each reference are also written to a BAM file of
+their own (see :class:`ContigSplitter`) as soon as the merge has passed that
+reference, so that they can be processed while the rest is still being
+merged.
+
+Records with equal coordinates stay in input order, as with ``samtools sort``.
+Usage as a pipeline stage::
+
+    aligner ... | python -m evac.bamsort -m 2G -@ 8 -o sorted.bam
+"""
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+import gzip
+import heapq
+import logging
+from operator import itemgetter
+import os
+import re
+import shutil
+import struct
+import sys
+import tempfile
+import time
+from evac.bgzf import BaiIndexer, BgzfWriter, ParallelBgzfWriter, reg2bin
+from evac.readers import BAM_CORE, BAM_MAGIC
+
+log = logging.getLogger()
+
+# Approximate memory used by a record in a run, in addition to its size
+RECORD_OVERHEAD = 120
+
+# Size of the blocks of SAM text encoded by a worker at a time
+BLOCK_SIZE = 1024 ** 2
+
+# Number of records in a chunk of BAM input
+CHUNK_RECORDS = 1000
+
+# Unplaced reads (reference -1) sort after all others
+UNPLACED = 0xffffffff
+
+FLAG_REVERSE = 0x10
+FLAG_UNMAPPED = 0x4
+
+# CIGAR operations, and those that consume the reference
+CIGAR_OPS = b'MIDNSHP=X'
+CIGAR_REF = (0, 2, 3, 7, 8)
+CIGAR_RE = re.compile(rb'(\d+)([MIDNSHP=X])')
+CIGAR_CODES = dict(
+    (CIGAR_OPS[i:i + 1], i) for i in range(len(CIGAR_OPS)))
+
+SEQ_CODES = b'=ACMGRSVTWYHKDBN'
+# 4-bit codes of bases, in the high and low half of a byte
+SEQ_HIGH = bytes.maketrans(
+    SEQ_CODES + SEQ_CODES.lower(),
+    bytes((i % 16) << 4 for i in range(32)))
+SEQ_LOW = bytes.maketrans(
+    SEQ_CODES + SEQ_CODES.lower(), bytes(i % 16 for i in range(32)))
+QUAL_OFFSET = bytes.maketrans(
+    bytes(range(33, 127)), bytes(range(94)))
+
+ARRAY_FORMATS = dict(
+    c='b', C='B', s='h', S='H', i='i', I='I', f='f')
+# Integer tags are stored in the smallest type that holds them
+INT_TYPES = tuple(
+    (code.encode(), low, high, struct.Struct('<' + ARRAY_FORMATS[code]))
+    for code, low, high in (
+        ('C', 0, 0xff), ('c', -0x80, 0x7f), ('S', 0, 0xffff),
+        ('s', -0x8000, 0x7fff), ('I', 0, 0xffffffff),
+        ('i', -0x80000000, 0x7fffffff)))
+FLOAT = struct.Struct('<f')
+INT32 = struct.Struct('<i')
+
+class SamHeader(object):
+    """The header of a SAM file: its text and reference sequences.
+    """
+    def __init__(self, text, refs):
+        self.text = text
+        self.refs = refs
+        self.refids = dict((name, i) for i, (name, length) in enumerate(refs))
+
+    @classmethod
+    def from_text(cls, text):
+        refs = []
+        for line in text.splitlines():
+            if line.startswith(b'@SQ'):
+                tags = dict(
+                    field.split(b':', 1) for field in line.split(b'\t')[1:]
+                    if b':' in field)
+                refs.append((tags[b'SN'], int(tags[b'LN'])))
+        return cls(text, refs)
+
+    def sorted_text(self):
+        """The header text with the sort order set to coordinate.
+        """
+        lines = self.text.splitlines()
+        if lines and lines[0].startswith(b'@HD'):
+            fields = [
+                field for field in lines[0].split(b'\t')
+                if not field.startswith(b'SO:')]
+            lines[0] = b'\t'.join(fields + [b'SO:coordinate'])
+        else:
+            lines.insert(0, b'@HD\tVN:1.6\tSO:coordinate')
+        return b''.join(line + b'\n' for line in lines)
+
+    def to_bam(self, text):
+        parts = [BAM_MAGIC, struct.pack('<i', len(text)), text,
+                 struct.pack('<i', len(self.refs))]
+        for name, length in self.refs:
+            parts.append(struct.pack('<i', len(name) + 1))
+            parts.append(name + b'\0')
+            parts.append(struct.pack('<I', length))
+        return b''.join(parts)
+
+def sam_records(inp):
+    """Parse a SAM stream.
+
+    Returns:
+        A tuple (SamHeader, iterable of encoded BAM records)
+    """
+    header, line = _read_sam_header(inp)
+    def records():
+        refids = header.refids
+        if line.strip():
+            yield encode_sam(line, refids)
+        for current in inp:
+            if current.strip():
+                yield encode_sam(current, refids)
+    return header, records()
+
+def sam_chunks(inp, pool=None, workers=1, block_size=BLOCK_SIZE):
+    """Parse a SAM stream into chunks of records (see :func:`open_records`).
+    Blocks of about ``block_size`` bytes of lines are encoded by ``pool``, a
+    ProcessPoolExecutor with ``workers`` processes, if given; two blocks per
+    worker are in flight at a time, and the chunks are generated in input
+    order.
+
+    Returns:
+        A tuple (SamHeader, iterable of chunks)
+    """
+    header, line = _read_sam_header(inp)
+    encode = partial(_encode_block, refids=header.refids)
+    def blocks():
+        block = line + inp.read(block_size)
+        while block:
+            # Complete the last line
+            yield block + inp.readline()
+            block = inp.read(block_size)
+    def chunks():
+        if pool is None:
+            for block in blocks():
+                yield encode(block)
+            return
+        pending = deque()
+        for block in blocks():
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+            pending.append(pool.submit(encode, block))
+        while pending:
+            yield pending.popleft().result()
+    return header, chunks()
+
+def _read_sam_header(inp):
+    """Returns the SamHeader of a SAM stream and the line after it.
+    """
+    header = []
+    line = inp.readline()
+    while line.startswith(b'@'):
+        header.append(line)
+        line = inp.readline()
+    return SamHeader.from_text(b''.join(header)), line
+
+def _encode_block(block, refids):
+    """Encode a block of SAM lines as a chunk of records.
+    """
+    records = []
+    size = 0
+    for line in block.splitlines():
+        if line.strip():
+            record = encode_sam(line, refids)
+            records.append((sort_key(record), record))
+            size += len(record)
+    return records, size
+
+def _chunks(records, size=CHUNK_RECORDS):
+    """Group BAM records into chunks (see :func:`open_records`).
+    """
+    chunk = []
+    chunk_size = 0
+    for record in records:
+        chunk.append((sort_key(record), record))
+        chunk_size += len(record)
+        if len(chunk) >= size:
+            yield chunk, chunk_size
+            chunk = []
+            chunk_size = 0
+    if chunk:
+        yield chunk, chunk_size
+
+def encode_sam(line, refids):
+    """Encode a SAM line as a BAM record (with its block size prefix).
+    """
+    fields = line.rstrip(b'\r\n').split(b'\t')
+    (qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, seq,
+     qual) = fields[:11]
+    refid = refids[rname] if rname != b'*' else -1
+    pos = int(pos) - 1
+    if cigar == b'*':
+        ops = []
+    else:
+        ops = [
+            (int(length) << 4) | CIGAR_CODES[op]
+            for length, op in CIGAR_RE.findall(cigar)]
+    ref_len = sum(op >> 4 for op in ops if op & 0xf in CIGAR_REF)
+    if rnext == b'=':
+        next_refid = refid
+    elif rnext == b'*':
+        next_refid = -1
+    else:
+        next_refid = refids[rnext]
+    if seq == b'*':
+        l_seq = 0
+        packed = b''
+    else:
+        # Combine the high and low halves of every byte as big integers
+        l_seq = len(seq)
+        high = seq[0::2].translate(SEQ_HIGH)
+        low = seq[1::2].translate(SEQ_LOW)
+        if l_seq % 2:
+            low += b'\0'
+        packed = (
+            int.from_bytes(high, 'big') | int.from_bytes(low, 'big')
+        ).to_bytes(len(high), 'big')
+    if qual == b'*':
+        qual = b'\xff' * l_seq
+    else:
+        qual = qual.translate(QUAL_OFFSET)
+    data = b''.join((
+        BAM_CORE.pack(
+            refid, pos, len(qname) + 1, int(mapq),
+            reg2bin(pos, pos + (ref_len or 1)), len(ops), int(flag), l_seq,
+            next_refid, int(pnext) - 1, int(tlen)),
+        qname, b'\0', struct.pack('<{}I'.format(len(ops)), *ops), packed,
+        qual, b''.join([encode_tag(tag) for tag in fields[11:]])))
+    return INT32.pack(len(data)) + data
+
+def encode_tag(tag):
+    """Encode a SAM optional field (TAG:TYPE:VALUE).
+    """
+    name = tag[:2]
+    type_ = tag[3:4]
+    value = tag[5:]
+    if type_ == b'i':
+        value = int(value)
+        for code, low, high, packer in INT_TYPES:
+            if low <= value <= high:
+                return name + code + packer.pack(value)
+        raise ValueError("Integer tag out of range: {}".format(tag))
+    if type_ == b'A':
+        return name + b'A' + value[:1]
+    if type_ == b'f':
+        return name + b'f' + FLOAT.pack(float(value))
+    if type_ in (b'Z', b'H'):
+        return name + type_ + value + b'\0'
+    if type_ == b'B':
+        subtype, *values = value.split(b',')
+        fmt = ARRAY_FORMATS[subtype.decode()]
+        convert = float if fmt == 'f' else int
+        return name + b'B' + subtype + struct.pack(
+            '<i{}{}'.format(len(values), fmt), len(values),
+            *(convert(v) for v in values))
+    raise ValueError("Unsupported tag type: {}".format(tag))
+
+def bam_records(inp):
+    """Parse a BAM stream.
+
+    Returns:
+        A tuple (SamHeader, iterable of BAM records)
+    """
+    inp = gzip.GzipFile(fileobj=inp, mode='rb')
+    read = _reader(inp)
+    if read(4) != BAM_MAGIC:
+        raise ValueError("Not a BAM file")
+    text = read(struct.unpack('<i', read(4))[0])
+    refs = []
+    for i in range(struct.unpack('<i', read(4))[0]):
+        name = read(struct.unpack('<i', read(4))[0])[:-1]
+        refs.append((name, struct.unpack('<I', read(4))[0]))
+    def records():
+        while True:
+            size = inp.read(4)
+            if not size:
+                return
+            yield size + read(struct.unpack('<i', size)[0])
+    return SamHeader(text.rstrip(b'\0'), refs), records()
+
+def _reader(inp):
+    def read(size):
+        data = inp.read(size)
+        if len(data) != size:
+            raise ValueError("Truncated BAM file")
+        return data
+    return read
+
+def sort_key(record):
+    """Returns the sort key of a BAM record: its reference, position and
+    strand.
+    """
+    refid, pos = struct.unpack_from('<ii', record, 4)
+    flag = struct.unpack_from('<H', record, 18)[0]
+    return (
+        ((refid & UNPLACED) << 33) | ((pos + 1) << 1) |
+        (1 if flag & FLAG_REVERSE else 0))
+
+def record_extent(record):
+    """Returns (refid, begin, end, unmapped) of a BAM record.
+    """
+    (block_size, refid, pos, l_read_name, mapq, bin_, n_cigar, flag,
+     l_seq) = struct.unpack_from('<iiiBBHHHi', record, 0)
+    end = pos + 1
+    if n_cigar and not flag & FLAG_UNMAPPED:
+        ops = struct.unpack_from(
+            '<{}I'.format(n_cigar), record, 4 + BAM_CORE.size + l_read_name)
+        ref_len = sum(op >> 4 for op in ops if op & 0xf in CIGAR_REF)
+        end = pos + max(ref_len, 1)
+    return refid, pos, end, bool(flag & FLAG_UNMAPPED)
+
+class BamSorter(object):
+    """External merge sort of BAM records.
+
+    Args:
+        mem: Memory limit for the records held in memory, in bytes
+        threads: Number of threads for spilling runs and compressing output
+        tmpdir: Directory for spilled runs
+        level: Compression level of the output
+    """
+    def __init__(self, mem=768 * 1024 ** 2, threads=1, tmpdir=None, level=6):
+        self.threads = max(1, threads)
+        # While runs are being spilled, the next run is being collected
+        self.run_size = mem // (self.threads + 1)
+        self.tmpdir = tempfile.mkdtemp(prefix='bamsort.', dir=tmpdir)
+        self.level = level
+        self.pool = ThreadPoolExecutor(self.threads)
+        self.spills = []
+        self.runs = []
+
+    def sort(self, records, header, output, bai=None, split=None):
+        """Sort records into a BAM file.
+
+        Args:
+            records: Iterable of BAM records
+            header: SamHeader
+            output, bai, split: See :meth:`sort_chunks`
+
+        Returns:
+            The number of records written
+        """
+        return self.sort_chunks(_chunks(records), header, output, bai, split)
+
+    def sort_chunks(self, chunks, header, output, bai=None, split=None):
+        """Sort chunks of records (see :func:`open_records`) into a BAM file.
+
+        Args:
+            chunks: Iterable of chunks
+            header: SamHeader
+            output: Path of the output file, or a binary file object, or None
+                to only write ``split``
+            bai: Path of the BAI index to write, if any
+            split: Optional ContigSplitter that also gets the sorted records
+
+        Returns:
+            The number of records written
+        """
+        try:
+            run = []
+            size = 0
+            for chunk, chunk_size in chunks:
+                run.extend(chunk)
+                size += chunk_size + RECORD_OVERHEAD * len(chunk)
+                if size >= self.run_size:
+                    self._spill(run)
+                    run = []
+                    size = 0
+            run.sort(key=itemgetter(0))
+            if self.spills:
+                log.info("Merging {} sorted runs".format(
+                    len(self.spills) + 1))
+                for spill in self.spills:
+                    self.runs.append(spill.result())
+                merged = heapq.merge(
+                    *([_read_run(path) for path in self.runs] + [run]),
+                    key=itemgetter(0))
+            else:
+                merged = run
+            return self._write(merged, header, output, bai, split)
+        finally:
+            self.pool.shutdown()
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _spill(self, run):
+        # Bound the number of runs held in memory
+        pending = [spill for spill in self.spills if not spill.done()]
+        if len(pending) >= self.threads:
+            pending[0].result()
+        path = os.path.join(self.tmpdir, 'run{}.bgz'.format(len(self.spills)))
+        self.spills.append(self.pool.submit(_write_run, run, path))
+
+    def _write(self, records, header, output, bai, split=None):
+        writer = indexer = None
+        if output is not None:
+            writer = ParallelBgzfWriter(output, self.threads, self.level)
+            writer.write(header.to_bam(header.sorted_text()))
+            writer.flush()
+            if bai:
+                indexer = BaiIndexer(len(header.refs))
+        count = 0
+        for key, record in records:
+            if writer is not None:
+                vstart = writer.tell()
+                writer.write(record)
+                if indexer is not None:
+                    indexer.add(
+                        *record_extent(record), vstart=vstart,
+                        vend=writer.tell())
+            if split is not None:
+                split.add(record)
+            count += 1
+        if writer is not None:
+            writer.close()
+        if indexer is not None:
+            indexer.remap(writer.virtual_offset)
+            indexer.write(bai)
+        if split is not None:
+            split.close()
+        return count
+
+class ContigSplitter(object):
+    """Writes the sorted records of each reference to an indexed BAM file of
+    its own, ``{refid:06d}.bam`` (and ``.bam.bai``) in ``directory``. A file
+    only appears (by renaming) once all the records of its reference are
+    written, and a ``done`` file marks the end. Unplaced reads are not
+    written.
+
+    Args:
+        directory: Directory for the files
+        header: SamHeader; every file gets the complete header
+        threads: Number of compression threads
+        level: Compression level; the files are read once, so fast is best
+        max_pending: If set, wait before starting a file while this many
+            completed files are still in the directory, so that a consumer
+            that deletes the files it is done with bounds the space they
+            take up
+        interval: Seconds between checks for the number of files
+    """
+    def __init__(
+            self, directory, header, threads=1, level=1, max_pending=None,
+            interval=0.2):
+        self.directory = directory
+        self.header = header
+        self.text = header.to_bam(header.sorted_text())
+        self.threads = threads
+        self.level = level
+        self.max_pending = max_pending
+        self.interval = interval
+        self.refid = None
+        self.writer = self.indexer = None
+
+    def add(self, record):
+        refid = struct.unpack_from('<i', record, 4)[0]
+        if refid != self.refid:
+            self._finish()
+            self.refid = refid
+            if refid >= 0:
+                self._start()
+        if self.writer is not None:
+            vstart = self.writer.tell()
+            self.writer.write(record)
+            self.indexer.add(
+                *record_extent(record), vstart=vstart,
+                vend=self.writer.tell())
+
+    def path(self, refid):
+        return os.path.join(self.directory, '{:06d}.bam'.format(refid))
+
+    def pending(self):
+        """The number of completed files in the directory.
+        """
+        return sum(
+            1 for name in os.listdir(self.directory) if name.endswith('.bam'))
+
+    def _start(self):
+        if self.max_pending:
+            while self.pending() >= self.max_pending:
+                time.sleep(self.interval)
+        self.writer = ParallelBgzfWriter(
+            self.path(self.refid) + '.tmp', self.threads, self.level)
+        self.writer.write(self.text)
+        self.writer.flush()
+        self.indexer = BaiIndexer(len(self.header.refs))
+
+    def _finish(self):
+        if self.writer is None:
+            return
+        path = self.path(self.refid)
+        self.writer.close()
+        self.indexer.remap(self.writer.virtual_offset)
+        self.indexer.write(path + '.bai')
+        os.rename(path + '.tmp', path)
+        self.writer = self.indexer = None
+
+    def close(self):
+        self._finish()
+        open(os.path.join(self.directory, 'done'), 'wb').close()
+
+def _write_run(run, path):
+    run.sort(key=itemgetter(0))
+    with BgzfWriter(path, level=1) as out:
+        for key, record in run:
+            out.write(record)
+    return path
+
+def _read_run(path):
+    with gzip.open(path, 'rb') as inp:
+        read = _reader(inp)
+        while True:
+            size = inp.read(4)
+            if not size:
+                return
+            record = size + read(struct.unpack('<i', size)[0])
+            yield sort_key(record), record
+
+def open_records(inp, pool=None, workers=1):
+    """Parse SAM or BAM (detected from the first bytes) from a binary stream
+    into chunks of records. A chunk is a tuple (records, size) of a list of
+    (sort key, BAM record) tuples in input order and their total size.
+
+    Args:
+        inp: The stream
+        pool: ProcessPoolExecutor that encodes SAM, if any
+        workers: The number of processes of the pool
+
+    Returns:
+        A tuple (SamHeader, iterable of chunks)
+    """
+    inp = inp if hasattr(inp, 'peek') else open(inp.fileno(), 'rb')
+    if inp.peek(2)[:2] == b'\x1f\x8b':
+        header, records = bam_records(inp)
+        return header, _chunks(records)
+    return sam_chunks(inp, pool, workers)
+
+def main(argv=None):
+    # Imported here because the scheduler imports the pipelines, which import
+    # this module
+    from evac.scheduler import parse_size
+    parser = ArgumentParser(
+        description="Sort SAM/BAM records by coordinate into an indexed BAM.")
+    parser.add_argument(
+        'input', nargs='?', default='-',
+        help="SAM or BAM file (default: stdin)")
+    parser.add_argument(
+        '-o', '--output', default=None,
+        help="Output BAM file (default: stdout, without an index, unless "
+            "--split is given)")
+    parser.add_argument(
+        '-m', '--mem', default='768M',
+        help="Memory limit for records held in memory, e.g. 2G")
+    parser.add_argument(
+        '-@', '--threads', type=int, default=1,
+        help="Threads for spilling and compression, and worker processes "
+            "for encoding SAM")
+    parser.add_argument(
+        '-T', '--tmpdir', default=None,
+        help="Directory for temporary files")
+    parser.add_argument(
+        '-l', '--level', type=int, default=6,
+        help="Compression level of the output")
+    parser.add_argument(
+        '--no-index', action='store_false', dest='index', default=True,
+        help="Don't write a BAI index")
+    parser.add_argument(
+        '--bai', default=None,
+        help="Path of the BAI index (default: the output path + '.bai'; "
+            "required to index output written to stdout)")
+    parser.add_argument(
+        '--split', default=None, metavar="DIR",
+        help="Also write the records of each reference to an indexed BAM file "
+            "of its own in DIR, as soon as they are complete")
+    parser.add_argument(
+        '--max-pending', type=int, default=None, metavar="N",
+        help="With --split, wait while N completed files are still in DIR")
+    args = parser.parse_args(argv)
+    if args.output is None and not args.split:
+        args.output = '-'
+    if args.input == '-':
+        inp = sys.stdin.buffer
+    else:
+        inp = open(args.input, 'rb')
+    # Started before any thread, so that the workers are forked from a
+    # single-threaded process
+    pool = ProcessPoolExecutor(args.threads) if args.threads > 1 else None
+    header, chunks = open_records(inp, pool, args.threads)
+    if args.output == '-':
+        output = sys.stdout.buffer
+    else:
+        output = args.output
+    bai = None
+    if args.index and args.output:
+        bai = args.bai or (None if args.output == '-' else args.output + '.bai')
+    split = None
+    if args.split:
+        split = ContigSplitter(
+            args.split, header, args.threads, max_pending=args.max_pending)
+    sorter = BamSorter(
+        parse_size(args.mem), args.threads, args.tmpdir, args.level)
+    try:
+        count = sorter.sort_chunks(chunks, header, output, bai, split)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    log.info("Sorted {} records".format(count))
+
+if __name__ == '__main__':
+    main()
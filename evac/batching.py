@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""Batch sizes for the stream of reads to the aligner.
+
+Readers parse reads in batches, and the transport writes each batch to the
+aligner in one go. With small batches the reader spends most of its time on
+per-batch overhead, and a fast aligner is left waiting. Large batches of long
+reads take a lot of memory. With the 'fifo' transport a batch must also fit in
+the pipe buffer, because the aligner reads both mates in lock-step.
+
+Readers ask a sizer for the size of each batch as they start it.
+:class:`FixedBatchSize` always gives ``--batch-size``. :class:`AdaptiveBatchSize`
+is updated after every batch with three measurements:
+
+* how long the reader took to produce the batch;
+* how long the transport was blocked writing it;
+* how full the buffer to the aligner is.
+
+Every ``window`` batches, it:
+
+* grows the batch size when the aligner keeps up with the reader, meaning
+  writes don't block and the buffer is not nearly full. The reader is then the
+  bottleneck, and larger batches make it faster.
+* shrinks the batch size when the aligner is the bottleneck, meaning the
+  buffer is nearly full and writes block. The reader then has time to spare,
+  and smaller batches take less memory. It stops shrinking at ``min_bytes``,
+  below which memory no longer matters but the per-batch overhead would take
+  CPU away from the aligner.
+* keeps one mate of a batch within ``max_bytes`` of FASTQ.
+
+The size of a read is only known once one has been read, so the first batch
+is a single pair. The size of the next batch is then bounded by ``max_bytes``
+at that size per pair. Every batch is also checked with
+:meth:`~AdaptiveBatchSize.fit` before it is written, so a batch of longer
+reads shrinks the next one at once.
+
+The controller only sees the numbers passed to
+:meth:`AdaptiveBatchSize.update`, so a simulated consumer can drive it (see
+tests/batch_sizing.py).
+"""
+import logging
+import multiprocessing
+
+log = logging.getLogger()
+
+MB = 1024 * 1024
+
+# The size is kept in shared memory so that the parent can sample it while a
+# forked reader process adjusts it
+_mp = multiprocessing.get_context('fork')
+
+class FixedBatchSize(object):
+    """A batch size that does not change.
+
+    Args:
+        size: Number of read pairs in each batch
+    """
+    def __init__(self, size=1000):
+        self._size = _mp.RawValue('q', size)
+        # The size to use for anything that is only sized once, such as the
+        # requests to a remote source
+        self.initial = size
+
+    @property
+    def size(self):
+        return self._size.value
+
+    @size.setter
+    def size(self, value):
+        self._size.value = value
+
+    def fit(self, pairs, nbytes):
+        """Check the size of a batch before it is written.
+
+        Args:
+            pairs: Number of read pairs in the batch
+            nbytes: Size of the batch as FASTQ (both mates), in bytes
+        """
+        pass
+
+    def update(self, pairs, nbytes, read_time, write_time, fill=None):
+        """Record the measurements of one batch.
+
+        Args:
+            pairs: Number of read pairs in the batch
+            nbytes: Size of the batch as FASTQ (both mates), in bytes
+            read_time: Seconds the reader took to produce the batch
+            write_time: Seconds spent writing the batch to the transport
+            fill: Fraction of the buffer to the aligner that is full after
+                writing the batch, or None if unknown
+        """
+        pass
+
+    def finish(self):
+        """Called at the end of the stream.
+        """
+        pass
+
+class AdaptiveBatchSize(FixedBatchSize):
+    """A batch size tuned from the measured rates of the reader and the
+    aligner.
+
+    Args:
+        size: Initial batch size, from the second batch on (the first is a
+            single pair)
+        min_size: Smallest batch size, unless the initial size or the
+            ``max_bytes`` bound is smaller
+        max_size: Largest batch size
+        max_bytes: Largest size of one mate of a batch, as FASTQ
+        min_bytes: Size of one mate of a batch below which the batch size is
+            not shrunk
+        window: Number of batches between adjustments
+        high: Buffer fill above which the aligner is considered the
+            bottleneck
+        grow: Factor by which to grow the batch size
+        shrink: Factor by which to shrink the batch size
+    """
+    def __init__(
+            self, size=1000, min_size=100, max_size=1000000, max_bytes=32 * MB,
+            min_bytes=MB, window=4, high=0.75, grow=2.0,
+            shrink=0.75):
+        # The first batch is a single pair, to measure the size of a read
+        super(AdaptiveBatchSize, self).__init__(1)
+        self.initial = min(size, max_size)
+        self.min_size = min(min_size, size)
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.min_bytes = min_bytes
+        self.window = window
+        self.high = high
+        self.grow = grow
+        self.shrink = shrink
+        self.batches = 0
+        self.smallest = self.largest = None
+        self._reset()
+
+    def _reset(self):
+        self.pending = 0
+        self.pairs = 0
+        self.nbytes = 0
+        self.read_time = 0.0
+        self.write_time = 0.0
+        self.fills = []
+
+    def fit(self, pairs, nbytes):
+        if not pairs:
+            return
+        limit = self.limit(nbytes / (2 * pairs))
+        if self.smallest is None:
+            # The first batch: start at the initial size, within the bound
+            self._resize(min(self.initial, limit))
+        elif self.size > limit:
+            # Don't wait for the end of the window to get within the memory
+            # bound
+            log.info("Batch size {} -> {} (over {:.1f} MB per mate)".format(
+                self.size, limit, self.max_bytes / MB))
+            self._resize(limit)
+            self._reset()
+
+    def update(self, pairs, nbytes, read_time, write_time, fill=None):
+        self.batches += 1
+        self.pending += 1
+        self.pairs += pairs
+        self.nbytes += nbytes
+        self.read_time += read_time
+        self.write_time += write_time
+        if fill is not None:
+            self.fills.append(fill)
+        if self.pending >= self.window:
+            self._adjust()
+            self._reset()
+
+    def limit(self, pair_bytes):
+        """The largest batch size for pairs of ``pair_bytes`` bytes per mate.
+        """
+        return max(1, min(
+            self.max_size, int(self.max_bytes // max(pair_bytes, 1))))
+
+    def _adjust(self):
+        if not self.pairs:
+            return
+        size = self.size
+        pair_bytes = self.nbytes / (2 * self.pairs)
+        busy = self.read_time + self.write_time
+        blocked = self.write_time / busy if busy else 0.0
+        fill = sum(self.fills) / len(self.fills) if self.fills else None
+        new_size = size
+        if blocked < 0.1 and (fill is None or fill < self.high):
+            new_size = int(size * self.grow)
+        elif blocked >= 0.5 and (fill is None or fill >= self.high):
+            floor = int(self.min_bytes // max(pair_bytes, 1))
+            if size > floor:
+                new_size = max(floor, int(size * self.shrink))
+        # The memory bound takes precedence over the smallest size
+        new_size = min(max(self.min_size, new_size), self.limit(pair_bytes))
+        if new_size == size:
+            return
+        self._resize(new_size)
+        log.info(
+            "Batch size {} -> {} (reader {:.0f} pairs/s, blocked on the "
+            "aligner {:.0%} of the time, buffer {})".format(
+                size, new_size, self.pairs / (self.read_time or 1e-9),
+                blocked, "?" if fill is None else "{:.0%} full".format(fill)))
+
+    def _resize(self, size):
+        self.size = size
+        self.smallest = min(self.smallest or size, size)
+        self.largest = max(self.largest or size, size)
+
+    def finish(self):
+        log.info(
+            "Read {} batches; batch size ranged from {} to {} (final "
+            "{})".format(
+                self.batches, self.smallest, self.largest, self.size))
+
+def batch_sizer(args, transport=None):
+    """Create the batch sizer for a set of command-line args.
+
+    Args:
+        args: a Namespace object
+        transport: The transport the batches are written to, if any; its
+            ``max_batch_bytes`` also bounds the size of a batch
+
+    Returns:
+        A FixedBatchSize or AdaptiveBatchSize
+    """
+    if getattr(args, 'batch_sizing', 'fixed') != 'adaptive':
+        return FixedBatchSize(args.batch_size)
+    max_bytes = args.batch_mem * MB // 2
+    limit = getattr(transport, 'max_batch_bytes', None)
+    if limit:
+        max_bytes = min(max_bytes, limit)
+    return AdaptiveBatchSize(args.batch_size, max_bytes=max_bytes)
@@ -0,0 +1,970 @@
+# -*- coding: utf-8 -*-
+"""Benchmark every pipeline and caller on synthetic data.
+
+Generates a random reference, paired reads (FASTQ and unaligned BAM), an
+aligned BAM, a known-sites VCF and a GFF, then runs each pipeline in
+:data:`evac.pipeline.pipelines` and each caller in
+:data:`evac.varcallers.callers` end to end with the aligners and callers
+replaced by fast stub executables. The stubs read all of their input and
+write output in the right format, so the measurements reflect the cost of the
+streaming layer (readers, transports, executor, merging) rather than of the
+tools themselves.
+
+Results are written as JSON, one entry per benchmark with the wall time, CPU
+time and peak RSS of the whole run and the metrics of every stage, so that
+runs on different commits can be compared (see ``--compare``)::
+
+    python -m evac.bench -o before.json
+    git checkout other-branch
+    python -m evac.bench -o after.json --compare before.json
+"""
+from argparse import ArgumentParser
+import gzip
+from inspect import isclass
+from itertools import cycle
+import json
+import os
+import platform
+import random
+import shutil
+from subprocess import Popen, DEVNULL, check_output
+import sys
+import tempfile
+from threading import Thread
+import time
+import zlib
+import evac
+from evac.bamsort import record_extent
+from evac.bgzf import BaiIndexer, BgzfWriter, TabixIndexer, reg2bin
+from evac.executor import METRICS_ENV
+from evac.readers import BAM_CORE, BAM_MAGIC
+
+COMPLEMENT = bytes.maketrans(b'ACGT', b'TGCA')
+BASES = bytes(b'ACGT'[i & 3] for i in range(256))
+BAM_CODES = bytes.maketrans(b'=ACGTN', bytes((0, 1, 2, 4, 8, 15)))
+FLAG_PAIRED = 0x1
+FLAG_PROPER_PAIR = 0x2
+FLAG_UNMAPPED = 0x4 | 0x8
+FLAG_MATE_REVERSE = 0x20
+FLAG_REVERSE = 0x10
+FLAG_READ1 = 0x40
+FLAG_READ2 = 0x80
+INSERT_SIZE = 300
+# Distance between the variants that the stub callers report
+STUB_VARIANT_STEP = 100
+
+# Fixtures
+
+class Fixtures(object):
+    """Synthetic input files.
+
+    Args:
+        workdir: Directory in which to create the files
+        reads: Number of read pairs
+        read_length: Length of each read
+        contigs: Number of reference contigs
+        contig_length: Length of each contig
+        seed: Random seed
+    """
+    def __init__(
+            self, workdir, reads=100000, read_length=100, contigs=4,
+            contig_length=1000000, seed=1):
+        self.workdir = workdir
+        self.reads = reads
+        self.read_length = read_length
+        self.contig_names = ['chr{}'.format(i + 1) for i in range(contigs)]
+        self.contig_length = contig_length
+        self.seed = seed
+        self.index = self.path('index')
+        self.reference = self.path('ref.fa')
+        self.fastq1 = self.path('reads.1.fq')
+        self.fastq2 = self.path('reads.2.fq')
+        self.unaligned_bam = self.path('reads.bam')
+        self.aligned_bam = self.path('aligned.bam')
+        self.known_sites = self.path('known.vcf.gz')
+        self.contaminants = self.path('contaminants.fa')
+        self.gff = self.path('features.gff')
+        self.counts = self.path('counts.txt')
+        # A targeted panel: a few short regions per contig
+        self.panel = self.path('panel.bed')
+        self.assembly = self.path('assembly.txt')
+        # A local stand-in for SRA, with the reads under a fake accession
+        self.archive = self.path('archive')
+        self.accession = 'SRR0000001'
+
+    def path(self, name):
+        return os.path.join(self.workdir, name)
+
+    def as_dict(self):
+        return dict(
+            reads=self.reads, read_length=self.read_length,
+            contigs=len(self.contig_names),
+            contig_length=self.contig_length, seed=self.seed)
+
+    def create(self):
+        """Write all fixtures. Returns self.
+        """
+        rng = random.Random(self.seed)
+        os.makedirs(self.index, exist_ok=True)
+        # As in a STAR index; the stub aligners place reads on these contigs
+        with open(os.path.join(self.index, 'chrNameLength.txt'), 'wt') as out:
+            for name in self.contig_names:
+                out.write('{}\t{}\n'.format(name, self.contig_length))
+        contigs = [
+            rng.getrandbits(8 * self.contig_length).to_bytes(
+                self.contig_length, 'little').translate(BASES)
+            for name in self.contig_names]
+        with open(self.reference, 'wb') as out:
+            for name, seq in zip(self.contig_names, contigs):
+                out.write(b'>' + name.encode() + b'\n')
+                for i in range(0, len(seq), 60):
+                    out.write(seq[i:i + 60] + b'\n')
+        pairs = self._sample_pairs(rng, contigs)
+        self._write_fastq(pairs)
+        self._write_archive()
+        self._write_unaligned_bam(pairs)
+        self._write_aligned_bam(pairs)
+        self._write_known_sites(contigs)
+        self._write_contaminants(contigs)
+        self._write_annotation(rng)
+        self._write_counts(rng)
+        self._write_panel(rng)
+        return self
+
+    def _sample_pairs(self, rng, contigs):
+        """Sample read pairs from the reference.
+
+        Returns:
+            A list of (contig index, position of read 1, position of read 2,
+            sequence 1, sequence 2) tuples; sequence 2 is reverse complemented
+        """
+        length = self.read_length
+        span = max(INSERT_SIZE, length)
+        pairs = []
+        for i in range(self.reads):
+            contig = rng.randrange(len(contigs))
+            pos1 = rng.randrange(self.contig_length - span)
+            pos2 = pos1 + span - length
+            seq = contigs[contig]
+            pairs.append((
+                contig, pos1, pos2, seq[pos1:pos1 + length],
+                seq[pos2:pos2 + length].translate(COMPLEMENT)[::-1]))
+        return pairs
+
+    def _write_fastq(self, pairs):
+        qual = b'I' * self.read_length
+        with open(self.fastq1, 'wb') as out1, open(self.fastq2, 'wb') as out2:
+            for i, (contig, pos1, pos2, seq1, seq2) in enumerate(pairs):
+                name = 'read{}'.format(i).encode()
+                for out, mate, seq in (
+                        (out1, b'/1', seq1), (out2, b'/2', seq2)):
+                    out.write(b''.join((
+                        b'@', name, mate, b'\n', seq, b'\n+\n', qual, b'\n')))
+
+    def _write_archive(self):
+        os.makedirs(self.archive, exist_ok=True)
+        for mate, fastq in ((1, self.fastq1), (2, self.fastq2)):
+            path = os.path.join(self.archive, '{}_{}.fastq'.format(
+                self.accession, mate))
+            if os.path.lexists(path):
+                os.remove(path)
+            os.symlink(fastq, path)
+
+    def _bam_header(self, sort_order):
+        text = '@HD\tVN:1.4\tSO:{}\n'.format(sort_order) + ''.join(
+            '@SQ\tSN:{}\tLN:{}\n'.format(name, self.contig_length)
+            for name in self.contig_names)
+        return text, [(name, self.contig_length) for name in self.contig_names]
+
+    def _write_unaligned_bam(self, pairs):
+        text, refs = self._bam_header('queryname')
+        flag = FLAG_PAIRED | FLAG_UNMAPPED
+        records = []
+        for i, (contig, pos1, pos2, seq1, seq2) in enumerate(pairs):
+            name = 'read{}'.format(i).encode()
+            records.append(bam_record(name, seq1, flag | FLAG_READ1))
+            records.append(bam_record(name, seq2, flag | FLAG_READ2))
+        write_bam(self.unaligned_bam, text, refs, records)
+
+    def _write_aligned_bam(self, pairs):
+        text, refs = self._bam_header('coordinate')
+        records = []
+        paired = FLAG_PAIRED | FLAG_PROPER_PAIR
+        for i, (contig, pos1, pos2, seq1, seq2) in enumerate(pairs):
+            name = 'read{}'.format(i).encode()
+            tlen = pos2 + self.read_length - pos1
+            records.append((contig, pos1, bam_record(
+                name, seq1, paired | FLAG_MATE_REVERSE | FLAG_READ1,
+                contig, pos1, pos2, tlen)))
+            # The stored sequence of a reverse-strand read is the reference
+            # strand
+            records.append((contig, pos2, bam_record(
+                name, seq2.translate(COMPLEMENT)[::-1],
+                paired | FLAG_REVERSE | FLAG_READ2,
+                contig, pos2, pos1, -tlen)))
+        records.sort(key=lambda r: (r[0], r[1]))
+        write_bam(
+            self.aligned_bam, text, refs, [r[2] for r in records], index=True)
+
+    def _write_contaminants(self, contigs):
+        """Use the start of each contig as a 'contaminant' for read screening.
+        """
+        with open(self.contaminants, 'wb') as out:
+            for name, seq in zip(self.contig_names, contigs):
+                out.write(b'>' + name.encode() + b'\n' + seq[:10000] + b'\n')
+
+    def _write_known_sites(self, contigs):
+        """Write a bgzipped, tabix-indexed VCF with a SNP every
+        STUB_VARIANT_STEP bases.
+        """
+        indexer = TabixIndexer()
+        with BgzfWriter(self.known_sites) as out:
+            out.write(b'##fileformat=VCFv4.2\n' + b''.join(
+                '##contig=<ID={},length={}>\n'.format(
+                    name, self.contig_length).encode()
+                for name in self.contig_names) +
+                b'#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+            out.flush()
+            for name, seq in zip(self.contig_names, contigs):
+                for pos in range(
+                        STUB_VARIANT_STEP, len(seq), STUB_VARIANT_STEP):
+                    ref = seq[pos - 1:pos]
+                    alt = ref.translate(COMPLEMENT)
+                    start = out.tell()
+                    out.write(b'\t'.join((
+                        name.encode(), str(pos).encode(),
+                        'rs{}'.format(pos).encode(), ref, alt, b'.', b'.',
+                        b'VC=SNV')) + b'\n')
+                    indexer.add(name.encode(), pos - 1, pos, start, out.tell())
+        indexer.write(self.known_sites + '.tbi')
+
+    def _write_annotation(self, rng):
+        """Write a RefSeq-style GFF of genes and the assembly report that maps
+        its sequence accessions to the contig names.
+        """
+        with open(self.assembly, 'wt') as out:
+            out.write('# Sequence-Name\tSequence-Role\tAssigned-Molecule\t'
+                      'Assigned-Molecule-Location/Type\tGenBank-Accn\t'
+                      'Relationship\tRefSeq-Accn\tAssembly-Unit\n')
+            for i, name in enumerate(self.contig_names):
+                out.write('{}\tassembled-molecule\t{}\tChromosome\tCM{}\t=\t'
+                          'NC_{:06d}\tPrimary Assembly\n'.format(
+                              name, i + 1, i + 1, i + 1))
+        with open(self.gff, 'wt') as out:
+            out.write('##gff-version 3\n')
+            for i, name in enumerate(self.contig_names):
+                starts = sorted(
+                    rng.randrange(1, self.contig_length)
+                    for j in range(self.contig_length // 10000))
+                for j, start in enumerate(starts):
+                    end = min(start + rng.randrange(1000, 50000),
+                              self.contig_length)
+                    out.write('NC_{:06d}\tRefSeq\tgene\t{}\t{}\t.\t+\t.\t'
+                              'ID=gene{}_{};Name=G{}_{}\n'.format(
+                                  i + 1, start, end, i, j, i, j))
+
+    def _write_panel(self, rng, regions=10, size=200):
+        with open(self.panel, 'wt') as out:
+            for name in self.contig_names:
+                for start in sorted(
+                        rng.randrange(self.contig_length - size)
+                        for i in range(regions)):
+                    out.write('{}\t{}\t{}\n'.format(name, start, start + size))
+
+    def _write_counts(self, rng):
+        """Write a featureCounts table of multi-exon genes, plus one gene
+        with exons on two contigs.
+        """
+        with open(self.counts, 'wt') as out:
+            out.write('# Program:featureCounts v1.5.1; Command:"featureCounts" '
+                      '"-a" "features.gtf" "-o" "counts.txt" "aligned.bam"\n')
+            out.write('Geneid\tChr\tStart\tEnd\tStrand\tLength\t'
+                      'aligned.bam\n')
+            rows = []
+            for name in self.contig_names:
+                for start in sorted(
+                        rng.randrange(1, self.contig_length - 20000)
+                        for j in range(self.contig_length // 5000)):
+                    exons = []
+                    for k in range(rng.randint(1, 3)):
+                        end = start + rng.randrange(100, 3000)
+                        exons.append((name, start, end))
+                        start = end + rng.randrange(100, 3000)
+                    rows.append(exons)
+            if len(self.contig_names) > 1:
+                rows.append([
+                    (name, 1, 1000) for name in self.contig_names[-2:]])
+            for i, exons in enumerate(rows):
+                names, starts, ends = zip(*exons)
+                out.write('gene{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format(
+                    i, ';'.join(names), ';'.join(map(str, starts)),
+                    ';'.join(map(str, ends)), ';'.join('+' * len(exons)),
+                    sum(end - start + 1 for name, start, end in exons),
+                    rng.randrange(1000)))
+
+def bam_record(
+        name, seq, flag, refid=-1, pos=-1, mate_pos=-1, tlen=0, mapq=60):
+    """Encode a BAM alignment record (with a block size prefix). Mapped reads
+    get a single M cigar operation covering the read; both mates are on
+    ``refid``.
+    """
+    l_seq = len(seq)
+    codes = seq.translate(BAM_CODES)
+    if l_seq % 2:
+        codes += b'\0'
+    packed = bytes(
+        (hi << 4) | lo for hi, lo in zip(codes[0::2], codes[1::2]))
+    qual = bytes([40]) * l_seq
+    if refid < 0:
+        cigar = b''
+        bin_ = 4680
+        mapq = 0
+    else:
+        cigar = (l_seq << 4).to_bytes(4, 'little')
+        bin_ = reg2bin(pos, pos + l_seq)
+    data = b''.join((
+        BAM_CORE.pack(
+            refid, pos, len(name) + 1, mapq, bin_, len(cigar) // 4, flag,
+            l_seq, refid, mate_pos, tlen),
+        name, b'\0', cigar, packed, qual))
+    return len(data).to_bytes(4, 'little') + data
+
+def write_bam(path, text, refs, records, index=False):
+    """Write a BAM file from its header text, (name, length) references and
+    encoded records, and a BAI index (``path + '.bai'``) if ``index`` is set
+    (the records must then be sorted by coordinate).
+    """
+    indexer = BaiIndexer(len(refs)) if index else None
+    with BgzfWriter(path) as out:
+        text = text.encode()
+        out.write(BAM_MAGIC + len(text).to_bytes(4, 'little') + text +
+                  len(refs).to_bytes(4, 'little'))
+        for name, length in refs:
+            name = name.encode() + b'\0'
+            out.write(len(name).to_bytes(4, 'little', signed=True) + name +
+                      length.to_bytes(4, 'little'))
+        out.flush()
+        for record in records:
+            start = out.tell()
+            out.write(record)
+            if indexer is not None:
+                refid, beg, end, unmapped = record_extent(record)
+                indexer.add(refid, beg, end, unmapped, start, out.tell())
+    if indexer is not None:
+        indexer.write(path + '.bai')
+
+def read_bam(stream):
+    """Parse the header of a BAM file and iterate over the reference IDs of
+    its records.
+
+    Returns:
+        A tuple (header_text, [(name, length), ...], iterator of refids)
+    """
+    def read(size):
+        data = stream.read(size)
+        if len(data) < size:
+            raise ValueError("Truncated BAM file")
+        return data
+    if read(4) != BAM_MAGIC:
+        raise ValueError("Not a BAM file")
+    text = read(int.from_bytes(read(4), 'little')).decode()
+    refs = []
+    for i in range(int.from_bytes(read(4), 'little')):
+        name = read(int.from_bytes(read(4), 'little'))[:-1].decode()
+        refs.append((name, int.from_bytes(read(4), 'little')))
+    def refids():
+        while True:
+            size = stream.read(4)
+            if not size:
+                return
+            record = read(int.from_bytes(size, 'little'))
+            yield int.from_bytes(record[:4], 'little', signed=True)
+    return text, refs, refids()
+
+# Stub tools
+
+def _option(argv, name, count=1):
+    i = argv.index(name)
+    values = argv[i + 1:i + 1 + count]
+    return values[0] if count == 1 else values
+
+def _consume(paths, forward=None):
+    """Read files concurrently (as an aligner reads both mates), optionally
+    copying the first one to a binary stream.
+
+    Returns:
+        The total number of bytes read
+    """
+    counts = [0] * len(paths)
+    def read(i, path):
+        with open(path, 'rb') as inp:
+            while True:
+                data = inp.read(1024 * 1024)
+                if not data:
+                    break
+                counts[i] += len(data)
+                if i == 0 and forward is not None:
+                    forward.write(data)
+    threads = [
+        Thread(target=read, args=(i, path)) for i, path in enumerate(paths)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if forward is not None:
+        forward.flush()
+    return sum(counts)
+
+def _write_quant(outdir, name, nbytes):
+    os.makedirs(outdir, exist_ok=True)
+    with open(os.path.join(outdir, name), 'wt') as out:
+        out.write('target_id\tlength\test_counts\nstub\t1000\t{}\n'.format(
+            nbytes))
+
+def _write_sam(paths, out, refs=None):
+    """Write paired FASTQ records as SAM records. Without ``refs``, the reads
+    are unmapped, as an aligner that finds no alignments would write them;
+    otherwise each pair is placed on one of the (name, length) ``refs`` at a
+    position derived from a hash of its name.
+    """
+    out.write(b'@HD\tVN:1.0\tSO:unsorted\n')
+    for name, length in refs or ():
+        out.write('@SQ\tSN:{}\tLN:{}\n'.format(name, length).encode())
+    with open(paths[0], 'rb') as inp1, open(paths[1], 'rb') as inp2:
+        for flag, lines in zip(cycle((b'77', b'141')), _mates(inp1, inp2)):
+            name, seq, _, qual = lines
+            name = name[1:].split()[0]
+            if name[-2:] in (b'/1', b'/2'):
+                name = name[:-2]
+            seq = seq.rstrip()
+            fields = [b'*', b'0', b'0', b'*', b'*', b'0', b'0']
+            if refs:
+                ref, length = refs[zlib.crc32(name) % len(refs)]
+                pos = zlib.crc32(name[::-1]) % max(
+                    1, length - INSERT_SIZE - len(seq)) + 1
+                mate = pos + INSERT_SIZE
+                if flag == b'77':
+                    flag = b'99'
+                else:
+                    flag = b'147'
+                    pos, mate = mate, pos
+                fields = [
+                    ref.encode(), str(pos).encode(), b'60',
+                    str(len(seq)).encode() + b'M', b'=', str(mate).encode(),
+                    str(mate - pos).encode()]
+            out.write(b'\t'.join(
+                [name, flag] + fields + [seq, qual.rstrip()]) + b'\n')
+    out.flush()
+
+def _index_refs(index):
+    """The (name, length) of the contigs of a fixture index, if it has any.
+    """
+    path = os.path.join(index, 'chrNameLength.txt')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rt') as inp:
+        return [
+            (name, int(length))
+            for name, length in (line.split() for line in inp)]
+
+def _mates(inp1, inp2):
+    while True:
+        record1 = [inp1.readline() for _ in range(4)]
+        record2 = [inp2.readline() for _ in range(4)]
+        if not record1[0]:
+            return
+        yield record1
+        yield record2
+
+def _stub_star(argv):
+    if '--genomeLoad' in argv and _option(argv, '--genomeLoad') in (
+            'LoadAndExit', 'Remove'):
+        return
+    paths = _option(argv, '--readFilesIn', 2)
+    if '--outStd' in argv and _option(argv, '--outStd') == 'SAM':
+        _write_sam(
+            paths, sys.stdout.buffer, _index_refs(_option(argv, '--genomeDir')))
+    else:
+        _consume(paths, sys.stdout.buffer)
+
+def _stub_hisat2(argv):
+    _write_sam(
+        [_option(argv, '-1'), _option(argv, '-2')], sys.stdout.buffer,
+        _index_refs(_option(argv, '-x')))
+
+def _stub_sambamba(argv):
+    shutil.copyfileobj(sys.stdin.buffer, sys.stdout.buffer)
+
+def _stub_kallisto(argv):
+    _write_quant(
+        _option(argv, '-o'), 'abundance.tsv', _consume(argv[-2:]))
+
+def _stub_salmon(argv):
+    _write_quant(_option(argv, '-o'), 'quant.sf', _consume(
+        [_option(argv, '-1'), _option(argv, '-2')]))
+
+def _vcf_header(refs):
+    return (
+        '##fileformat=VCFv4.2\n' + ''.join(
+            '##contig=<ID={},length={}>\n'.format(name, length)
+            for name, length in refs) +
+        '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tsample\n')
+
+REF_BLOCK = '{}\t{}\t.\tN\t<NON_REF>\t.\t.\tEND={}\tGT\t0/0\n'
+
+def _vcf_records(intervals, info='DP=10', block=False):
+    """Records at every STUB_VARIANT_STEP'th position within each 0-based
+    interval; with ``block``, the gaps are covered by gVCF reference blocks.
+    """
+    lines = []
+    for contig, start, end in intervals:
+        first = (start // STUB_VARIANT_STEP + 1) * STUB_VARIANT_STEP
+        pos = start + 1
+        for site in range(first, end + 1, STUB_VARIANT_STEP):
+            if block and site > pos:
+                lines.append(REF_BLOCK.format(contig, pos, site - 1))
+            lines.append('{}\t{}\t.\tA\tG\t50\t.\t{}\tGT\t0/1\n'.format(
+                contig, site, info))
+            pos = site + 1
+        if block and pos <= end:
+            lines.append(REF_BLOCK.format(contig, pos, end))
+    return lines
+
+def _stub_samtools(argv):
+    command = argv[0]
+    if command == 'view' and '-H' in argv:
+        with gzip.open(argv[-1], 'rb') as inp:
+            sys.stdout.write(read_bam(inp)[0])
+    elif command == 'view':
+        # Uncompressed BAM is still BGZF; the stub just passes it through
+        with open(argv[-1], 'rb') as inp:
+            shutil.copyfileobj(inp, sys.stdout.buffer)
+    elif command == 'idxstats':
+        with gzip.open(argv[-1], 'rb') as inp:
+            text, refs, refids = read_bam(inp)
+            counts = [0] * len(refs)
+            unmapped = 0
+            for refid in refids:
+                if refid < 0:
+                    unmapped += 1
+                else:
+                    counts[refid] += 1
+        for (name, length), count in zip(refs, counts):
+            sys.stdout.write('{}\t{}\t{}\t0\n'.format(name, length, count))
+        sys.stdout.write('*\t0\t0\t{}\n'.format(unmapped))
+    elif command == 'mpileup':
+        bam = argv[-1]
+        inp = gzip.open(sys.stdin.buffer if bam == '-' else bam, 'rb')
+        with inp:
+            text, refs, refids = read_bam(inp)
+            covered = set(refids)
+        if '-l' in argv:
+            intervals = []
+            with open(_option(argv, '-l'), 'rt') as bed:
+                for line in bed:
+                    contig, start, end = line.split('\t')[:3]
+                    intervals.append((contig, int(start), int(end)))
+        else:
+            intervals = [
+                (name, 0, length) for refid, (name, length) in enumerate(refs)
+                if refid in covered]
+        out = open(_option(argv, '-o'), 'wt') if '-o' in argv else sys.stdout
+        with out:
+            out.write(_vcf_header(refs))
+            out.writelines(_vcf_records(intervals, 'DP=10;AD=5,5'))
+    else:
+        raise ValueError("Unsupported samtools command {}".format(command))
+
+def _stub_java(argv):
+    tool = _option(argv, '-T')
+    output = _option(argv, '-o')
+    if tool == 'HaplotypeCaller':
+        refs = []
+        intervals = []
+        with open(_option(argv, '-L'), 'rt') as inp:
+            for line in inp:
+                if line.startswith('@SQ'):
+                    tags = dict(f.split(':', 1) for f in line.split('\t')[1:])
+                    refs.append((tags['SN'], int(tags['LN'])))
+                elif not line.startswith('@'):
+                    contig, start, end = line.split('\t')[:3]
+                    intervals.append((contig, int(start) - 1, int(end)))
+        with open(output, 'wt') as out:
+            out.write(_vcf_header(refs))
+            out.writelines(_vcf_records(intervals, block=True))
+    elif tool == 'GenotypeGVCFs':
+        with gzip.open(_option(argv, '-V'), 'rt') as inp, \
+                open(output, 'wt') as out:
+            for line in inp:
+                if line.startswith('#') or '<NON_REF>\t.\t.\tEND=' not in line:
+                    out.write(line)
+    elif tool == 'CombineGVCFs':
+        paths = [
+            argv[i + 1] for i, arg in enumerate(argv) if arg == '--variant']
+        with gzip.open(output, 'wt') as out:
+            for i, path in enumerate(paths):
+                with open(path, 'rt') as inp:
+                    for line in inp:
+                        if i == 0 or not line.startswith('#'):
+                            out.write(line)
+    else:
+        raise ValueError("Unsupported GATK tool {}".format(tool))
+
+stubs = dict(
+    STAR=_stub_star,
+    hisat2=_stub_hisat2,
+    sambamba=_stub_sambamba,
+    kallisto=_stub_kallisto,
+    salmon=_stub_salmon,
+    samtools=_stub_samtools,
+    java=_stub_java)
+
+def install_stubs(bindir):
+    """Create an executable for each stub tool in ``bindir``.
+    """
+    os.makedirs(bindir, exist_ok=True)
+    for tool in stubs:
+        path = os.path.join(bindir, tool)
+        with open(path, 'wt') as out:
+            out.write('#!/bin/sh\nexec "{}" -m evac.bench stub {} "$@"\n'
+                      .format(sys.executable, tool))
+        os.chmod(path, 0o755)
+
+# Benchmarks
+
+class Benchmark(object):
+    """A single end-to-end run of a pipeline, caller or script.
+
+    Args:
+        name: Name of the benchmark
+        kind: 'pipeline', 'caller' or 'script'
+        cmd: The command, as a list
+    """
+    def __init__(self, name, kind, cmd):
+        self.name = name
+        self.kind = kind
+        self.cmd = cmd
+
+    def run(self, env, workdir):
+        """Run the command once.
+
+        Returns:
+            A dict of metrics
+        """
+        metrics_file = os.path.join(workdir, 'stage_metrics.jsonl')
+        if os.path.exists(metrics_file):
+            os.remove(metrics_file)
+        env = dict(env)
+        env[METRICS_ENV] = metrics_file
+        log_file = os.path.join(workdir, '{}.log'.format(
+            self.name.replace('/', '_')))
+        start = time.time()
+        with open(log_file, 'wb') as log:
+            proc = Popen(
+                self.cmd, stdin=DEVNULL, stdout=DEVNULL, stderr=log,
+                cwd=workdir, env=env)
+            pid, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = (
+                -os.WTERMSIG(status) if os.WIFSIGNALED(status)
+                else os.WEXITSTATUS(status))
+        result = dict(
+            returncode=proc.returncode, wall_time=time.time() - start,
+            cpu_time=usage.ru_utime + usage.ru_stime,
+            user_time=usage.ru_utime, system_time=usage.ru_stime,
+            max_rss_kb=usage.ru_maxrss, stages=[], edges=[])
+        if os.path.exists(metrics_file):
+            with open(metrics_file, 'rt') as inp:
+                for line in inp:
+                    executor = json.loads(line)
+                    result['stages'].extend(executor['stages'])
+                    result['edges'].extend(executor['edges'])
+        if proc.returncode != 0:
+            with open(log_file, 'rt', errors='replace') as inp:
+                result['error'] = inp.read()[-2000:]
+        return result
+
+def script_path(name):
+    """Find one of the evac scripts: next to the package in a source
+    checkout, or on the PATH once installed.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(evac.__file__)))
+    for path in (os.path.join(root, 'scripts', name),
+                 os.path.join(root, name)):
+        if os.path.exists(path):
+            return path
+    return shutil.which(name)
+
+def pipeline_args(name, fixtures, output, threads):
+    """Command-line arguments for align.py to run the named pipeline on the
+    fixtures, or None if there is no benchmark for it.
+    """
+    common = [
+        '-p', name, '-i', fixtures.fastq1, fixtures.fastq2,
+        '-t', str(threads), '-r', fixtures.index, '--noprogress']
+    if name in ('hisat', 'star'):
+        return common + ['-o', output + '.bam']
+    if name in ('kallisto', 'salmon'):
+        return common + ['-o', output]
+    if name == 'fastq':
+        return common + ['-o', output]
+    if name == 'head':
+        return common + ['-M', '10']
+    return None
+
+def caller_args(name, fixtures, output, threads):
+    """Command-line arguments for call_variants.py to run the named caller on
+    the fixtures, or None if there is no benchmark for it.
+    """
+    common = [
+        '-c', name, '-b', fixtures.aligned_bam, '-r', fixtures.reference,
+        '-t', str(threads)]
+    if name == 'mpileup':
+        return common + ['-o', output + '.vcf']
+    if name == 'gatk':
+        os.makedirs(output, exist_ok=True)
+        return common + [
+            '-o', output, '--java', 'java', '--gatk', 'GenomeAnalysisTK.jar',
+            '--dbsnp', fixtures.known_sites]
+    if name == 'known':
+        return common + [
+            '-o', output + '.vcf', '--sites', fixtures.known_sites]
+    return None
+
+def benchmarks(fixtures, workdir, threads):
+    """Create a Benchmark for every pipeline (with each transport, for
+    pipelines that use one) and every caller.
+
+    Returns:
+        A tuple (benchmarks, skipped), where skipped is a list of names that
+        have no benchmark configuration
+    """
+    from evac.pipeline import SraPipeline, pipelines
+    from evac.transport import transports
+    from evac.varcallers import callers
+    result = []
+    skipped = []
+    align = script_path('align.py')
+    for name in sorted(pipelines):
+        output = os.path.join(workdir, 'out', name)
+        args = pipeline_args(name, fixtures, output, threads)
+        if args is None or align is None:
+            skipped.append(name)
+            continue
+        pipeline = pipelines[name]
+        if isclass(pipeline) and issubclass(pipeline, SraPipeline):
+            for transport in sorted(transports):
+                result.append(Benchmark(
+                    '{}/{}'.format(name, transport), 'pipeline',
+                    [sys.executable, align] + args +
+                    ['--transport', transport, '--buffer-mb', '16']))
+        else:
+            result.append(Benchmark(
+                name, 'pipeline', [sys.executable, align] + args))
+    result.append(Benchmark(
+        'fastq/bam', 'pipeline', [
+            sys.executable, align, '-p', 'fastq', '-i', fixtures.unaligned_bam,
+            '--noprogress', '-o', os.path.join(workdir, 'out', 'fastq_bam')]))
+    result.append(Benchmark(
+        'fastq/filter', 'pipeline', [
+            sys.executable, align, '-p', 'fastq',
+            '-i', fixtures.fastq1, fixtures.fastq2, '--noprogress',
+            '--downsample', '0.5', '--min-quality', '20', '--max-n', '0.1',
+            '--screen', fixtures.contaminants,
+            '--filter-workers', str(threads),
+            '-o', os.path.join(workdir, 'out', 'fastq_filter')]))
+    # The first run fetches every chunk, and later runs read the cache
+    shutil.rmtree(os.path.join(workdir, 'sra_cache'), ignore_errors=True)
+    result.append(Benchmark(
+        'fastq/prefetch', 'pipeline', [
+            sys.executable, align, '-p', 'fastq', '-a', fixtures.accession,
+            '--sra-archive', fixtures.archive, '--prefetch', str(threads),
+            '--chunk-reads', str(max(1000, fixtures.reads // 20)),
+            '--sra-cache', os.path.join(workdir, 'sra_cache'),
+            '--noprogress', '-o', os.path.join(workdir, 'out', 'fastq_prefetch')]))
+    result.append(Benchmark(
+        'star/dedup', 'pipeline', [sys.executable, align] + pipeline_args(
+            'star', fixtures, os.path.join(workdir, 'out', 'star_dedup'),
+            threads) + ['--dedup']))
+    # STAR and Salmon on one stream of reads
+    for transport in sorted(transports):
+        output = os.path.join(workdir, 'out', 'star_salmon_' + transport)
+        result.append(Benchmark(
+            'star+salmon/{}'.format(transport), 'pipeline', [
+                sys.executable, align, '-p', 'star,salmon',
+                '-i', fixtures.fastq1, fixtures.fastq2, '-t', str(threads),
+                '-r', fixtures.index, '--noprogress',
+                '-o', '{0}.bam,{0}'.format(output),
+                '--transport', transport, '--buffer-mb', '16']))
+    result.append(Benchmark(
+        'star/mpileup', 'pipeline', [
+            sys.executable, align, '-p', 'star',
+            '-i', fixtures.fastq1, fixtures.fastq2, '-t', str(threads),
+            '-r', fixtures.index, '--noprogress', '--caller', 'mpileup',
+            '--reference', fixtures.reference,
+            '--vcf', os.path.join(workdir, 'out', 'star_mpileup.vcf')]))
+    result.append(Benchmark(
+        'star/known', 'pipeline', [
+            sys.executable, align, '-p', 'star',
+            '-i', fixtures.fastq1, fixtures.fastq2, '-t', str(threads),
+            '-r', fixtures.index, '--noprogress', '--caller', 'known',
+            '--reference', fixtures.reference, '--sites', fixtures.known_sites,
+            '--vcf', os.path.join(workdir, 'out', 'star_known.vcf')]))
+    call = script_path('call_variants.py')
+    for name in sorted(callers):
+        output = os.path.join(workdir, 'out', name)
+        args = caller_args(name, fixtures, output, threads)
+        if args is None or call is None:
+            skipped.append(name)
+            continue
+        result.append(Benchmark(
+            name, 'caller', [sys.executable, call] + args))
+    if call is not None:
+        result.append(Benchmark(
+            'mpileup/panel', 'caller', [sys.executable, call] + caller_args(
+                'mpileup', fixtures, os.path.join(workdir, 'out', 'panel'),
+                threads) + ['-L', fixtures.panel]))
+        result.append(Benchmark(
+            'known/panel', 'caller', [sys.executable, call] + caller_args(
+                'known', fixtures, os.path.join(workdir, 'out', 'known_panel'),
+                threads) + ['--sites', fixtures.panel]))
+    annotator = script_path(os.path.join(
+        'VCF Annotator', 'VarRefSeqAnnotation.py'))
+    if annotator:
+        result.append(Benchmark(
+            'annotate', 'script', [
+                sys.executable, annotator, '-feature', 'gene',
+                '-gff', fixtures.gff, '-vcf', fixtures.known_sites,
+                '-asm', fixtures.assembly,
+                '-np', str(threads),
+                '-cache', os.path.join(workdir, 'cache')]))
+    result.append(Benchmark(
+        'intersect', 'script', [
+            sys.executable, '-m', 'evac.intersect', fixtures.known_sites,
+            fixtures.counts, '-o', os.path.join(workdir, 'out', 'intersect.txt')]))
+    os.makedirs(os.path.join(workdir, 'out'), exist_ok=True)
+    return result, skipped
+
+def git_commit():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(evac.__file__)))
+    try:
+        return check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=root, stderr=DEVNULL,
+            universal_newlines=True).strip()
+    except Exception:
+        return None
+
+def run_benchmarks(args, workdir):
+    fixtures = Fixtures(
+        os.path.join(workdir, 'fixtures'), args.reads, args.read_length,
+        args.contigs, args.contig_length, args.seed)
+    os.makedirs(fixtures.workdir, exist_ok=True)
+    start = time.time()
+    fixtures.create()
+    fixture_time = time.time() - start
+    bindir = os.path.join(workdir, 'bin')
+    install_stubs(bindir)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(evac.__file__)))
+    env = dict(os.environ)
+    env['PATH'] = os.pathsep.join((bindir, env.get('PATH', '')))
+    env['PYTHONPATH'] = os.pathsep.join(
+        p for p in (root, env.get('PYTHONPATH')) if p)
+    todo, skipped = benchmarks(fixtures, workdir, args.threads)
+    if args.only:
+        todo = [b for b in todo if b.name.split('/')[0] in args.only]
+    results = []
+    for benchmark in todo:
+        runs = [benchmark.run(env, workdir) for i in range(args.repeats)]
+        walls = [run['wall_time'] for run in runs]
+        best = min(runs, key=lambda run: run['wall_time'])
+        result = dict(
+            name=benchmark.name, kind=benchmark.kind, cmd=benchmark.cmd,
+            ok=all(run['returncode'] == 0 for run in runs),
+            best_wall_time=best['wall_time'],
+            mean_wall_time=sum(walls) / len(walls), runs=runs)
+        results.append(result)
+        sys.stderr.write('{:<20}{:>10.3f}s{}\n'.format(
+            benchmark.name, best['wall_time'],
+            '' if result['ok'] else '  FAILED'))
+    return dict(
+        commit=git_commit(), python=platform.python_version(),
+        platform=platform.platform(), timestamp=time.time(),
+        fixtures=fixtures.as_dict(), fixture_time=fixture_time,
+        threads=args.threads, repeats=args.repeats, skipped=skipped,
+        results=results)
+
+def compare(results, baseline):
+    """Format a table comparing the best wall times of two sets of results.
+    """
+    before = dict((r['name'], r) for r in baseline['results'])
+    lines = ['{:<20}{:>12}{:>12}{:>9}'.format(
+        'benchmark', 'baseline', 'current', 'ratio')]
+    for result in results['results']:
+        old = before.get(result['name'])
+        if old is None or not old['ok'] or not result['ok']:
+            continue
+        lines.append('{:<20}{:>11.3f}s{:>11.3f}s{:>9.2f}'.format(
+            result['name'], old['best_wall_time'], result['best_wall_time'],
+            result['best_wall_time'] / (old['best_wall_time'] or 1e-9)))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['stub']:
+        stubs[argv[1]](argv[2:])
+        return 0
+    parser = ArgumentParser(
+        prog='python -m evac.bench',
+        description="Benchmark the pipelines and callers on synthetic data "
+                    "with stub tools.")
+    parser.add_argument(
+        '-o', '--output', default='-', metavar="FILE",
+        help="JSON results file (defaults to stdout)")
+    parser.add_argument(
+        '-n', '--reads', type=int, default=100000, metavar="N",
+        help="Number of read pairs")
+    parser.add_argument(
+        '--read-length', type=int, default=100, metavar="N")
+    parser.add_argument(
+        '--contigs', type=int, default=4, metavar="N")
+    parser.add_argument(
+        '--contig-length', type=int, default=1000000, metavar="N")
+    parser.add_argument(
+        '-t', '--threads', type=int, default=4, metavar="N")
+    parser.add_argument(
+        '--repeats', type=int, default=3, metavar="N",
+        help="Number of times to run each benchmark; the best time is "
+             "reported")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument(
+        '--only', nargs='+', default=None, metavar="NAME",
+        help="Only run these pipelines/callers")
+    parser.add_argument(
+        '--workdir', default=None, metavar="DIR",
+        help="Directory for fixtures and outputs, which is kept (defaults "
+             "to a temporary directory that is removed)")
+    parser.add_argument(
+        '--compare', default=None, metavar="FILE",
+        help="Results of an earlier run to compare with")
+    args = parser.parse_args(argv)
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        results = run_benchmarks(args, os.path.abspath(args.workdir))
+    else:
+        workdir = tempfile.mkdtemp(prefix='evac-bench.')
+        try:
+            results = run_benchmarks(args, workdir)
+        finally:
+            shutil.rmtree(workdir)
+    text = json.dumps(results, indent=2)
+    if args.output == '-':
+        sys.stdout.write(text + '\n')
+    else:
+        with open(args.output, 'wt') as out:
+            out.write(text + '\n')
+    if args.compare:
+        with open(args.compare, 'rt') as inp:
+            sys.stderr.write(compare(results, json.load(inp)) + '\n')
+    return 0 if all(r['ok'] for r in results['results']) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,503 @@
+# -*- coding: utf-8 -*-
+"""Reading and writing BGZF (bgzip) files and their indexes (BAI, CSI and
+tabix) without htslib.
+
+A BGZF file is a series of gzip members of at most 64 KB each, which makes it
+possible to seek to any record given a "virtual offset": the compressed offset
+of the block that contains the record, shifted left by 16 bits, plus the
+record's offset within the uncompressed block.
+"""
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import struct
+import zlib
+
+# Maximum uncompressed size of a block (as in htslib)
+BLOCK_SIZE = 0xff00
+
+BGZF_HEADER = struct.Struct('<4BI2BH2BHH')
+BGZF_EOF = bytes.fromhex(
+    '1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+# Binning scheme shared by BAI and tabix indexes
+MIN_SHIFT = 14
+DEPTH = 5
+
+def compress_block(data, level=6):
+    """Compress up to BLOCK_SIZE bytes into a single BGZF block.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    block_size = BGZF_HEADER.size + len(deflated) + 8
+    header = BGZF_HEADER.pack(
+        0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2,
+        block_size - 1)
+    return b''.join((
+        header, deflated,
+        struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))))
+
+def read_block(inp):
+    """Read one BGZF block, still compressed.
+
+    Returns:
+        The block, or an empty bytes object at the end of the file
+    """
+    header = inp.read(BGZF_HEADER.size)
+    if not header:
+        return b''
+    if len(header) < BGZF_HEADER.size or header[:4] != b'\x1f\x8b\x08\x04':
+        raise ValueError("Not a BGZF block")
+    block_size = BGZF_HEADER.unpack(header)[-1] + 1
+    rest = inp.read(block_size - BGZF_HEADER.size)
+    if len(rest) != block_size - BGZF_HEADER.size:
+        raise ValueError("Truncated BGZF block")
+    return header + rest
+
+def decompress_block(block):
+    """Returns the uncompressed contents of a block read by
+    :func:`read_block`.
+    """
+    return zlib.decompress(block[BGZF_HEADER.size:-8], -15)
+
+class BgzfWriter(object):
+    """Writes BGZF to a binary file object, keeping track of virtual offsets.
+
+    Args:
+        out: Binary file object, or a path
+        level: Compression level
+    """
+    def __init__(self, out, level=6):
+        if isinstance(out, str):
+            out = open(out, 'wb')
+        self.out = out
+        self.level = level
+        self.buffer = bytearray()
+        self.block_offset = 0
+
+    def tell(self):
+        """Returns the virtual offset of the next byte to be written.
+        """
+        return (self.block_offset << 16) | len(self.buffer)
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= BLOCK_SIZE:
+            self._write_block(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+        return len(data)
+
+    def flush(self):
+        """Compress whatever is buffered into a block, so that the next write
+        starts a new block.
+        """
+        if self.buffer:
+            self._write_block(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.out.flush()
+
+    def _write_block(self, data):
+        block = compress_block(data, self.level)
+        self.out.write(block)
+        self.block_offset += len(block)
+
+    def write_compressed(self, block):
+        """Write a block that is already compressed (e.g. copied from another
+        BGZF file), after whatever is buffered.
+        """
+        if self.buffer:
+            self._write_block(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.out.write(block)
+        self.block_offset += len(block)
+
+    def close(self):
+        self.flush()
+        self.out.write(BGZF_EOF)
+        self.out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class ParallelBgzfWriter(BgzfWriter):
+    """BgzfWriter that compresses blocks in a pool of threads (zlib releases
+    the GIL) and writes them in order.
+
+    The compressed offset of a block is only known once the blocks before it
+    have been compressed, so :meth:`tell` returns a *provisional* virtual
+    offset: the index of the block rather than its offset, shifted left by 16
+    bits, plus the offset within the block. Provisional offsets are ordered like
+    the real ones; :meth:`virtual_offset` converts them once the writer is
+    closed.
+
+    Args:
+        out: Binary file object, or a path
+        threads: Number of compression threads
+        level: Compression level
+    """
+    def __init__(self, out, threads=4, level=6):
+        super(ParallelBgzfWriter, self).__init__(out, level)
+        self.pool = ThreadPoolExecutor(max(1, threads))
+        self.pending = deque()
+        self.max_pending = 4 * max(1, threads)
+        self.blocks = 0
+        # Compressed offset of each block written
+        self.block_offsets = []
+
+    def tell(self):
+        return (self.blocks << 16) | len(self.buffer)
+
+    def virtual_offset(self, provisional):
+        """Convert a provisional virtual offset returned by :meth:`tell` into
+        the real virtual offset.
+        """
+        block = provisional >> 16
+        if block == len(self.block_offsets):
+            # The end of the file
+            return self.block_offset << 16
+        return (self.block_offsets[block] << 16) | (provisional & 0xffff)
+
+    def _write_block(self, data):
+        self.pending.append(
+            self.pool.submit(compress_block, data, self.level))
+        self.blocks += 1
+        while len(self.pending) > self.max_pending:
+            self._write_compressed()
+
+    def _write_compressed(self):
+        block = self.pending.popleft().result()
+        self.block_offsets.append(self.block_offset)
+        self.out.write(block)
+        self.block_offset += len(block)
+
+    def flush(self):
+        if self.buffer:
+            self._write_block(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self._write_compressed()
+        self.out.flush()
+
+    def close(self):
+        super(ParallelBgzfWriter, self).close()
+        self.pool.shutdown()
+
+def reg2bin(beg, end, min_shift=MIN_SHIFT, depth=DEPTH):
+    """Returns the smallest bin that contains the 0-based, half-open interval
+    [beg, end).
+    """
+    end -= 1
+    shift = min_shift
+    level = depth
+    offset = ((1 << (3 * depth)) - 1) // 7
+    while level > 0:
+        if beg >> shift == end >> shift:
+            return offset + (beg >> shift)
+        level -= 1
+        shift += 3
+        offset -= 1 << (3 * level)
+    return 0
+
+def reg2bins(beg, end, min_shift=MIN_SHIFT, depth=DEPTH):
+    """Returns all the bins that may hold records overlapping the 0-based,
+    half-open interval [beg, end), from the root down.
+    """
+    end -= 1
+    bins = []
+    offset = 0
+    shift = min_shift + 3 * depth
+    for level in range(depth + 1):
+        bins.extend(range(
+            offset + (beg >> shift), offset + (end >> shift) + 1))
+        offset += 1 << (3 * level)
+        shift -= 3
+    return bins
+
+def bin_parent(bin_):
+    return (bin_ - 1) >> 3
+
+class ReferenceIndex(object):
+    """The part of a BAI or CSI index that covers one reference sequence.
+
+    Args:
+        bins: Dict {bin: list of (vstart, vend) chunks}
+        linear: The linear index (BAI), or None
+        loffsets: Dict {bin: virtual offset of its first record} (CSI), or None
+        min_shift, depth: The binning scheme
+    """
+    def __init__(
+            self, bins, linear=None, loffsets=None, min_shift=MIN_SHIFT,
+            depth=DEPTH):
+        self.bins = bins
+        self.linear = linear
+        self.loffsets = loffsets
+        self.min_shift = min_shift
+        self.depth = depth
+        self.first_leaf = ((1 << (3 * depth)) - 1) // 7
+        self.leaves = sorted(b for b in bins if b >= self.first_leaf)
+
+    def min_offset(self, beg):
+        """Returns the virtual offset before which no record can overlap
+        position ``beg``, as htslib computes it.
+        """
+        if self.linear:
+            window = beg >> self.min_shift
+            return self.linear[min(window, len(self.linear) - 1)]
+        if self.loffsets:
+            bin_ = self.first_leaf + (beg >> self.min_shift)
+            while bin_ > 0 and bin_ not in self.loffsets:
+                bin_ = bin_parent(bin_)
+            return self.loffsets.get(bin_, 0)
+        return 0
+
+    def max_offset(self, end):
+        """Returns the virtual offset from which no record can overlap
+        positions before ``end``, or None: the first record of the first leaf
+        bin that starts at or after ``end``. Records are sorted by position,
+        so all the records after it start after ``end`` too.
+        """
+        first = self.first_leaf + ((end - 1) >> self.min_shift) + 1
+        i = bisect_left(self.leaves, first)
+        if i == len(self.leaves):
+            return None
+        return min(vstart for vstart, vend in self.bins[self.leaves[i]])
+
+    def chunks(self, beg, end):
+        """Returns the chunks (vstart, vend) that may hold records overlapping
+        [beg, end), sorted and merged.
+        """
+        min_offset = self.min_offset(beg)
+        max_offset = self.max_offset(end)
+        found = []
+        for bin_ in reg2bins(beg, end, self.min_shift, self.depth):
+            for vstart, vend in self.bins.get(bin_, ()):
+                if max_offset is not None:
+                    if vstart >= max_offset:
+                        continue
+                    vend = min(vend, max_offset)
+                if vend > min_offset:
+                    found.append((max(vstart, min_offset), vend))
+        return merge_chunks(found)
+
+def merge_chunks(chunks, gap=0):
+    """Sort chunks (vstart, vend) and merge those that overlap, or that are
+    less than ``gap`` compressed bytes apart (reading through a short gap is
+    cheaper than a seek).
+    """
+    merged = []
+    for vstart, vend in sorted(chunks):
+        if merged and (
+                vstart <= merged[-1][1] or
+                (vstart >> 16) - (merged[-1][1] >> 16) < gap):
+            if vend > merged[-1][1]:
+                merged[-1] = (merged[-1][0], vend)
+        else:
+            merged.append((vstart, vend))
+    return merged
+
+def read_index(path):
+    """Read a BAI or CSI index.
+
+    Returns:
+        A list with the ReferenceIndex of each reference sequence
+    """
+    with open(path, 'rb') as inp:
+        data = inp.read()
+    if data[:2] == b'\x1f\x8b':
+        # CSI indexes are BGZF-compressed
+        data = gzip.decompress(data)
+    magic = data[:4]
+    if magic == b'BAI\1':
+        min_shift, depth = MIN_SHIFT, DEPTH
+        offset = 4
+    elif magic == b'CSI\1':
+        min_shift, depth, l_aux = struct.unpack_from('<3i', data, 4)
+        offset = 16 + l_aux
+    else:
+        raise ValueError("{} is not a BAI or CSI index".format(path))
+    # The bin that holds metadata rather than chunks
+    pseudo_bin = ((1 << (3 * (depth + 1))) - 1) // 7 + 1
+    n_refs = struct.unpack_from('<i', data, offset)[0]
+    offset += 4
+    indexes = []
+    for i in range(n_refs):
+        n_bins = struct.unpack_from('<i', data, offset)[0]
+        offset += 4
+        bins = {}
+        loffsets = {} if magic == b'CSI\1' else None
+        for j in range(n_bins):
+            if loffsets is None:
+                bin_, n_chunks = struct.unpack_from('<Ii', data, offset)
+                offset += 8
+            else:
+                bin_, loffset, n_chunks = struct.unpack_from(
+                    '<IQi', data, offset)
+                offset += 16
+            values = struct.unpack_from(
+                '<{}Q'.format(2 * n_chunks), data, offset)
+            offset += 16 * n_chunks
+            if bin_ == pseudo_bin:
+                continue
+            bins[bin_] = list(zip(values[::2], values[1::2]))
+            if loffsets is not None:
+                loffsets[bin_] = loffset
+        linear = None
+        if loffsets is None:
+            n_intervals = struct.unpack_from('<i', data, offset)[0]
+            offset += 4
+            linear = list(struct.unpack_from(
+                '<{}Q'.format(n_intervals), data, offset))
+            offset += 8 * n_intervals
+        indexes.append(ReferenceIndex(
+            bins, linear, loffsets, min_shift, depth))
+    return indexes
+
+class BinningIndex(object):
+    """Accumulates the binning and linear index of one reference sequence, as
+    used by both BAI and tabix indexes. Records must be added in coordinate
+    order.
+    """
+    def __init__(self):
+        self.bins = {}
+        self.linear = []
+
+    def add(self, beg, end, vstart, vend):
+        """Add a record covering [beg, end) that was written between virtual
+        offsets ``vstart`` and ``vend``.
+        """
+        end = max(end, beg + 1)
+        chunks = self.bins.setdefault(reg2bin(beg, end), [])
+        if chunks and chunks[-1][1] == vstart:
+            chunks[-1][1] = vend
+        else:
+            chunks.append([vstart, vend])
+        first = beg >> MIN_SHIFT
+        last = (end - 1) >> MIN_SHIFT
+        if len(self.linear) <= last:
+            self.linear.extend([None] * (last + 1 - len(self.linear)))
+        for window in range(first, last + 1):
+            if self.linear[window] is None:
+                self.linear[window] = vstart
+
+    def linear_offsets(self):
+        """Returns the linear index with empty windows filled in from the
+        following window (as htslib does).
+        """
+        offsets = list(self.linear)
+        following = None
+        for i in range(len(offsets) - 1, -1, -1):
+            if offsets[i] is None:
+                offsets[i] = following if following is not None else 0
+            following = offsets[i]
+        return offsets
+
+    def remap(self, func):
+        """Replace every virtual offset ``v`` in the index by ``func(v)``
+        (e.g. to convert the provisional offsets of a ParallelBgzfWriter).
+        """
+        for chunks in self.bins.values():
+            for chunk in chunks:
+                chunk[0] = func(chunk[0])
+                chunk[1] = func(chunk[1])
+        self.linear = [
+            None if offset is None else func(offset)
+            for offset in self.linear]
+
+    def pack(self, extra_bins=()):
+        """Pack the index, adding ``extra_bins``, a list of (bin, chunks)
+        tuples (e.g. the BAI pseudo-bin).
+        """
+        bins = sorted(self.bins.items()) + list(extra_bins)
+        parts = [struct.pack('<i', len(bins))]
+        for bin_, chunks in bins:
+            parts.append(struct.pack('<Ii', bin_, len(chunks)))
+            parts.extend(struct.pack('<QQ', *chunk) for chunk in chunks)
+        linear = self.linear_offsets()
+        parts.append(struct.pack('<i', len(linear)))
+        parts.append(struct.pack('<{}Q'.format(len(linear)), *linear))
+        return b''.join(parts)
+
+class TabixIndexer(object):
+    """Builds a tabix (.tbi) index for a VCF written with a BgzfWriter.
+    """
+    # Format, sequence/begin/end columns, comment character, lines to skip
+    VCF_CONF = (2, 1, 2, 0, ord('#'), 0)
+
+    def __init__(self, conf=VCF_CONF):
+        self.conf = conf
+        self.names = []
+        self.indexes = {}
+
+    def add(self, contig, beg, end, vstart, vend):
+        """Add a record on ``contig`` covering the 0-based, half-open interval
+        [beg, end).
+        """
+        if contig not in self.indexes:
+            self.names.append(contig)
+            self.indexes[contig] = BinningIndex()
+        self.indexes[contig].add(beg, end, vstart, vend)
+
+    def write(self, path):
+        names = b''.join(name + b'\0' for name in self.names)
+        parts = [
+            b'TBI\1',
+            struct.pack('<7i', len(self.names), *self.conf),
+            struct.pack('<i', len(names)),
+            names]
+        parts.extend(self.indexes[name].pack() for name in self.names)
+        with BgzfWriter(path) as out:
+            out.write(b''.join(parts))
+
+class BaiIndexer(object):
+    """Builds a BAI index for a coordinate-sorted BAM written with a
+    BgzfWriter.
+
+    Args:
+        n_refs: Number of reference sequences in the BAM header
+    """
+    # Bin that holds the offsets and counts of the reads on a reference
+    PSEUDO_BIN = 37450
+
+    def __init__(self, n_refs):
+        self.indexes = [BinningIndex() for _ in range(n_refs)]
+        self.extents = [None] * n_refs
+        self.counts = [[0, 0] for _ in range(n_refs)]
+        self.no_coordinate = 0
+
+    def add(self, refid, beg, end, unmapped, vstart, vend):
+        """Add a record placed on reference ``refid`` (-1 for unplaced reads)
+        covering [beg, end).
+        """
+        if refid < 0:
+            self.no_coordinate += 1
+            return
+        self.indexes[refid].add(beg, end, vstart, vend)
+        extent = self.extents[refid]
+        if extent is None:
+            self.extents[refid] = [vstart, vend]
+        else:
+            extent[1] = vend
+        self.counts[refid][1 if unmapped else 0] += 1
+
+    def remap(self, func):
+        for index in self.indexes:
+            index.remap(func)
+        for extent in self.extents:
+            if extent is not None:
+                extent[:] = [func(extent[0]), func(extent[1])]
+
+    def write(self, path):
+        parts = [b'BAI\1', struct.pack('<i', len(self.indexes))]
+        for index, extent, counts in zip(
+                self.indexes, self.extents, self.counts):
+            if extent is None:
+                parts.append(struct.pack('<ii', 0, 0))
+                continue
+            parts.append(index.pack([(self.PSEUDO_BIN, [extent, counts])]))
+        parts.append(struct.pack('<Q', self.no_coordinate))
+        with open(path, 'wb') as out:
+            out.write(b''.join(parts))
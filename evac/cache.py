@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""Content-addressed cache of stage outputs, so that a rerun of a pipeline
+skips the stages that already completed.
+
+A stage's key is a hash of its name, the contents of its input files, the
+executables (and jars) it runs, and its parameters. Outputs are stored under
+``<root>/objects/<key>/`` once the stage succeeds, and are copied back into
+place on a cache hit. Outputs are copied rather than hard-linked because the
+pipelines overwrite their outputs in place, which would also change the cached
+copy. Hashing a large input is done once: digests are remembered by path, size
+and modification time.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+log = logging.getLogger()
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+class StageCache(object):
+    """A cache of stage outputs in a directory.
+
+    Args:
+        root: Cache directory
+    """
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.objects = os.path.join(self.root, 'objects')
+        os.makedirs(self.objects, exist_ok=True)
+        self.digests_path = os.path.join(self.root, 'digests.json')
+        self._digests = None
+
+    # Keys
+
+    def fingerprint(self, path):
+        """Returns a digest of the contents of a file. For a directory (e.g. a
+        genome index), the digest covers the names, sizes and modification
+        times of the files in it.
+        """
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            sha = hashlib.sha1()
+            for dirpath, dirnames, filenames in sorted(os.walk(path)):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    stat = os.stat(os.path.join(dirpath, name))
+                    sha.update('{}\t{}\t{}\n'.format(
+                        os.path.relpath(os.path.join(dirpath, name), path),
+                        stat.st_size, stat.st_mtime_ns).encode())
+            return sha.hexdigest()
+        stat = os.stat(path)
+        digests = self._load_digests()
+        known = digests.get(path)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            return known[2]
+        log.info("Hashing {}".format(path))
+        sha = hashlib.sha1()
+        with open(path, 'rb') as inp:
+            for block in iter(lambda: inp.read(HASH_BLOCK_SIZE), b''):
+                sha.update(block)
+        digests[path] = [stat.st_size, stat.st_mtime_ns, sha.hexdigest()]
+        self._save_digests()
+        return sha.hexdigest()
+
+    def tool_fingerprint(self, exe):
+        """Returns a digest identifying an executable (or jar): the digest of
+        its contents if it can be found, otherwise its name.
+        """
+        path = exe if os.path.exists(exe) else shutil.which(exe)
+        if path is None:
+            return exe
+        return self.fingerprint(os.path.realpath(path))
+
+    def key(self, stage, inputs=(), tools=(), params=None):
+        """Compute the key of a stage.
+
+        Args:
+            stage: Name of the stage
+            inputs: Paths of input files/directories (None entries are
+                ignored)
+            tools: Executables/jars the stage runs
+            params: JSON-serializable parameters that affect the output
+
+        Returns:
+            The key, as a hex string
+        """
+        description = dict(
+            stage=stage,
+            inputs=[self.fingerprint(p) for p in inputs if p],
+            tools=[self.tool_fingerprint(t) for t in tools if t],
+            params=params)
+        return hashlib.sha256(
+            json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    # Entries
+
+    def entry(self, key):
+        return os.path.join(self.objects, key[:2], key)
+
+    def get(self, key, dests):
+        """Restore the outputs of a stage if they are in the cache.
+
+        Args:
+            key: The stage key
+            dests: Dict of {name: destination path}
+
+        Returns:
+            True if all outputs were restored
+        """
+        entry = self.entry(key)
+        if not all(
+                os.path.exists(os.path.join(entry, name)) for name in dests):
+            return False
+        for name, dest in dests.items():
+            _place(os.path.join(entry, name), dest)
+        log.info("Restored {} from cache entry {}".format(
+            ', '.join(sorted(dests.values())), key[:12]))
+        return True
+
+    def put(self, key, sources):
+        """Store the outputs of a completed stage.
+
+        Args:
+            key: The stage key
+            sources: Dict of {name: path of the output file or directory}
+        """
+        entry = self.entry(key)
+        if os.path.exists(entry):
+            return
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix='.put.', dir=os.path.dirname(entry))
+        try:
+            for name, source in sources.items():
+                _place(source, os.path.join(tmp, name))
+            os.rename(tmp, entry)
+        except OSError:
+            # A concurrent run stored the same entry first
+            if not os.path.exists(entry):
+                raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def _load_digests(self):
+        if self._digests is None:
+            try:
+                with open(self.digests_path, 'rt') as inp:
+                    self._digests = json.load(inp)
+            except (IOError, ValueError):
+                self._digests = {}
+        return self._digests
+
+    def _save_digests(self):
+        tmp = '{}.{}'.format(self.digests_path, os.getpid())
+        with open(tmp, 'wt') as out:
+            json.dump(self._digests, out)
+        os.replace(tmp, self.digests_path)
+
+class NullCache(object):
+    """Stands in for StageCache when caching is off.
+    """
+    def key(self, stage, inputs=(), tools=(), params=None):
+        return None
+
+    def get(self, key, dests):
+        return False
+
+    def put(self, key, sources):
+        pass
+
+NULL = NullCache()
+
+def open_cache(args):
+    """Returns a StageCache for ``--cache-dir``, or a no-op cache if it was
+    not given.
+    """
+    root = getattr(args, 'cache_dir', None)
+    return StageCache(root) if root else NULL
+
+def _place(source, dest):
+    """Copy a file or directory tree to ``dest``, replacing anything already
+    there.
+    """
+    if os.path.isdir(dest) and not os.path.islink(dest):
+        shutil.rmtree(dest)
+    elif os.path.lexists(dest):
+        os.remove(dest)
+    if os.path.isdir(source):
+        shutil.copytree(source, dest)
+    else:
+        shutil.copy2(source, dest)
@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+"""Compressive alignment: identical read pairs are aligned only once.
+
+RNA-seq reads from highly expressed transcripts are extremely redundant. As in
+CORA (http://bioinformatics.oxfordjournals.org/content/32/20/3124.short), only
+one representative of each distinct pair of sequences is sent to the aligner,
+and the alignments are copied back to the other reads afterwards:
+
+1. :meth:`Dedup.reads` wraps a reader. It keeps a table of the (hashes of the)
+   sequence pairs seen so far, passes on the first pair with each sequence,
+   and writes every duplicate (its name and qualities, and the name of its
+   representative) to a spill file. Once the table holds ``max_entries``
+   sequences, new sequences are instead partitioned by hash into spill files.
+   After the rest of the input, each of those is deduplicated the same way,
+   streaming it through a new table and spilling what does not fit into
+   partitions of its own, so memory stays bounded however many distinct pairs
+   there are.
+2. :func:`expand` runs as a stage after the aligner. It passes the aligner's
+   SAM output through, and also saves every record in a spill file partitioned
+   by read name. Duplicates may follow their representative anywhere in the
+   input, so once the aligner is done (and with it the reader), each partition
+   of records is joined with the duplicates of the same partition and a copy
+   of every alignment is written for every duplicate, with the duplicate's name
+   and qualities. The duplicates of a partition are held in memory for the
+   join, so a partition that is too large for ``--mem`` is first split
+   (along with its records) until each part fits.
+
+The output is therefore not in input order; the pipelines sort it anyway.
+"""
+from argparse import ArgumentParser
+import hashlib
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import zlib
+from evac.reads import ReadBatch
+from evac.telemetry import active
+
+log = logging.getLogger()
+
+MB = 1024 * 1024
+
+# Approximate memory used by each entry of the table
+ENTRY_BYTES = 160
+
+# Approximate memory used for each byte of duplicates that is loaded for a join
+DUPLICATE_OVERHEAD = 4
+
+# Most spill files to split a partition into at once (each is an open file);
+# a part that is still too large is split again
+MAX_PARTITIONS = 256
+
+# A partition of duplicates that is still too large after being split this
+# many times (because one pair has that many duplicates) is joined anyway
+MAX_SPLITS = 4
+
+SAM_FLAG_REVERSE = 0x10
+SAM_FLAG_READ2 = 0x80
+
+def read_name(name):
+    """The read name as reported by aligners: up to the first space, without a
+    /1 or /2 mate suffix.
+    """
+    name = name.split(None, 1)[0] if name else name
+    if name[-2:] in (b'/1', b'/2'):
+        name = name[:-2]
+    return name
+
+def _partition(key, partitions, level=0):
+    if level == 0:
+        return zlib.crc32(key) % partitions
+    # A partition is split with a different hash, or it would not split
+    digest = hashlib.blake2b(
+        key, digest_size=8, person=str(level).encode()).digest()
+    return int.from_bytes(digest, 'little') % partitions
+
+class Dedup(object):
+    """Configuration and spill files of the deduplication of one run.
+
+    Args:
+        workdir: Directory for the spill files
+        mem_mb: Memory for the table of distinct sequences, in MB
+        partitions: Number of spill partitions
+        batch_size: Size of the batches of representatives of spilled pairs
+    """
+    def __init__(self, workdir, mem_mb=1024, partitions=16, batch_size=1000):
+        self.workdir = workdir
+        self.mem_mb = mem_mb
+        self.max_entries = max(1, int(mem_mb * MB // ENTRY_BYTES))
+        self.partitions = partitions
+        self.batch_size = batch_size
+        for subdir in ('duplicates', 'overflow', 'records'):
+            os.makedirs(os.path.join(workdir, subdir), exist_ok=True)
+        # Created here rather than in reads(), which runs in a forked process,
+        # so that the parent sees the counts
+        self.unique = active().counter('dedup_unique')
+        self.duplicates = active().counter('dedup_duplicates')
+
+    def expand_command(self):
+        """The command of the stage that expands the aligner's SAM output.
+        """
+        return [
+            sys.executable, '-m', 'evac.dedup', 'expand',
+            '--partitions', str(self.partitions), '--mem', str(self.mem_mb),
+            self.workdir]
+
+    def reads(self, reader):
+        """Generate batches of representative read pairs from a reader.
+        """
+        dups = _Partitions(
+            os.path.join(self.workdir, 'duplicates'), self.partitions)
+        self.total = 0
+        try:
+            for batch in self._dedup(self._pairs(reader), dups):
+                yield batch
+        finally:
+            dups.close()
+        # Tells expand() that the duplicates are complete
+        open(os.path.join(self.workdir, 'done'), 'wb').close()
+        unique = self.unique.total
+        log.info(
+            "Aligning {} distinct of {} read pairs ({:.2f}x fewer)".format(
+                unique, self.total, self.total / (unique or 1)))
+
+    def _pairs(self, reader):
+        """Generate the batches of a reader as lists of (name, seq1, qual1,
+        seq2, qual2) tuples.
+        """
+        for batch1, batch2 in reader:
+            self.total += len(batch1)
+            yield [
+                (read_name(read1[0]),) + read1[1:] + read2[1:]
+                for read1, read2 in zip(batch1, batch2)]
+
+    def _dedup(self, batches, dups, expected=None, level=0):
+        """Deduplicate batches of (name, seq1, qual1, seq2, qual2) tuples,
+        writing the duplicates to ``dups``, and generate batches of the
+        representatives. At most ``max_entries`` distinct pairs are held in
+        memory; the pairs with new sequences that do not fit are partitioned
+        into spill files, which are deduplicated the same way afterwards.
+
+        Args:
+            batches: The batches of pairs
+            dups: _Partitions of the duplicates
+            expected: The number of pairs in the batches, if known, from which
+                the number of spill files is derived
+            level: How many times the pairs have been spilled
+        """
+        table = {}
+        overflow = None
+        for pairs in batches:
+            kept = ([], [], [], [], [])
+            for pair in pairs:
+                name = pair[0]
+                key = hashlib.blake2b(
+                    pair[1] + b'\t' + pair[3], digest_size=16).digest()
+                rep = table.get(key)
+                if rep is not None:
+                    dups.write(
+                        _partition(rep, self.partitions),
+                        b'\t'.join((rep, name, pair[2], pair[4])))
+                    self.duplicates.add()
+                elif len(table) < self.max_entries:
+                    table[key] = name
+                    for field, value in zip(kept, pair):
+                        field.append(value)
+                else:
+                    if overflow is None:
+                        overflow = self._overflow(expected)
+                    overflow.write(
+                        _partition(key, len(overflow.paths), level),
+                        b'\t'.join(pair))
+            if kept[0]:
+                self.unique.add(len(kept[0]))
+                yield _batches(*kept)
+        table = None
+        if overflow is None:
+            return
+        overflow.close()
+        log.info(
+            "Deduplicating {} read pairs that did not fit in memory, in {} "
+            "partitions".format(overflow.count, len(overflow.paths)))
+        try:
+            for path, count in zip(overflow.paths, overflow.counts):
+                if count:
+                    for batch in self._dedup(
+                            _read_pairs(path, self.batch_size), dups, count,
+                            level + 1):
+                        yield batch
+        finally:
+            shutil.rmtree(overflow.workdir, ignore_errors=True)
+
+    def _overflow(self, expected):
+        """Spill files for the pairs that don't fit in memory: as many as it
+        takes for each to fit, if the number of pairs is known.
+        """
+        partitions = self.partitions
+        if expected is not None:
+            partitions = min(
+                max(2, -(-expected // self.max_entries)), MAX_PARTITIONS)
+        return _Partitions(tempfile.mkdtemp(
+            dir=os.path.join(self.workdir, 'overflow')), partitions)
+
+def _batches(names, seqs1, quals1, seqs2, quals2):
+    return (
+        ReadBatch.from_lists(names, seqs1, quals1),
+        ReadBatch.from_lists(names, seqs2, quals2))
+
+class _Partitions(object):
+    """Line-oriented spill files, opened on first use.
+    """
+    def __init__(self, workdir, partitions):
+        self.workdir = workdir
+        self.paths = [
+            os.path.join(workdir, 'part{}'.format(i))
+            for i in range(partitions)]
+        self.files = [None] * partitions
+        self.counts = [0] * partitions
+        self.count = 0
+
+    def write(self, partition, line):
+        out = self.files[partition]
+        if out is None:
+            out = self.files[partition] = open(
+                self.paths[partition], 'wb', buffering=1024 * 1024)
+        out.write(line + b'\n')
+        self.counts[partition] += 1
+        self.count += 1
+
+    def close(self):
+        for out in self.files:
+            if out is not None:
+                out.close()
+
+def _read_pairs(path, batch_size):
+    """Generate the pairs of a spill file in batches, and delete it once
+    read.
+    """
+    batch = []
+    with open(path, 'rb') as inp:
+        for line in inp:
+            batch.append(tuple(line.rstrip(b'\n').split(b'\t')))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+    os.remove(path)
+
+def expand(workdir, partitions, inp, out, mem_mb=1024):
+    """Copy SAM records from ``inp`` to ``out``, followed by a copy of the
+    records of each representative read pair for every duplicate of that pair.
+
+    Returns:
+        The number of records added
+    """
+    records = _Partitions(os.path.join(workdir, 'records'), partitions)
+    for line in inp:
+        out.write(line)
+        if not line.startswith(b'@'):
+            qname = line[:line.index(b'\t')]
+            records.write(_partition(qname, partitions), line.rstrip(b'\n'))
+    records.close()
+    if not os.path.exists(os.path.join(workdir, 'done')):
+        raise IOError(
+            "Deduplication did not finish; the duplicates in {} are "
+            "incomplete".format(workdir))
+    max_bytes = max(1, int(mem_mb * MB // DUPLICATE_OVERHEAD))
+    added = 0
+    for i, path in enumerate(records.paths):
+        dups_path = os.path.join(workdir, 'duplicates', 'part{}'.format(i))
+        if os.path.exists(dups_path) and os.path.exists(path):
+            added += _join(dups_path, path, out, max_bytes)
+    return added
+
+def _join(dups_path, records_path, out, max_bytes, level=1):
+    """Write a copy of the records in ``records_path`` for every duplicate of
+    their read in ``dups_path``. If the duplicates take more than
+    ``max_bytes``, both files are split by the name of the representative
+    read, and each part is joined in turn.
+
+    Returns:
+        The number of records written
+    """
+    size = os.path.getsize(dups_path)
+    if size > max_bytes:
+        if level > MAX_SPLITS:
+            log.warning(
+                "Joining {:.1f} MB of duplicates of the same reads in "
+                "memory".format(size / MB))
+        else:
+            parts = min(-(-size // max_bytes) + 1, MAX_PARTITIONS)
+            log.info("Splitting {:.1f} MB of duplicates into {} parts".format(
+                size / MB, parts))
+            workdir = tempfile.mkdtemp(
+                prefix='split.', dir=os.path.dirname(records_path))
+            try:
+                dups = _split(dups_path, workdir, 'duplicates', parts, level)
+                records = _split(
+                    records_path, workdir, 'records', parts, level)
+                return sum(
+                    _join(dups_part, records_part, out, max_bytes, level + 1)
+                    for dups_part, records_part, dups_count, records_count
+                    in zip(dups.paths, records.paths, dups.counts,
+                           records.counts)
+                    if dups_count and records_count)
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+    dups = {}
+    with open(dups_path, 'rb') as dups_file:
+        for line in dups_file:
+            rep, name, qual1, qual2 = line.rstrip(b'\n').split(b'\t')
+            dups.setdefault(rep, []).append((name, qual1, qual2))
+    added = 0
+    with open(records_path, 'rb') as records_file:
+        for line in records_file:
+            fields = line.rstrip(b'\n').split(b'\t')
+            copies = dups.get(fields[0])
+            if not copies:
+                continue
+            flag = int(fields[1])
+            mate = 2 if flag & SAM_FLAG_READ2 else 1
+            has_qual = fields[10] != b'*'
+            for copy in copies:
+                fields[0] = copy[0]
+                if has_qual:
+                    qual = copy[mate]
+                    fields[10] = (
+                        qual[::-1] if flag & SAM_FLAG_REVERSE else qual)
+                out.write(b'\t'.join(fields) + b'\n')
+                added += 1
+    return added
+
+def _split(path, workdir, name, partitions, level):
+    """Split a spill file into ``partitions`` by the first field of its lines,
+    and delete it.
+
+    Returns:
+        The _Partitions of the parts
+    """
+    parts = _Partitions(os.path.join(workdir, name), partitions)
+    os.makedirs(parts.workdir)
+    with open(path, 'rb') as inp:
+        for line in inp:
+            parts.write(
+                _partition(line[:line.index(b'\t')], partitions, level),
+                line.rstrip(b'\n'))
+    parts.close()
+    os.remove(path)
+    return parts
+
+def main(argv=None):
+    parser = ArgumentParser(
+        description="Copy the alignments of representative read pairs to "
+            "their duplicates.")
+    parser.add_argument('command', choices=('expand',))
+    parser.add_argument('--partitions', type=int, default=16)
+    parser.add_argument(
+        '--mem', type=float, default=1024,
+        help="Memory for the duplicates of one partition, in MB")
+    parser.add_argument('workdir')
+    args = parser.parse_args(argv)
+    expand(
+        args.workdir, args.partitions, sys.stdin.buffer, sys.stdout.buffer,
+        args.mem)
+    sys.stdout.buffer.flush()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+"""Run a DAG of command stages connected by pipes, without a shell.
+
+Each stage's stderr is streamed into the logger, and every stage and edge is
+measured: wall time, CPU time and peak RSS for each stage (from ``wait4``), and
+the number of bytes through each edge. To count bytes, the parent relays each
+edge with ``splice`` (zero-copy) where possible; pass ``count_bytes=False`` to
+connect stages directly instead.
+
+Stages and edges are also registered with the active :mod:`evac.telemetry`,
+which samples their CPU, memory and pipe fill levels while they run.
+
+If the ``EVAC_METRICS`` environment variable is set, the metrics of each
+executor are also appended to that file as a line of JSON.
+"""
+import json
+import logging
+import os
+from subprocess import Popen, PIPE, CalledProcessError
+from threading import Thread
+import time
+from evac.telemetry import active, pipe_level
+
+log = logging.getLogger()
+
+RELAY_CHUNK_SIZE = 1024 * 1024
+
+METRICS_ENV = 'EVAC_METRICS'
+
+class Stage(object):
+    """A command in a DAG.
+
+    Args:
+        name: Unique name of the stage
+        cmd: The command, as a list
+        stdin: Name of the upstream stage whose stdout is this stage's stdin, or
+            a file object/descriptor, or None to inherit the parent's stdin
+        stdout: File object/descriptor to write to if no other stage reads
+            this stage's stdout; None inherits the parent's stdout
+        inputs: Dict of {placeholder: upstream stage name} for commands that
+            read more than one stream; each '{placeholder}' in ``cmd`` is
+            replaced with a /dev/fd path fed by the upstream stage
+        pass_fds: Additional file descriptors the stage must inherit
+    """
+    def __init__(
+            self, name, cmd, stdin=None, stdout=None, inputs=None,
+            pass_fds=()):
+        self.name = name
+        self.cmd = list(cmd)
+        self.stdin = stdin
+        self.stdout = stdout
+        self.inputs = inputs or {}
+        self.pass_fds = tuple(pass_fds)
+        self.proc = None
+        self.metrics = StageMetrics(name)
+
+    @property
+    def upstream(self):
+        names = list(self.inputs.values())
+        if isinstance(self.stdin, str):
+            names.append(self.stdin)
+        return names
+
+class StageMetrics(object):
+    """Resource usage of a stage.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+        self.end = None
+        self.user_time = None
+        self.system_time = None
+        self.max_rss_kb = None
+        self.returncode = None
+
+    @property
+    def wall_time(self):
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+    @property
+    def cpu_time(self):
+        if self.user_time is None:
+            return None
+        return self.user_time + self.system_time
+
+    def as_dict(self):
+        return dict(
+            stage=self.name, wall_time=self.wall_time,
+            cpu_time=self.cpu_time, user_time=self.user_time,
+            system_time=self.system_time, max_rss_kb=self.max_rss_kb,
+            returncode=self.returncode)
+
+class Edge(object):
+    """A stream from one stage to one or more consumers, relayed by the
+    parent.
+    """
+    def __init__(self, source):
+        self.source = source
+        self.read_fd = None
+        self.write_fds = []
+        self.targets = []
+        self.bytes = 0
+        self.thread = None
+        self.closed = False
+
+    def relay(self):
+        try:
+            if len(self.write_fds) == 1 and hasattr(os, 'splice'):
+                self._splice(self.write_fds[0])
+            else:
+                self._copy()
+        finally:
+            self.closed = True
+            os.close(self.read_fd)
+            for fd in self.write_fds:
+                if fd is not None:
+                    os.close(fd)
+
+    def _splice(self, write_fd):
+        while True:
+            try:
+                count = os.splice(self.read_fd, write_fd, RELAY_CHUNK_SIZE)
+            except BrokenPipeError:
+                self._drain()
+                return
+            if count == 0:
+                return
+            self.bytes += count
+
+    def _copy(self):
+        while True:
+            data = os.read(self.read_fd, RELAY_CHUNK_SIZE)
+            if not data:
+                return
+            self.bytes += len(data)
+            for i, fd in enumerate(self.write_fds):
+                if fd is None:
+                    continue
+                try:
+                    view = memoryview(data)
+                    while view:
+                        view = view[os.write(fd, view):]
+                except BrokenPipeError:
+                    # The consumer went away; keep feeding the others
+                    os.close(fd)
+                    self.write_fds[i] = None
+
+    def _drain(self):
+        while os.read(self.read_fd, RELAY_CHUNK_SIZE):
+            pass
+
+    def level(self, fd):
+        """Bytes buffered in one of the edge's pipes, or None once the edge
+        is closed.
+        """
+        return None if self.closed or fd is None else pipe_level(fd)
+
+    def watch(self, telemetry):
+        """Register gauges for the fill level of the pipe from the source and
+        of the pipe to each target.
+        """
+        telemetry.gauge(
+            'pipe:{}'.format(self.source), lambda: self.level(self.read_fd))
+        for i, target in enumerate(self.targets):
+            telemetry.gauge(
+                'pipe:{}->{}'.format(self.source, target),
+                lambda i=i: self.level(self.write_fds[i]))
+
+    def as_dict(self):
+        return dict(
+            source=self.source, targets=self.targets, bytes=self.bytes)
+
+class Executor(object):
+    """Runs a DAG of stages.
+
+    Args:
+        stages: Stages, in any order
+        count_bytes: Whether to relay edges through the parent to count bytes
+        stderr_level: Logging level for the stages' stderr
+    """
+    def __init__(self, stages, count_bytes=True, stderr_level=logging.INFO):
+        self.stages = _toposort(stages)
+        self.count_bytes = count_bytes
+        self.stderr_level = stderr_level
+        self.edges = {}
+        self.threads = []
+        self.killed = set()
+
+    def start(self):
+        """Start all stages.
+
+        Returns:
+            self
+        """
+        # Reads of each stage's stdout: (consumer, placeholder or None)
+        consumers = dict((stage.name, []) for stage in self.stages)
+        for stage in self.stages:
+            if isinstance(stage.stdin, str):
+                consumers[stage.stdin].append((stage, None))
+            for placeholder, upstream in stage.inputs.items():
+                consumers[upstream].append((stage, placeholder))
+
+        # Create the pipes. in_fds[stage][placeholder] is the read end for each
+        # input of a stage; out_fds[stage] is the write end of its stdout.
+        # Every fd that the parent still has to close is in open_fds.
+        in_fds = dict((stage.name, {}) for stage in self.stages)
+        out_fds = {}
+        open_fds = set()
+        def pipe():
+            fds = os.pipe()
+            open_fds.update(fds)
+            return fds
+        def close(fd):
+            open_fds.discard(fd)
+            os.close(fd)
+        try:
+            for stage in self.stages:
+                readers = consumers[stage.name]
+                if not readers:
+                    continue
+                if self.count_bytes or len(readers) > 1:
+                    edge = Edge(stage.name)
+                    self.edges[stage.name] = edge
+                    edge.read_fd, out_fds[stage.name] = pipe()
+                    for consumer, placeholder in readers:
+                        read_fd, write_fd = pipe()
+                        edge.write_fds.append(write_fd)
+                        edge.targets.append(consumer.name)
+                        in_fds[consumer.name][placeholder] = read_fd
+                else:
+                    consumer, placeholder = readers[0]
+                    read_fd, out_fds[stage.name] = pipe()
+                    in_fds[consumer.name][placeholder] = read_fd
+
+            for stage in self.stages:
+                inputs = in_fds[stage.name]
+                stdin_fd = inputs.pop(None, None)
+                stdin = stage.stdin if stdin_fd is None else stdin_fd
+                stdout = out_fds.get(stage.name, stage.stdout)
+                cmd = [
+                    arg.format(**dict(
+                        (placeholder, '/dev/fd/{}'.format(fd))
+                        for placeholder, fd in inputs.items()))
+                    if inputs else arg
+                    for arg in stage.cmd]
+                log.info("Running command: {}".format(' '.join(cmd)))
+                stage.metrics.start = time.time()
+                stage.proc = Popen(
+                    cmd, stdin=stdin, stdout=stdout, stderr=PIPE,
+                    pass_fds=tuple(inputs.values()) + stage.pass_fds)
+                active().watch(stage.name, stage.proc.pid)
+                # The child has its own copies now
+                for fd in inputs.values():
+                    close(fd)
+                if stdin_fd is not None:
+                    close(stdin_fd)
+                self._thread(self._log_stderr, stage)
+                self._thread(self._wait, stage)
+            for fd in out_fds.values():
+                close(fd)
+        except BaseException:
+            # Don't leave the stages that did start blocked on pipes that
+            # will never be relayed or closed
+            for fd in open_fds:
+                os.close(fd)
+            self.kill()
+            for thread in self.threads:
+                thread.join()
+            raise
+        for edge in self.edges.values():
+            edge.watch(active())
+            edge.thread = self._thread(edge.relay)
+        return self
+
+    def kill(self):
+        """Kill the stages that are still running. :meth:`wait` does not
+        report them as failed.
+        """
+        for stage in self.stages:
+            if stage.proc is not None and stage.proc.returncode is None:
+                self.killed.add(stage.name)
+                try:
+                    stage.proc.kill()
+                except ProcessLookupError:
+                    pass
+
+    def _thread(self, target, *args):
+        thread = Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+        return thread
+
+    def _log_stderr(self, stage):
+        for line in stage.proc.stderr:
+            log.log(self.stderr_level, "[{}] {}".format(
+                stage.name, line.decode(errors='replace').rstrip()))
+        stage.proc.stderr.close()
+
+    def _wait(self, stage):
+        metrics = stage.metrics
+        while True:
+            try:
+                pid, status, usage = os.wait4(stage.proc.pid, 0)
+                break
+            except InterruptedError:
+                continue
+            except ChildProcessError:
+                # Already reaped by Popen
+                stage.proc.wait()
+                metrics.end = time.time()
+                metrics.returncode = stage.proc.returncode
+                return
+        metrics.end = time.time()
+        metrics.user_time = usage.ru_utime
+        metrics.system_time = usage.ru_stime
+        metrics.max_rss_kb = usage.ru_maxrss
+        stage.proc.returncode = _exitcode(status)
+        metrics.returncode = stage.proc.returncode
+
+    def wait(self):
+        """Wait for all stages to finish and log their metrics.
+
+        Returns:
+            0 if all stages succeeded
+
+        Raises:
+            CalledProcessError if any stage failed (other than those stopped
+            by :meth:`kill`)
+        """
+        for thread in self.threads:
+            thread.join()
+        self.log_metrics()
+        if os.environ.get(METRICS_ENV):
+            self.write_metrics(os.environ[METRICS_ENV])
+        for stage in self.stages:
+            if (stage.proc.returncode != 0 and
+                    stage.name not in self.killed):
+                raise CalledProcessError(stage.proc.returncode, stage.cmd)
+        return 0
+
+    @property
+    def metrics(self):
+        """Metrics for all stages and edges, as a dict.
+        """
+        return dict(
+            stages=[stage.metrics.as_dict() for stage in self.stages],
+            edges=[edge.as_dict() for edge in self.edges.values()])
+
+    def log_metrics(self):
+        for stage in self.stages:
+            metrics = stage.metrics
+            log.info(
+                "Stage {}: exit {}, wall {:.2f}s, cpu {:.2f}s, max RSS {} "
+                "KB".format(
+                    stage.name, metrics.returncode, metrics.wall_time or 0,
+                    metrics.cpu_time or 0, metrics.max_rss_kb))
+        for edge in self.edges.values():
+            log.info("Edge {} -> {}: {} bytes".format(
+                edge.source, ', '.join(edge.targets), edge.bytes))
+
+    def write_metrics(self, path):
+        """Append the metrics to a file, as one line of JSON.
+        """
+        with open(path, 'at') as out:
+            out.write(json.dumps(self.metrics) + '\n')
+
+def chain(stages, **kwargs):
+    """Create an Executor for a linear chain of stages, each reading the
+    previous stage's stdout.
+    """
+    for previous, stage in zip(stages, stages[1:]):
+        stage.stdin = previous.name
+    return Executor(stages, **kwargs)
+
+def _exitcode(status):
+    if hasattr(os, 'waitstatus_to_exitcode'):
+        return os.waitstatus_to_exitcode(status)
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def _toposort(stages):
+    by_name = dict((stage.name, stage) for stage in stages)
+    if len(by_name) != len(stages):
+        raise ValueError("Stage names must be unique")
+    ordered = []
+    state = {}
+    def visit(stage):
+        if state.get(stage.name) == 'done':
+            return
+        if state.get(stage.name) == 'visiting':
+            raise ValueError("Cycle in stage graph at {}".format(stage.name))
+        state[stage.name] = 'visiting'
+        for name in stage.upstream:
+            if name not in by_name:
+                raise ValueError("Unknown stage {}".format(name))
+            visit(by_name[name])
+        state[stage.name] = 'done'
+        ordered.append(stage)
+    for stage in stages:
+        visit(stage)
+    return ordered
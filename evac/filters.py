@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""Read-level filters applied to batches of read pairs on their way from the
+reader to the aligner.
+
+A :class:`ReadFilter` drops a read pair if:
+
+* it is not selected by downsampling, which is deterministic: a pair is kept if
+  a keyed hash of its name falls below the target fraction, so the same pairs
+  are selected on every run (and by every worker) with the same seed;
+* either mate has a low mean base quality, or too high a fraction of N bases;
+* either mate matches a contaminant (e.g. rRNA or adapter sequences): a
+  fraction of the k-mers sampled along the read are found in a set of k-mers
+  built from a FASTA file.
+
+Batches are filtered in a pool of worker processes, in order, and the number
+of pairs dropped for each reason is counted.
+"""
+from collections import OrderedDict, deque
+import hashlib
+import logging
+import multiprocessing
+from evac.reads import ReadBatch
+
+log = logging.getLogger()
+
+HASH_RANGE = 2 ** 64
+COMPLEMENT = bytes.maketrans(b'ACGT', b'TGCA')
+
+# Reasons a pair is dropped, in the order the filters are applied
+REASONS = ('downsampled', 'low_quality', 'too_many_n', 'contaminant')
+
+_mp = multiprocessing.get_context('fork')
+
+class ReadFilter(object):
+    """Filters batches of read pairs.
+
+    Args:
+        fraction: Fraction of pairs to keep (by hash of the read name)
+        seed: Seed for the downsampling hash
+        min_quality: Minimum mean base quality (phred) of each mate
+        max_n: Maximum fraction of N bases in each mate
+        kmers: Set of contaminant k-mers (bytes)
+        k: Length of the k-mers
+        screen_fraction: Minimum fraction of sampled k-mers found in ``kmers``
+            for a read to be a contaminant
+        screen_step: Distance between the k-mers sampled from each read
+    """
+    def __init__(
+            self, fraction=None, seed=0, min_quality=None, max_n=None,
+            kmers=None, k=25, screen_fraction=0.5, screen_step=4):
+        self.threshold = None
+        if fraction is not None and fraction < 1:
+            self.threshold = int(fraction * HASH_RANGE)
+        self.key = str(seed).encode()
+        self.min_quality = min_quality
+        self.max_n = max_n
+        self.kmers = kmers or None
+        self.k = k
+        self.screen_fraction = screen_fraction
+        self.screen_step = screen_step
+
+    def keep(self, name):
+        """Whether downsampling selects the pair with read name ``name``.
+        """
+        if self.threshold is None:
+            return True
+        # Mate suffixes differ between files; the rest of the name does not
+        if name[-2:] in (b'/1', b'/2'):
+            name = name[:-2]
+        digest = hashlib.blake2b(name, digest_size=8, key=self.key).digest()
+        return int.from_bytes(digest, 'little') < self.threshold
+
+    def check(self, seq, qual):
+        """Returns the reason a read fails the quality, N and contaminant
+        filters, or None if it passes.
+        """
+        length = len(seq)
+        if length == 0:
+            return 'low_quality'
+        if self.min_quality is not None and (
+                sum(qual) - 33 * length < self.min_quality * length):
+            return 'low_quality'
+        if self.max_n is not None and (
+                seq.upper().count(b'N') > self.max_n * length):
+            return 'too_many_n'
+        if self.kmers is not None and self.contaminant(seq.upper()):
+            return 'contaminant'
+        return None
+
+    def contaminant(self, seq):
+        kmers = self.kmers
+        k = self.k
+        positions = range(0, len(seq) - k + 1, self.screen_step)
+        if not positions:
+            return False
+        hits = 0
+        for i in positions:
+            if seq[i:i + k] in kmers:
+                hits += 1
+        return hits >= self.screen_fraction * len(positions)
+
+    def __call__(self, batches):
+        """Filter a pair of batches.
+
+        Args:
+            batches: Tuple (batch1, batch2)
+
+        Returns:
+            Tuple (batch1, batch2, counts), where counts is a dict with the
+            number of pairs dropped for each reason
+        """
+        batch1, batch2 = batches
+        counts = dict.fromkeys(REASONS, 0)
+        kept1 = ([], [], [])
+        kept2 = ([], [], [])
+        for read1, read2 in zip(batch1, batch2):
+            if not self.keep(read1[0]):
+                counts['downsampled'] += 1
+                continue
+            reason = self.check(read1[1], read1[2]) or self.check(
+                read2[1], read2[2])
+            if reason:
+                counts[reason] += 1
+                continue
+            for kept, read in ((kept1, read1), (kept2, read2)):
+                for field, value in zip(kept, read):
+                    field.append(value)
+        return (
+            ReadBatch.from_lists(*kept1), ReadBatch.from_lists(*kept2),
+            counts)
+
+class FilteredReader(object):
+    """Wraps a reader (an iterable of (batch1, batch2) tuples) and filters
+    every pair of batches, in a pool of worker processes if ``workers`` > 1.
+    Empty batches are not passed on.
+
+    Args:
+        reader: The reader
+        read_filter: The ReadFilter
+        workers: Number of worker processes
+        counters: Optional dict of {reason: telemetry Counter}
+    """
+    def __init__(self, reader, read_filter, workers=1, counters=None):
+        self.reader = reader
+        self.read_filter = read_filter
+        self.workers = workers
+        self.counters = counters or {}
+        self.counts = OrderedDict(
+            (reason, 0) for reason in ('total',) + REASONS)
+
+    def __iter__(self):
+        if self.workers > 1:
+            results = self._parallel()
+        else:
+            results = map(self.read_filter, self.reader)
+        try:
+            for batch1, batch2, counts in results:
+                dropped = 0
+                for reason, count in counts.items():
+                    if count:
+                        self.counts[reason] += count
+                        dropped += count
+                        if reason in self.counters:
+                            self.counters[reason].add(count)
+                self.counts['total'] += dropped + len(batch1)
+                if len(batch1):
+                    yield batch1, batch2
+        finally:
+            self.log_counts()
+
+    def _parallel(self):
+        # The filter (with its k-mer set) is inherited by the forked workers
+        # rather than sent with every batch. At most two batches per worker are
+        # in flight, so that the reader does not run ahead of the aligner.
+        pool = _mp.Pool(
+            self.workers, initializer=_set_worker_filter,
+            initargs=(self.read_filter,))
+        pending = deque()
+        try:
+            for batches in self.reader:
+                if len(pending) >= 2 * self.workers:
+                    yield pending.popleft().get()
+                pending.append(pool.apply_async(_worker_filter, (batches,)))
+            while pending:
+                yield pending.popleft().get()
+            pool.close()
+        finally:
+            pool.terminate()
+
+    def log_counts(self):
+        total = self.counts['total']
+        dropped = sum(self.counts[reason] for reason in REASONS)
+        log.info("Filtered {} of {} read pairs ({})".format(
+            dropped, total, ', '.join(
+                '{} {}'.format(self.counts[reason], reason)
+                for reason in REASONS)))
+
+_worker_read_filter = None
+
+def _set_worker_filter(read_filter):
+    global _worker_read_filter
+    _worker_read_filter = read_filter
+
+def _worker_filter(batches):
+    return _worker_read_filter(batches)
+
+def read_kmers(path, k):
+    """Build the set of k-mers (on both strands) of the sequences in a FASTA
+    file. K-mers containing N are skipped.
+    """
+    kmers = set()
+    seqs = []
+    def add(seq):
+        for s in (seq, seq.translate(COMPLEMENT)[::-1]):
+            for i in range(len(s) - k + 1):
+                kmer = s[i:i + k]
+                if b'N' not in kmer:
+                    kmers.add(kmer)
+    with open(path, 'rb') as inp:
+        for line in inp:
+            line = line.strip()
+            if line.startswith(b'>'):
+                add(b''.join(seqs).upper())
+                seqs = []
+            else:
+                seqs.append(line)
+    add(b''.join(seqs).upper())
+    log.info("Read {} {}-mers from {}".format(len(kmers), k, path))
+    return kmers
+
+def downsample_fraction(args):
+    """Returns the fraction of read pairs to keep for ``--downsample`` or
+    ``--target-depth``, or None if neither was given.
+    """
+    if args.target_depth is None:
+        return args.downsample
+    if not (args.genome_size and args.input_bases):
+        raise ValueError(
+            "--target-depth requires --genome-size and --input-bases")
+    return min(1.0, args.target_depth * args.genome_size / args.input_bases)
+
+def filtering(args):
+    """Whether any read filter is enabled by a set of command-line args.
+    """
+    return not (
+        downsample_fraction(args) is None and args.min_quality is None and
+        args.max_n is None and not args.screen)
+
+def read_filter(args):
+    """Create a ReadFilter from a set of command-line args.
+
+    Returns:
+        A ReadFilter, or None if no filter is enabled
+    """
+    if not filtering(args):
+        return None
+    kmers = set()
+    for path in args.screen or ():
+        kmers.update(read_kmers(path, args.screen_k))
+    return ReadFilter(
+        fraction=downsample_fraction(args), seed=args.seed, min_quality=args.min_quality,
+        max_n=args.max_n, kmers=kmers, k=args.screen_k,
+        screen_fraction=args.screen_fraction)
+
+def filter_params(args):
+    """Returns the filter arguments that affect which reads are kept (for
+    cache keys).
+    """
+    return dict(
+        fraction=downsample_fraction(args), seed=args.seed,
+        min_quality=args.min_quality, max_n=args.max_n,
+        screen=args.screen, screen_k=args.screen_k,
+        screen_fraction=args.screen_fraction)
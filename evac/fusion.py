@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""Variant calling fused with alignment (``align.py --caller``).
+
+Instead of writing a sorted BAM and then reading it again to call variants,
+the native sort (:mod:`evac.bamsort`) writes the records of each contig to a
+small indexed BAM of its own as soon as its merge has passed that contig (see
+:class:`evac.bamsort.ContigSplitter`). A pool of ``--threads`` callers picks up
+each contig as it appears, so calling chr1 starts while later contigs are still
+being merged, and deletes the contig's BAM once it is called. The sort waits
+while ``--max-pending-contigs`` contigs are still waiting to be called, which
+bounds the space taken up by the contig BAMs. The sort itself still needs
+scratch space for the whole input once it exceeds ``--sort-mem``: its sorted
+runs are spilled to the temporary directory and kept until the merge is done.
+A full BAM is only written if ``--output`` names a file.
+
+The calls on each contig are then combined in contig order: concatenated for
+mpileup, or combined and genotyped for GATK.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+from threading import Thread
+import time
+from xphyle import open_
+from xphyle.paths import TempDir
+from evac.bamsort import bam_records
+from evac.executor import Executor, Stage
+from evac.regions import normalize, read_bed
+from evac.varcallers import (
+    genotype_gvcfs, haplotype_caller_command, mpileup_command,
+    write_interval_list)
+from evac.vcf import combine_disjoint, concatenate
+
+log = logging.getLogger()
+
+class ContigCaller(object):
+    """Base class for callers of the BAM of one contig.
+
+    Args:
+        args: a Namespace object
+    """
+    suffix = '.vcf'
+
+    def __init__(self, args):
+        self.args = args
+        self.header = None
+        self.intervals = None
+
+    def set_header(self, header):
+        """Set the SamHeader shared by all contigs, and split ``--regions``
+        by contig.
+        """
+        self.header = header
+        if self.args.regions:
+            contigs = [name.decode() for name, length in header.refs]
+            self.intervals = {}
+            for interval in normalize(read_bed(self.args.regions), contigs):
+                self.intervals.setdefault(interval[0], []).append(interval)
+
+    def __call__(self, refid, bam, workdir):
+        """Call variants on the contig ``refid``, whose records are in
+        ``bam``. The BAM and its index are deleted afterwards.
+
+        Returns:
+            The path of the output, or None if there are no regions on the
+            contig
+        """
+        contig, length = self.header.refs[refid]
+        contig = contig.decode()
+        try:
+            if self.intervals is None:
+                intervals = [(contig, 0, length)]
+            else:
+                intervals = self.intervals.get(contig)
+                if not intervals:
+                    return None
+            output = os.path.join(workdir, '{:06d}{}'.format(
+                refid, self.suffix))
+            self.call(contig, intervals, bam, output)
+            return output
+        finally:
+            for path in (bam, bam + '.bai'):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def call(self, contig, intervals, bam, output):
+        """Call variants on one contig, by running its Stage by default.
+        """
+        Executor([self.stage(contig, intervals, bam, output)]).start().wait()
+
+    def stage(self, contig, intervals, bam, output):
+        """Returns the Stage that calls variants on one contig.
+        """
+        raise NotImplementedError()
+
+    def finish(self, outputs):
+        """Combine the outputs of all contigs, in order.
+        """
+        raise NotImplementedError()
+
+class MpileupCaller(ContigCaller):
+    def stage(self, contig, intervals, bam, output):
+        cmd = mpileup_command(
+            self.args.samtools or 'samtools', self.args.reference,
+            self.args.caller_args)
+        if self.intervals is not None:
+            bed = output + '.bed'
+            with open(bed, 'wt') as out:
+                for name, start, end in intervals:
+                    out.write('{}\t{}\t{}\n'.format(name, start, end))
+            cmd += ['-l', bed]
+        return Stage(
+            'mpileup:{}'.format(contig), cmd + ['-o', output, bam])
+
+    def finish(self, outputs):
+        with open_(self.args.vcf, 'wb') as out:
+            count = concatenate(outputs, out)
+        log.info("Wrote {} records from {} contigs".format(
+            count, len(outputs)))
+
+class GatkCaller(ContigCaller):
+    suffix = '.g.vcf'
+
+    def stage(self, contig, intervals, bam, output):
+        args = self.args
+        interval_file = output + '.interval_list'
+        write_interval_list(
+            ''.join(
+                line + '\n' for line in self.header.text.decode().splitlines()
+                if line.startswith(('@HD', '@SQ'))),
+            intervals, interval_file)
+        cmd = haplotype_caller_command(
+            args.java, args.gatk, args.gatk_mem, args.reference, bam,
+            args.dbsnp, args.caller_args)
+        return Stage(
+            'HaplotypeCaller:{}'.format(contig),
+            cmd + ['-nct', '1', '-L', interval_file, '-o', output])
+
+    def finish(self, outputs):
+        args = self.args
+        gvcf = gvcf_path(args.vcf)
+        count = combine_disjoint(outputs, gvcf)
+        log.info("Merged {} gVCF records from {} contigs".format(
+            count, len(outputs)))
+        genotype_gvcfs(
+            args.java, args.gatk, args.gatk_mem, args.reference, gvcf,
+            args.vcf)
+
+class KnownSitesCaller(ContigCaller):
+    """Genotypes the known sites in ``--sites`` (or ``--regions``) on each
+    contig in-process, as soon as the contig is sorted (see evac.genotype).
+    """
+    def set_header(self, header):
+        from evac.genotype import KnownSiteGenotyper, read_sites
+        args = self.args
+        sites_path = args.sites or args.regions
+        if sites_path is None:
+            raise ValueError("The 'known' caller needs --sites (or --regions)")
+        self.header = header
+        sites = read_sites(sites_path, args.reference)
+        self.genotyper = KnownSiteGenotyper(
+            sites, args.min_base_quality, args.min_mapping_quality,
+            args.min_depth, args.min_allele_fraction)
+        # Only the contigs with sites are called
+        self.intervals = dict(
+            (contig, [(contig, contig_sites[0].pos, contig_sites[-1].pos + 1)])
+            for contig, contig_sites in sites.items() if contig_sites)
+
+    def call(self, contig, intervals, bam, output):
+        with open(output, 'wb') as out:
+            self.genotyper.genotype_bam(bam, out, contigs=[contig])
+
+    def finish(self, outputs):
+        with open_(self.args.vcf, 'wb') as out:
+            count = concatenate(outputs, out)
+        log.info("Genotyped {} sites on {} contigs".format(
+            count, len(outputs)))
+
+def gvcf_path(vcf):
+    """The path of the combined gVCF written next to a GATK VCF.
+    """
+    if vcf.endswith('.vcf'):
+        vcf = vcf[:-4]
+    return vcf + '.g.vcf.gz'
+
+callers = dict(
+    mpileup=MpileupCaller,
+    gatk=GatkCaller,
+    known=KnownSitesCaller)
+
+def list_callers():
+    """Returns the callers that can be fused with alignment.
+    """
+    return list(callers.keys())
+
+def contig_bams(directory, running, interval=0.2):
+    """Generate the (refid, path) of each contig BAM written to ``directory``
+    by a ContigSplitter, as they appear, until the splitter is done (or
+    ``running()`` returns False).
+    """
+    seen = set()
+    while True:
+        finished = not running()
+        done = os.path.exists(os.path.join(directory, 'done'))
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.bam') and name not in seen:
+                seen.add(name)
+                yield int(name[:-4]), os.path.join(directory, name)
+        if done or finished:
+            return
+        time.sleep(interval)
+
+def align_and_call(pipeline, args):
+    """Run an alignment pipeline and call variants on each contig of its
+    sorted output as soon as the contig is complete.
+
+    Args:
+        pipeline: an SraPipeline that supports calling
+        args: a Namespace object
+    """
+    if not getattr(pipeline, 'supports_calling', False):
+        raise ValueError("--caller is not supported by the {} pipeline".format(
+            args.pipeline))
+    if args.sort not in (None, 'native'):
+        raise ValueError("--caller requires --sort native")
+    if not args.vcf or not args.reference:
+        raise ValueError("--caller requires --vcf and --reference")
+    caller = callers[args.caller](args)
+    with TempDir(dir=args.temp_dir) as workdir:
+        workdir = str(workdir.absolute_path)
+        pipeline.split = os.path.join(workdir, 'contigs')
+        os.makedirs(pipeline.split)
+        errors = []
+
+        def align():
+            try:
+                pipeline(args)
+            except BaseException as err:
+                errors.append(err)
+
+        aligner = Thread(target=align)
+        aligner.daemon = True
+        aligner.start()
+        futures = []
+        with ThreadPoolExecutor(max(1, args.threads)) as pool:
+            for refid, bam in contig_bams(pipeline.split, aligner.is_alive):
+                if caller.header is None:
+                    with open(bam, 'rb') as inp:
+                        caller.set_header(bam_records(inp)[0])
+                futures.append(pool.submit(caller, refid, bam, workdir))
+            outputs = [future.result() for future in futures]
+        aligner.join()
+        if errors:
+            raise errors[0]
+        outputs = [output for output in outputs if output]
+        if not outputs:
+            raise ValueError("No contigs with aligned reads to call")
+        caller.finish(outputs)
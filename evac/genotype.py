@@ -0,0 +1,456 @@
+# -*- coding: utf-8 -*-
+"""Genotyping of known sites (``--caller known``).
+
+Instead of calling variants de novo, count the alleles of the reads at a fixed
+set of sites, such as the ClinVar variants, and genotype each site from its
+counts. The sites come from a VCF (which gives their REF and ALT alleles) or a
+BED (every base of every interval is a site, its REF is read from the
+reference, and its ALTs are the other bases that are seen).
+
+The alignments are streamed once. If the BAM is indexed, only the parts that
+overlap the sites are read (see :mod:`evac.bamslice`). Reads that are
+unmapped, secondary, QC-failed or duplicates are skipped, as are reads below
+the minimum mapping quality and bases below the minimum base quality, as in
+``samtools mpileup``. Unlike mpileup, both mates of an overlapping pair are
+counted. The base of each read at each site is collected, and the counts are
+added up per site into a NumPy array (sites x A, C, G, T, other) with
+``bincount``.
+
+Each site is written as a VCF record with the total depth (``DP``) and the
+depth of each allele (``AD``). The genotype is made of the (at most two)
+alleles that make up at least ``min_fraction`` of the depth, or is missing
+if the depth is below ``min_depth``.
+"""
+from bisect import bisect_left
+import logging
+import os
+import struct
+import sys
+import numpy as np
+from xphyle import open_
+from evac.bamslice import BamSlicer, find_index
+from evac.bamsort import bam_records
+from evac.vcf import read_header, records
+
+log = logging.getLogger()
+
+BASES = b'ACGT'
+# Column of the counts for each 4-bit BAM base code: A, C, G, T, or other
+# (N and IUPAC codes)
+CODE_COLUMNS = np.array(
+    [4, 0, 1, 4, 2, 4, 4, 4, 3, 4, 4, 4, 4, 4, 4, 4], dtype=np.int64)
+COLUMNS = 5
+
+# block_size, refid, pos, l_read_name, mapq, bin, n_cigar, flag, l_seq
+RECORD_HEAD = struct.Struct('<iiiBBHHHi')
+# Unmapped, secondary, QC fail, duplicate
+SKIP_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+# CIGAR operations that consume the read and the reference (M, =, X), and
+# only the reference (D, N) or only the read (I, S)
+CIGAR_MATCH = (0, 7, 8)
+CIGAR_REF = (2, 3)
+CIGAR_READ = (1, 4)
+
+# Collected bases are added to the counts in batches of this many
+FLUSH_BASES = 1 << 20
+
+class Site(object):
+    """A known site: one record of the output.
+    """
+    __slots__ = ('pos', 'id', 'ref', 'alts')
+
+    def __init__(self, pos, id, ref, alts):
+        self.pos = pos
+        self.id = id
+        self.ref = ref
+        self.alts = alts
+
+class ContigSites(object):
+    """The sites on one contig, and the allele counts at each of their
+    (distinct) positions.
+
+    Args:
+        sites: List of Sites, sorted by position
+    """
+    def __init__(self, sites):
+        self.sites = sites
+        self.positions = sorted(set(site.pos for site in sites))
+        self.counts = np.zeros((len(self.positions), COLUMNS), dtype=np.int64)
+        self.hits = []
+        self.codes = []
+
+    def intervals(self, contig):
+        """Returns the intervals covered by the sites, with nearby positions
+        merged.
+        """
+        intervals = []
+        for pos in self.positions:
+            if intervals and pos - intervals[-1][2] < 1024:
+                intervals[-1] = (contig, intervals[-1][1], pos + 1)
+            else:
+                intervals.append((contig, pos, pos + 1))
+        return intervals
+
+    def flush(self):
+        """Add the collected bases to the counts.
+        """
+        if not self.hits:
+            return
+        hits = np.array(self.hits, dtype=np.int64)
+        columns = CODE_COLUMNS[np.array(self.codes, dtype=np.int64)]
+        self.counts += np.bincount(
+            hits * COLUMNS + columns,
+            minlength=len(self.positions) * COLUMNS).reshape(-1, COLUMNS)
+        self.hits = []
+        self.codes = []
+
+def read_sites(path, reference=None):
+    """Read known sites from a VCF or BED file. Only the SNVs of a VCF are
+    kept.
+
+    Args:
+        path: Path of the (optionally compressed) VCF or BED file
+        reference: FASTA file from which the REF of BED sites is read
+
+    Returns:
+        A dict {contig: list of Sites sorted by position}
+    """
+    with open_(path, 'rb') as inp:
+        header, first = read_header(inp)
+        if header and header[0].startswith(b'##fileformat=VCF'):
+            return _vcf_sites(records(inp, first))
+        lines = records(inp, first)
+        return _bed_sites(lines, reference)
+
+def _vcf_sites(lines):
+    sites = {}
+    skipped = 0
+    for line in lines:
+        fields = line.rstrip(b'\r\n').split(b'\t', 6)
+        ref = fields[3].upper()
+        alts = [alt.upper() for alt in fields[4].split(b',') if alt != b'.']
+        if len(ref) != 1 or not all(
+                len(alt) == 1 and alt in BASES for alt in alts):
+            skipped += 1
+            continue
+        sites.setdefault(fields[0].decode(), []).append(Site(
+            int(fields[1]) - 1, fields[2], ref, alts))
+    if skipped:
+        log.info("Skipped {} known sites that are not SNVs".format(skipped))
+    for contig_sites in sites.values():
+        contig_sites.sort(key=lambda site: site.pos)
+    return sites
+
+def _bed_sites(lines, reference):
+    if reference is None:
+        raise ValueError(
+            "A reference is needed to genotype the sites of a BED")
+    positions = {}
+    for line in lines:
+        if not line.strip() or line.startswith((b'track', b'browser')):
+            continue
+        fields = line.split(b'\t', 3)
+        positions.setdefault(fields[0].decode(), set()).update(
+            range(int(fields[1]), int(fields[2].rstrip())))
+    sites = {}
+    for contig, bases in reference_bases(reference, positions).items():
+        sites[contig] = [
+            Site(pos, b'.', base, None) for pos, base in sorted(bases.items())]
+    return sites
+
+def reference_bases(fasta, positions):
+    """Read the reference bases at a set of positions, seeking to each of them
+    if the FASTA is indexed (``.fai``), or reading the contigs that have any
+    positions otherwise.
+
+    Args:
+        fasta: Path of the FASTA file
+        positions: Dict {contig: iterable of 0-based positions}
+
+    Returns:
+        A dict {contig: {position: base}}
+    """
+    bases = {}
+    if os.path.exists(fasta + '.fai'):
+        with open(fasta + '.fai', 'rt') as inp:
+            fai = dict(
+                (fields[0], [int(field) for field in fields[1:5]])
+                for fields in (line.split('\t') for line in inp))
+        with open(fasta, 'rb') as inp:
+            for contig, contig_positions in positions.items():
+                if contig not in fai:
+                    continue
+                length, offset, line_bases, line_width = fai[contig]
+                contig_bases = bases[contig] = {}
+                for pos in sorted(contig_positions):
+                    if pos >= length:
+                        continue
+                    inp.seek(
+                        offset + pos // line_bases * line_width +
+                        pos % line_bases)
+                    contig_bases[pos] = inp.read(1).upper()
+        return bases
+    def add(contig, lines):
+        seq = b''.join(lines)
+        bases[contig] = dict(
+            (pos, seq[pos:pos + 1].upper())
+            for pos in positions[contig] if pos < len(seq))
+    with open_(fasta, 'rb') as inp:
+        contig = None
+        lines = []
+        for line in inp:
+            if line.startswith(b'>'):
+                if contig in positions:
+                    add(contig, lines)
+                contig = line[1:].split()[0].decode()
+                lines = []
+            elif contig in positions:
+                lines.append(line.rstrip())
+        if contig in positions:
+            add(contig, lines)
+    return bases
+
+def count_alleles(
+        stream, by_refid, min_base_quality=13, min_mapping_quality=0):
+    """Collect the base of each read at each known site it covers.
+
+    Args:
+        stream: Iterable of BAM records (with their size prefix),
+            sorted by coordinate
+        by_refid: List of the ContigSites of each reference (None for those
+            without sites)
+        min_base_quality: Skip bases with a lower quality
+        min_mapping_quality: Skip reads with a lower mapping quality
+
+    Returns:
+        The number of reads that covered at least one site
+    """
+    used = 0
+    for record in stream:
+        (size, refid, pos, l_read_name, mapq, bin_, n_cigar, flag,
+         l_seq) = RECORD_HEAD.unpack_from(record)
+        if (refid < 0 or refid >= len(by_refid) or flag & SKIP_FLAGS or
+                mapq < min_mapping_quality):
+            continue
+        contig = by_refid[refid]
+        if contig is None:
+            continue
+        positions = contig.positions
+        n = len(positions)
+        i = bisect_left(positions, pos)
+        if i == n:
+            continue
+        cigar_at = RECORD_HEAD.size + 12 + l_read_name
+        seq_at = cigar_at + 4 * n_cigar
+        qual_at = seq_at + (l_seq + 1) // 2
+        hits = contig.hits
+        codes = contig.codes
+        found = len(hits)
+        rpos = pos
+        qpos = 0
+        for op in struct.unpack_from('<{}I'.format(n_cigar), record, cigar_at):
+            kind = op & 0xf
+            length = op >> 4
+            if kind in CIGAR_MATCH:
+                end = rpos + length
+                while i < n and positions[i] < end:
+                    q = qpos + positions[i] - rpos
+                    if record[qual_at + q] >= min_base_quality:
+                        byte = record[seq_at + (q >> 1)]
+                        hits.append(i)
+                        codes.append(byte & 0xf if q & 1 else byte >> 4)
+                    i += 1
+                rpos = end
+                qpos += length
+            elif kind in CIGAR_REF:
+                rpos += length
+                while i < n and positions[i] < rpos:
+                    i += 1
+            elif kind in CIGAR_READ:
+                qpos += length
+            if i == n:
+                break
+        if len(hits) > found:
+            used += 1
+            if len(hits) >= FLUSH_BASES:
+                contig.flush()
+    for contig in by_refid:
+        if contig is not None:
+            contig.flush()
+    return used
+
+def genotype(counts, depth, min_depth=1, min_fraction=0.2):
+    """Genotype a site from the counts of its alleles (REF first).
+
+    Returns:
+        The GT field, e.g. '0/1', or './.' if the depth is below
+        ``min_depth`` or no allele makes up ``min_fraction`` of it
+    """
+    if depth < min_depth or depth == 0:
+        return b'./.'
+    present = sorted(
+        (i for i, count in enumerate(counts)
+         if count and count >= min_fraction * depth),
+        key=lambda i: (-counts[i], i))[:2]
+    if not present:
+        return b'./.'
+    if len(present) == 1:
+        present *= 2
+    return '{}/{}'.format(*sorted(present)).encode()
+
+class KnownSiteGenotyper(object):
+    """Genotypes a BAM at known sites.
+
+    Args:
+        sites: Dict of sites, as returned by :func:`read_sites`
+        min_base_quality: Skip bases with a lower quality
+        min_mapping_quality: Skip reads with a lower mapping quality
+        min_depth: Minimum depth of a called genotype
+        min_fraction: Minimum fraction of the depth of an allele in the
+            genotype
+    """
+    def __init__(
+            self, sites, min_base_quality=13, min_mapping_quality=0,
+            min_depth=1, min_fraction=0.2):
+        self.sites = sites
+        self.min_base_quality = min_base_quality
+        self.min_mapping_quality = min_mapping_quality
+        self.min_depth = min_depth
+        self.min_fraction = min_fraction
+
+    def genotype_bam(self, bam, out, contigs=None):
+        """Count the alleles of the reads of a BAM file at the sites, and
+        write the genotypes to ``out``.
+
+        Args:
+            bam: Path of the coordinate-sorted BAM file ('-' for stdin)
+            out: Binary file object to write the VCF to
+            contigs: Only genotype the sites on these contigs, if given
+
+        Returns:
+            The number of records written
+        """
+        header, by_refid = self.count_bam(bam, contigs)
+        return self.write_vcf(out, header, by_refid, sample_name(header, bam))
+
+    def count_bam(self, bam, contigs=None, slice_indexed=True):
+        """Count the alleles of the reads of a BAM file at the sites. If the
+        BAM is indexed (and ``slice_indexed``), only the parts that overlap
+        the sites are read.
+
+        Returns:
+            A tuple (SamHeader, list of the ContigSites of each reference)
+        """
+        with open(sys.stdin.fileno() if bam == '-' else bam, 'rb',
+                  closefd=bam != '-') as inp:
+            header, stream = bam_records(inp)
+            by_refid = self.contig_sites(header, contigs)
+            index = None
+            if bam != '-' and slice_indexed:
+                index = find_index(bam)
+            if index is None:
+                used = self.count(stream, by_refid)
+            else:
+                intervals = []
+                for refid, contig in enumerate(by_refid):
+                    if contig is not None:
+                        intervals.extend(contig.intervals(
+                            header.refs[refid][0].decode()))
+                used = self.count(
+                    BamSlicer(bam, index).records(intervals), by_refid)
+        log.info("Counted the alleles of {} reads".format(used))
+        return header, by_refid
+
+    def contig_sites(self, header, contigs=None):
+        """Returns the ContigSites of each reference of a SamHeader (None for
+        those without sites).
+        """
+        names = [name.decode() for name, length in header.refs]
+        missing = set(self.sites) - set(names)
+        if missing:
+            log.warning("Ignoring sites on contigs not in the BAM: {}".format(
+                ', '.join(sorted(missing))))
+        return [
+            ContigSites(self.sites[name])
+            if name in self.sites and (contigs is None or name in contigs)
+            else None
+            for name in names]
+
+    def count(self, stream, by_refid):
+        return count_alleles(
+            stream, by_refid, self.min_base_quality,
+            self.min_mapping_quality)
+
+    def write_vcf(self, out, header, by_refid, sample):
+        """Write a VCF record for every site.
+
+        Returns:
+            The number of records written
+        """
+        lines = [
+            b'##fileformat=VCFv4.2',
+            b'##source=evac.genotype',
+            b'##INFO=<ID=DP,Number=1,Type=Integer,Description="Depth of '
+            b'the bases that pass the quality filters">',
+            b'##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+            b'##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read '
+            b'depth">',
+            b'##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Depth of '
+            b'each allele">']
+        lines.extend(
+            '##contig=<ID={},length={}>'.format(
+                name.decode(), length).encode()
+            for name, length in header.refs)
+        lines.append(
+            b'#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t' +
+            sample.encode())
+        out.write(b''.join(line + b'\n' for line in lines))
+        count = 0
+        for (name, length), contig in zip(header.refs, by_refid):
+            if contig is None:
+                continue
+            depths = contig.counts.sum(axis=1).tolist()
+            counts = contig.counts[:, :4].tolist()
+            positions = contig.positions
+            i = 0
+            for site in contig.sites:
+                while positions[i] < site.pos:
+                    i += 1
+                out.write(self.format_site(name, site, counts[i], depths[i]))
+                count += 1
+        return count
+
+    def format_site(self, contig, site, base_counts, depth):
+        ref = BASES.find(site.ref)
+        alts = site.alts
+        if alts is None:
+            # A BED site: the other bases that were seen, most common first
+            alts = [
+                BASES[i:i + 1] for i in sorted(
+                    range(4), key=lambda i: (-base_counts[i], i))
+                if i != ref and base_counts[i]]
+        allele_counts = [
+            base_counts[BASES.find(allele)] if allele in BASES else 0
+            for allele in [site.ref] + alts]
+        gt = genotype(
+            allele_counts, depth, self.min_depth, self.min_fraction)
+        dp = str(depth).encode()
+        ad = b','.join(str(count).encode() for count in allele_counts)
+        return b'\t'.join((
+            contig, str(site.pos + 1).encode(), site.id, site.ref,
+            b','.join(alts) or b'.', b'.', b'.', b'DP=' + dp, b'GT:DP:AD',
+            gt + b':' + dp + b':' + ad)) + b'\n'
+
+def sample_name(header, bam):
+    """The sample (SM) of the first read group in a SamHeader, or the name of
+    the BAM file.
+    """
+    for line in header.text.splitlines():
+        if line.startswith(b'@RG'):
+            for field in line.split(b'\t')[1:]:
+                if field.startswith(b'SM:'):
+                    return field[3:].decode()
+    if bam == '-':
+        return 'sample'
+    name = os.path.basename(bam)
+    return name[:-4] if name.endswith('.bam') else name
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""Keep one shared-memory copy of a genome index alive across pipeline runs.
+
+The state of each index (whether it is loaded, which processes are using it,
+and load/reuse statistics) is kept in a small JSON file that is only modified
+while holding an exclusive lock, so that concurrent pipelines (in the same or
+different processes) agree on who loads and who unloads the index.
+
+Users are recorded by process ID (and start time, so that a reused PID is not
+mistaken for a user), so a run that dies without releasing the index (killed,
+or out of memory) is dropped from the state as soon as another process looks
+at it. While the index is loaded, a detached reaper process looks at it
+periodically and unloads it once it has had no live users for an idle
+timeout. A run that is terminated (SIGTERM) inside :meth:`IndexManager.use`
+releases the index before it exits. The state also records the boot it was
+written in, since a reboot unloads everything.
+"""
+from argparse import ArgumentParser
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import signal
+from subprocess import Popen, DEVNULL
+import sys
+import tempfile
+import threading
+import time
+
+log = logging.getLogger()
+
+DEFAULT_IDLE_TIMEOUT = 600
+
+# Longest time between two checks of the reaper
+REAP_INTERVAL = 60
+
+def boot_id():
+    """Returns an ID of the current boot of the machine, or None if unknown.
+    """
+    try:
+        with open('/proc/sys/kernel/random/boot_id', 'rt') as inp:
+            return inp.read().strip()
+    except IOError:
+        return None
+
+def _proc_stat(pid):
+    """Returns the fields of /proc/<pid>/stat after the command name (so the
+    state is the first), or None if they can't be read.
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid), 'rt') as inp:
+            # The command name can contain spaces, but not ')'
+            return inp.read().rsplit(')', 1)[1].split()
+    except (IOError, IndexError):
+        return None
+
+def process_id(pid=None):
+    """Returns a [pid, start time] pair that identifies a process (by default
+    the current one), even after its PID is reused. The start time is None if
+    it is unknown.
+    """
+    pid = os.getpid() if pid is None else pid
+    fields = _proc_stat(pid)
+    return [pid, int(fields[19]) if fields else None]
+
+def is_alive(holder):
+    """Whether the process identified by a [pid, start time] pair (see
+    :func:`process_id`) is still running.
+    """
+    pid, start = holder
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    fields = _proc_stat(pid)
+    if fields is None:
+        return start is None
+    # An exited process that its parent has not waited for is a zombie
+    return fields[0] != 'Z' and (start is None or int(fields[19]) == start)
+
+def default_state_dir():
+    """Returns the default directory for index state files. /dev/shm is
+    preferred because it is cleared (along with the shared memory segments)
+    on reboot.
+    """
+    root = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(root, 'evac-index')
+
+class StarIndexLoader(object):
+    """Loads and unloads a STAR genome with --genomeLoad.
+
+    Args:
+        exe: Path to the STAR executable
+        workdir: Directory for the log files STAR writes
+    """
+    def __init__(self, exe='STAR', workdir=None):
+        self.exe = exe
+        self.workdir = workdir or tempfile.gettempdir()
+
+    def load(self, index):
+        self._run(index, 'LoadAndExit')
+
+    def unload(self, index):
+        self._run(index, 'Remove')
+
+    def _run(self, index, mode):
+        cmd = [
+            self.exe, '--genomeLoad', mode, '--genomeDir', index,
+            '--outFileNamePrefix',
+            os.path.join(self.workdir, 'genome{}.'.format(mode))]
+        log.info("Running command: {}".format(' '.join(cmd)))
+        with Popen(cmd) as proc:
+            if proc.wait() != 0:
+                raise IOError("Command {} failed with exit code {}".format(
+                    ' '.join(cmd), proc.returncode))
+
+class IndexManager(object):
+    """Tracks the users of shared-memory copies of indexes.
+
+    Args:
+        loader: Object with ``load(index)`` and ``unload(index)`` methods
+        idle_timeout: Seconds to keep an unused index loaded; 0 unloads it as
+            soon as the last user releases it, and None keeps it loaded
+            indefinitely
+        state_dir: Directory for the state files
+    """
+    def __init__(
+            self, loader, idle_timeout=DEFAULT_IDLE_TIMEOUT, state_dir=None):
+        self.loader = loader
+        self.idle_timeout = idle_timeout
+        self.state_dir = state_dir or default_state_dir()
+        os.makedirs(self.state_dir, exist_ok=True)
+
+    def state_path(self, index):
+        key = hashlib.sha1(os.path.abspath(index).encode()).hexdigest()[:16]
+        return os.path.join(self.state_dir, key + '.json')
+
+    @contextmanager
+    def locked_state(self, index):
+        """Lock the state file of an index and yield its contents as a dict,
+        which is written back on exit.
+        """
+        path = self.state_path(index)
+        with open(path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                state = dict(
+                    index=os.path.abspath(index), loaded=False, refcount=0,
+                    holders=[], reaper=None, boot_id=boot_id(), loads=0,
+                    reuses=0, load_time=None, last_release=None)
+                if os.path.exists(path):
+                    with open(path, 'rt') as inp:
+                        state.update(json.load(inp))
+                self._prune(state)
+                yield state
+                state['refcount'] = len(state['holders'])
+                tmp = path + '.tmp'
+                with open(tmp, 'wt') as out:
+                    json.dump(state, out)
+                os.replace(tmp, path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def acquire(self, index):
+        """Make sure an index is loaded and register a user of it.
+
+        Returns:
+            The number of seconds spent loading the index (0 if it was already
+            loaded)
+        """
+        with self.locked_state(index) as state:
+            if state['loaded']:
+                state['reuses'] += 1
+                elapsed = 0
+                log.info(
+                    "Reusing loaded index {} (loading it took {:.1f} seconds; "
+                    "{} loads, {} reuses)".format(
+                        index, state['load_time'] or 0, state['loads'],
+                        state['reuses']))
+            else:
+                # Loading while holding the lock makes concurrent users wait
+                # for this copy rather than load their own.
+                start = time.time()
+                self.loader.load(index)
+                elapsed = time.time() - start
+                state.update(loaded=True, load_time=elapsed)
+                state['loads'] += 1
+                log.info("Loaded index {} in {:.1f} seconds".format(
+                    index, elapsed))
+            state['holders'].append(process_id())
+            self._start_reaper(index, state)
+        return elapsed
+
+    def release(self, index):
+        """Unregister a user of an index (the current process). When the last
+        user goes away, the index is unloaded, either now or (by the reaper)
+        after the idle timeout.
+        """
+        with self.locked_state(index) as state:
+            holder = process_id()
+            if holder in state['holders']:
+                state['holders'].remove(holder)
+            if not state['holders']:
+                state['last_release'] = time.time()
+                if state['loaded'] and self.idle_timeout == 0:
+                    self._unload(index, state)
+            if state['loaded']:
+                self._start_reaper(index, state)
+
+    @contextmanager
+    def use(self, index):
+        """Context manager that acquires an index and releases it on exit,
+        also if the process is terminated with SIGTERM while using it.
+        """
+        handler = None
+        if threading.current_thread() is threading.main_thread():
+            handler = signal.signal(signal.SIGTERM, _terminate)
+        try:
+            self.acquire(index)
+            try:
+                yield
+            finally:
+                self.release(index)
+        finally:
+            if handler is not None:
+                signal.signal(signal.SIGTERM, handler)
+
+    def reap(self, index):
+        """Unload an index if it has had no live users for at least the idle
+        timeout.
+
+        Returns:
+            True if the index is no longer loaded (so there is nothing left
+            for the reaper to do)
+        """
+        with self.locked_state(index) as state:
+            if (state['loaded'] and not state['holders'] and
+                    self.idle_timeout is not None and
+                    time.time() - (state['last_release'] or 0) >=
+                    self.idle_timeout):
+                self._unload(index, state)
+            if not state['loaded']:
+                state['reaper'] = None
+                return True
+        return False
+
+    def _prune(self, state):
+        """Drop the users that are no longer running from the state of an
+        index; after a reboot, the index is no longer loaded at all.
+        """
+        current = boot_id()
+        if state['boot_id'] != current:
+            state.update(
+                boot_id=current, loaded=False, holders=[], reaper=None)
+            return
+        holders = [holder for holder in state['holders'] if is_alive(holder)]
+        if len(holders) < len(state['holders']):
+            log.warning("Dropping {} users of index {} that are no longer "
+                        "running".format(
+                            len(state['holders']) - len(holders),
+                            state['index']))
+            state['holders'] = holders
+            if not holders:
+                state['last_release'] = time.time()
+
+    def _unload(self, index, state):
+        log.info("Unloading index {}".format(index))
+        self.loader.unload(index)
+        state['loaded'] = False
+
+    def _start_reaper(self, index, state):
+        """Start the reaper of a loaded index, unless it is already running.
+        """
+        if self.idle_timeout is None:
+            return
+        if state['reaper'] and is_alive(state['reaper']):
+            return
+        state['reaper'] = process_id(self.spawn_reaper(index).pid)
+
+    def spawn_reaper(self, index):
+        """Start a detached process that unloads the index once it has had no
+        live users for the idle timeout.
+
+        Returns:
+            The Popen of the reaper
+        """
+        cmd = [
+            sys.executable, '-m', 'evac.index',
+            '--state-dir', self.state_dir,
+            '--idle-timeout', str(self.idle_timeout),
+            '--star', self.loader.exe,
+            index]
+        return Popen(
+            cmd, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL,
+            start_new_session=True)
+
+def _terminate(signum, frame):
+    # Unwind, so that the index is released on the way out
+    raise SystemExit(128 + signum)
+
+def star_index_manager(args):
+    """Create an IndexManager for STAR from a set of command-line args.
+    """
+    return IndexManager(
+        StarIndexLoader(args.star or 'STAR', args.temp_dir),
+        idle_timeout=args.index_idle_timeout)
+
+def main():
+    """Reaper: check the index periodically, and unload it once it has had no
+    live users for the idle timeout.
+    """
+    parser = ArgumentParser()
+    parser.add_argument('--state-dir', default=None)
+    parser.add_argument(
+        '--idle-timeout', type=float, default=DEFAULT_IDLE_TIMEOUT)
+    parser.add_argument('--star', default='STAR')
+    parser.add_argument('index')
+    args = parser.parse_args()
+    manager = IndexManager(
+        StarIndexLoader(args.star), args.idle_timeout, args.state_dir)
+    interval = REAP_INTERVAL
+    if args.idle_timeout:
+        interval = min(max(args.idle_timeout, 1), REAP_INTERVAL)
+    while True:
+        time.sleep(interval)
+        if manager.reap(args.index):
+            break
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""Join called variants to the gene counts of featureCounts.
+
+This replaces the convert_formats_*.sh scripts, which went through four
+intermediate files (grep, awk, vcf2bed, intersectBed, cut). For every variant
+that overlaps an exon of a gene, one line is written with the selected fields.
+By default these are the variant's contig, 0-based start and end, and the
+gene's count and ID, as the scripts wrote.
+
+The featureCounts table is read into a sorted list of exons per contig. Its
+size depends on the annotation, not on the number of samples or variants. The
+VCF is streamed once and joined to the exons with a sweep line, so memory does
+not grow with the number of variants. Contig filtering and the selection of
+fields happen as the records stream past, and nothing is written but the
+output.
+
+As in the scripts, these records and genes are skipped:
+
+* records without an alternate allele (ALT '.', '<*>' or '<NON_REF>'), such
+  as the reference-only records of ``bcftools mpileup``;
+* genes whose exons are on more than one contig (e.g. chrX;chrY).
+
+Unlike the scripts, featureCounts' 1-based, inclusive coordinates are
+converted to 0-based, half-open ones before they are compared to the variants.
+"""
+from argparse import ArgumentParser
+import heapq
+import logging
+from xphyle import open_
+from evac.vcf import read_header, records
+
+log = logging.getLogger()
+
+# Alleles that stand for "no alternate allele"
+REF_ONLY = frozenset((b'.', b'<*>', b'<NON_REF>', b'<X>'))
+
+VARIANT_FIELDS = ('chrom', 'start', 'end', 'pos', 'id', 'ref', 'alt', 'qual',
+                  'filter', 'info')
+GENE_FIELDS = ('gene', 'strand', 'length', 'count')
+FIELDS = VARIANT_FIELDS + GENE_FIELDS
+DEFAULT_FIELDS = ('chrom', 'start', 'end', 'count', 'gene')
+
+class Gene(object):
+    """A row of a featureCounts table.
+    """
+    __slots__ = ('id', 'strand', 'length', 'counts')
+
+    def __init__(self, id, strand, length, counts):
+        self.id = id
+        self.strand = strand
+        self.length = length
+        self.counts = counts
+
+def read_counts(stream, contigs=None, exclude=None, multi_contig=False):
+    """Read the exons of the genes in a featureCounts table.
+
+    Args:
+        stream: Binary file object
+        contigs: Only keep exons on these contigs (bytes), if given
+        exclude: Skip exons on these contigs (bytes)
+        multi_contig: Whether to keep genes with exons on several contigs
+
+    Returns:
+        A tuple (samples, exons): the names of the count columns, and a dict
+        mapping each contig to a list of (start, end, gene) tuples sorted by
+        start, with 0-based, half-open coordinates
+    """
+    samples = []
+    exons = {}
+    skipped = 0
+    for line in stream:
+        if line.startswith(b'#'):
+            continue
+        fields = line.rstrip(b'\r\n').split(b'\t')
+        if fields[0] == b'Geneid':
+            samples = fields[6:]
+            continue
+        chroms = fields[1].split(b';')
+        if not multi_contig and len(set(chroms)) > 1:
+            skipped += 1
+            continue
+        gene = Gene(
+            fields[0], fields[4].split(b';', 1)[0], fields[5], fields[6:])
+        for chrom, start, end in zip(
+                chroms, fields[2].split(b';'), fields[3].split(b';')):
+            if contigs is not None and chrom not in contigs:
+                continue
+            if exclude and chrom in exclude:
+                continue
+            exons.setdefault(chrom, []).append(
+                (int(start) - 1, int(end), gene))
+    for contig_exons in exons.values():
+        contig_exons.sort(key=lambda exon: exon[0])
+    if skipped:
+        log.info("Skipped {} genes with exons on several contigs".format(
+            skipped))
+    return samples, exons
+
+def variants(stream, contigs=None, exclude=None):
+    """Generate (contig, start, end, fields) for each record of a VCF stream
+    that has an alternate allele, where ``fields`` is the list of the first
+    eight columns.
+    """
+    header, first = read_header(stream)
+    for line in records(stream, first):
+        fields = line.rstrip(b'\r\n').split(b'\t', 8)[:8]
+        contig = fields[0]
+        if contigs is not None and contig not in contigs:
+            continue
+        if exclude and contig in exclude:
+            continue
+        if all(alt in REF_ONLY for alt in fields[4].split(b',')):
+            continue
+        start = int(fields[1]) - 1
+        yield contig, start, start + len(fields[3]), fields
+
+def sweep(variants, exons):
+    """Join variants to the genes whose exons they overlap, with a sweep line
+    over each contig.
+
+    Args:
+        variants: Iterable of (contig, start, end, fields), grouped by contig
+            and sorted by start within each contig
+        exons: Dict of sorted exons, as returned by :func:`read_counts`
+
+    Yields:
+        (variant, gene) tuples, one for each gene that overlaps a variant
+    """
+    contig = None
+    done = set()
+    for variant in variants:
+        if variant[0] != contig:
+            contig = variant[0]
+            if contig in done:
+                raise ValueError(
+                    "VCF records on {} are not contiguous".format(
+                        contig.decode()))
+            done.add(contig)
+            todo = exons.get(contig, ())
+            next_exon = 0
+            # Heap of (end, exon number, start, gene) of the exons that
+            # started before the end of a variant and may still overlap later
+            # ones
+            active = []
+            last = -1
+        start, end = variant[1], variant[2]
+        if start < last:
+            raise ValueError("VCF records on {} are not sorted".format(
+                contig.decode()))
+        last = start
+        while next_exon < len(todo) and todo[next_exon][0] < end:
+            exon_start, exon_end, gene = todo[next_exon]
+            heapq.heappush(active, (exon_end, next_exon, exon_start, gene))
+            next_exon += 1
+        while active and active[0][0] <= start:
+            heapq.heappop(active)
+        if not active:
+            continue
+        if len(active) == 1:
+            if active[0][2] < end:
+                yield variant, active[0][3]
+            continue
+        # Each gene once, however many of its exons the variant overlaps
+        genes = {}
+        for exon_end, number, exon_start, gene in sorted(
+                active, key=lambda item: item[1]):
+            if exon_start < end:
+                genes.setdefault(gene)
+        for gene in genes:
+            yield variant, gene
+
+def _column(index):
+    return lambda variant, gene: variant[3][index]
+
+# Functions that return the value of each field for a (variant, gene) pair
+GETTERS = dict(
+    chrom=lambda variant, gene: variant[0],
+    start=lambda variant, gene: str(variant[1]).encode(),
+    end=lambda variant, gene: str(variant[2]).encode(),
+    gene=lambda variant, gene: gene.id,
+    strand=lambda variant, gene: gene.strand,
+    length=lambda variant, gene: gene.length,
+    count=lambda variant, gene: b'\t'.join(gene.counts))
+for _index, _field in enumerate(VARIANT_FIELDS[3:], 1):
+    GETTERS[_field] = _column(_index)
+
+def formatter(fields):
+    """Returns a function that formats the selected fields of a (variant,
+    gene) pair as a tab-delimited line.
+    """
+    getters = [GETTERS[field] for field in fields]
+    def format_line(variant, gene):
+        return b'\t'.join([get(variant, gene) for get in getters]) + b'\n'
+    return format_line
+
+def join_counts(
+        vcf, counts, out, fields=DEFAULT_FIELDS, contigs=None, exclude=None,
+        multi_contig=False, header=False):
+    """Join the records of a VCF to the genes of a featureCounts table.
+
+    Args:
+        vcf: Binary file object of the VCF, sorted by coordinate
+        counts: Binary file object of the featureCounts table
+        out: Binary file object to write to
+        fields: Names of the fields to write (see ``FIELDS``)
+        contigs: Only join records and exons on these contigs, if given
+        exclude: Skip records and exons on these contigs
+        multi_contig: Whether to keep genes with exons on several contigs
+        header: Whether to write a header line of field names
+
+    Returns:
+        The number of lines written
+    """
+    for field in fields:
+        if field not in FIELDS:
+            raise ValueError("Unknown field {}; choose from {}".format(
+                field, ', '.join(FIELDS)))
+    if contigs is not None:
+        contigs = set(contig.encode() for contig in contigs)
+    if exclude:
+        exclude = set(contig.encode() for contig in exclude)
+    samples, exons = read_counts(counts, contigs, exclude, multi_contig)
+    if header:
+        names = []
+        for field in fields:
+            if field == 'count':
+                names.extend(
+                    sample.decode() for sample in samples or [b'count'])
+            else:
+                names.append(field)
+        out.write(('#' + '\t'.join(names) + '\n').encode())
+    format_line = formatter(fields)
+    count = 0
+    for variant, gene in sweep(variants(vcf, contigs, exclude), exons):
+        out.write(format_line(variant, gene))
+        count += 1
+    return count
+
+def main(argv=None):
+    parser = ArgumentParser(
+        description="Join the variants in a VCF to the featureCounts counts "
+            "of the genes they overlap.")
+    parser.add_argument(
+        'vcf',
+        help="VCF file, sorted by coordinate (optionally compressed; '-' for "
+            "stdin)")
+    parser.add_argument(
+        'counts',
+        help="featureCounts output table")
+    parser.add_argument(
+        '-o', '--output', default='-',
+        help="Output file (default: stdout)")
+    parser.add_argument(
+        '-f', '--fields', nargs='+', default=DEFAULT_FIELDS, choices=FIELDS,
+        metavar="FIELD",
+        help="Fields to write, from: {} ('start' and 'end' are 0-based, "
+            "half-open; 'count' is every count column). Default: {}".format(
+                ', '.join(FIELDS), ' '.join(DEFAULT_FIELDS)))
+    parser.add_argument(
+        '--contigs', nargs='+', default=None, metavar="CONTIG",
+        help="Only join records and genes on these contigs")
+    parser.add_argument(
+        '--exclude', nargs='+', default=None, metavar="CONTIG",
+        help="Skip records and genes on these contigs")
+    parser.add_argument(
+        '--multi-contig', action='store_true', default=False,
+        help="Keep genes with exons on more than one contig")
+    parser.add_argument(
+        '--header', action='store_true', default=False,
+        help="Write a header line of field names")
+    args = parser.parse_args(argv)
+    with open_(args.vcf, 'rb') as vcf, open_(args.counts, 'rb') as counts, \
+            open_(args.output, 'wb') as out:
+        count = join_counts(
+            vcf, counts, out, args.fields, args.contigs, args.exclude,
+            args.multi_contig, args.header)
+    log.info("Wrote {} variant-gene pairs".format(count))
+
+if __name__ == '__main__':
+    main()
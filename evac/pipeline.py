@@ -1,102 +1,375 @@
 # -*- coding: utf-8 -*-
-"""Aligner-agnostic alignment pipeline that reads from SRA.
+"""Aligner-agnostic alignment pipeline that reads from SRA or local files.
 """
-from contextlib import contextmanager
+from argparse import ArgumentTypeError, Namespace
+from bisect import bisect_right
+from contextlib import ExitStack, contextmanager
+import glob
 from inspect import isclass
 import logging
+import os
 import shlex
-from multiprocessing import Process
-from subprocess import Popen
-from srastream import SraReader, sra_dump
-from srastream.utils import Batcher
 import sys
+import time
 from xphyle import open_
 from xphyle.paths import TempDir
+from evac.batching import batch_sizer
+from evac.cache import open_cache
+from evac.dedup import Dedup
+from evac.executor import Stage, chain
+from evac.filters import (
+    REASONS, FilteredReader, filter_params, filtering, read_filter)
+from evac.fusion import align_and_call
+from evac.index import star_index_manager
+from evac.prefetch import prefetching
+from evac.readers import open_reader
+from evac.telemetry import active, telemetry
+from evac.transport import TeeTransport, fill_level, transports
 
 log = logging.getLogger()
 
+STAR_BAM_SORT_RAM = 2 * 1024 ** 3
+
+# How each pipeline's BAM is sorted if --sort is not given
+DEFAULT_SORT = dict(star='star', hisat='sambamba')
+
 # Pipelines
 
 # TODO: [JD] These are just default pipelines. Version 2 will enable pipelines
 # to be built from CWL descriptions using toil.
 
-# TODO: [JD] These have lots of redundant code right now. I will be adding
-# alternate readers for local FASTQ and SAM/BAM/CRAM files and refactoring the
-# pipelines to accept an arbitrary reader.
-
-# TODO: [JD] Pipe stderr of pipelines to logger
-
-# TODO: [JD] Incorporate compressive mapping code from CORA
-# https://github.com/jdidion/cora/blob/master/manual.txt
-# http://bioinformatics.oxfordjournals.org/content/32/20/3124.short
-
 # TODO: [JD] Incorporate qtip MAPQ correction?
 # https://github.com/BenLangmead/qtip
 
 # TODO: [JD] Aligner "boosting"
 # https://github.com/Grice-Lab/AlignerBoost
 
-class SraDump(Process):
-    """Process to dump SRA reads to FIFOs.
+class ReaderSource(object):
+    """Transport source that writes paired reads from a Reader as FASTQ.
+    Throughput is counted in the 'reads' and 'fastq_bytes' telemetry counters.
+    If a batch sizer is given, it is told the size of each batch before it is
+    written, and updated with the time taken to read and to write it and with
+    the fill level of the transport buffer; its size is sampled in the
+    'batch_size' telemetry gauge.
+
+    Aligners read the two mates in lock-step, so writing more of one mate
+    than the transport can hold before writing the other deadlocks them. A
+    batch larger than ``max_bytes`` (the transport's ``max_batch_bytes``) is
+    therefore written as alternating runs of whole records of mate 1 and
+    mate 2, each at most ``max_bytes`` long.
     """
-    def __init__(self, args, prefix, progress):
-        self.args = args
-        self.prefix = prefix
-        self.progress = progress
-        
-    def run(self):
-        sra_dump(
-            self.args.sra_accession, self.prefix, 
-            compression=self.args.compression,
-            progress=self.progress,
-            batch_size=self.args.batch_size, 
-            max_reads=self.args.max_reads)
-
-# TODO: [JD] The use of pipes and shell=True is insecure and not the recommended
-# way of doing things, but I want to benchmark the alternative (chained Popens)
-# to make sure it's not any slower.
-
-def hisat_pipeline(args):
-    with open_(args.output, 'wb') as bam:
-        cmd = shlex.split("""
-            {exe} -p {threads} -x {index} --sra-acc {accn} {extra}
-                | sambamba view -S -t {threads} -f bam /dev/stdin
-                | sambamba sort -t {threads} /dev/stdin
-        """.format(
-            exe=args.hisat2 or "hisat2",
-            accn=args.sra_accession,
-            threads=args.threads,
-            index=args.index,
-            extra=args.aligner_args
-        ))
-        log.info("Running command: {}".format(' '.join(cmd)))
-        with Popen(cmd, stdout=bam, shell=True) as proc:
-            proc.wait()
+    def __init__(self, reader, sizer=None, max_bytes=None):
+        self.reader = reader
+        self.sizer = sizer
+        self.max_bytes = max_bytes
+        # Created here rather than in __call__, which may run in a forked
+        # process, so that the parent sees the counts
+        self.reads = active().counter('reads')
+        self.bytes = active().counter('fastq_bytes')
+        if sizer is not None:
+            active().gauge('batch_size', lambda: sizer.size)
+    
+    def __call__(self, out1, out2):
+        sizer = self.sizer
+        start = time.time()
+        for batch1, batch2 in self.reader:
+            # Formatting is timed with reading, so that the write time is the
+            # time spent waiting for the aligner
+            data1 = batch1.to_fastq()
+            data2 = batch2.to_fastq()
+            read = time.time()
+            if sizer is not None:
+                sizer.fit(len(batch1), len(data1) + len(data2))
+            max_bytes = self.max_bytes
+            if max_bytes and max(len(data1), len(data2)) > max_bytes:
+                offsets1 = batch1.fastq_offsets()
+                offsets2 = batch2.fastq_offsets()
+                with memoryview(data1) as view1, memoryview(data2) as view2:
+                    for start, end in chunk_bounds(
+                            offsets1, offsets2, max_bytes):
+                        out1.write(view1[offsets1[start]:offsets1[end]])
+                        out2.write(view2[offsets2[start]:offsets2[end]])
+            else:
+                out1.write(data1)
+                out2.write(data2)
+            nbytes = len(data1) + len(data2)
+            self.bytes.add(nbytes)
+            self.reads.add(len(batch1))
+            if sizer is not None:
+                written = time.time()
+                sizer.update(
+                    len(batch1), nbytes, read - start, written - read,
+                    fill_level(out1))
+                start = written
+        if sizer is not None:
+            sizer.finish()
+
+def chunk_bounds(offsets1, offsets2, max_bytes):
+    """Split a batch into runs of whole records that are at most ``max_bytes``
+    long in both mates (or a single record, if it is longer).
+
+    Args:
+        offsets1, offsets2: The record offsets of mate 1 and mate 2 (see
+            :meth:`evac.reads.ReadBatch.fastq_offsets`)
+        max_bytes: Largest run, in bytes
+
+    Returns:
+        A list of (start, end) record indexes
+    """
+    bounds = []
+    start = 0
+    size = len(offsets1) - 1
+    while start < size:
+        end = min(
+            bisect_right(offsets1, offsets1[start] + max_bytes),
+            bisect_right(offsets2, offsets2[start] + max_bytes)) - 1
+        end = max(end, start + 1)
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+def open_reads(args, progress=False, dedup=None, sizer=None):
+    """Open the reader for a set of command-line args, applying the read
+    filters (if any) in ``--filter-workers`` processes. The number of pairs
+    dropped for each reason is counted in the 'filtered_<reason>' telemetry
+    counters.
+    
+    Args:
+        args: a Namespace object
+        progress: Whether to show a progress bar (SRA only)
+        dedup: Optional Dedup that collapses identical read pairs after
+            filtering
+        sizer: Optional batch sizer for the reader
+    """
+    reader = open_reader(args, progress, sizer=sizer)
+    if filtering(args):
+        telemetry = active()
+        reader = FilteredReader(
+            reader, read_filter(args), args.filter_workers, counters=dict(
+                (reason, telemetry.counter('filtered_' + reason))
+                for reason in REASONS))
+    if dedup is not None:
+        reader = dedup.reads(reader)
+    return reader
 
 class SraPipeline(object):
+    """Base class for pipelines that stream reads (from SRA or local files)
+    to an aligner through a transport.
+    """
+    transport = None
+    dedup = None
+    # (argument, default) of each executable the pipeline runs
+    tools = ()
+    # Whether the pipeline can expand the alignments of deduplicated reads
+    # (``--dedup``) by adding the stage given by ``self.dedup``
+    supports_dedup = False
+    # Whether the pipeline's output is sorted by evac.bamsort, which can split
+    # it by contig into the directory ``self.split`` for calling (``--caller``)
+    supports_calling = False
+    split = None
+    
+    def run(self, args):
+        """Run the pipeline, unless its output is in the cache
+        (``--cache-dir``). The output is cached by the content of the reads and
+        index, the aligner executable and the arguments that affect the output.
+        """
+        cache = open_cache(args)
+        key = None
+        if args.output != '-':
+            key = self.cache_key(cache, args)
+            if cache.get(key, self.outputs(args)):
+                return
+        self(args)
+        if key:
+            cache.put(key, self.outputs(args))
+    
+    def outputs(self, args):
+        """Returns the output files of a run, as a dict {name: path}.
+        """
+        return {"output": args.output}
+    
+    def cache_key(self, cache, args):
+        if args.index is None or os.path.exists(args.index):
+            index = [args.index]
+        else:
+            # e.g. the HISAT2 index is a path prefix
+            index = sorted(glob.glob(args.index + '*'))
+        return cache.key(
+            type(self).__name__,
+            (args.input or []) + index + (args.screen or []),
+            [getattr(args, name, None) or default
+             for name, default in self.tools],
+            dict(
+                accession=None if args.input else args.sra_accession,
+                max_reads=args.max_reads,
+                library_type=args.library_type,
+                aligner_args=args.aligner_args,
+                filters=filter_params(args),
+                dedup=args.dedup,
+                sort=sort_method(args)))
+    
     def __call__(self, args):
-        with TempDir(dir=args.temp_dir) as workdir:
-            progress = args.progress and (
-                not args.quiet or args.log_level == 'ERROR' or args.log_file)
-            sra_proc = SraDump(args, "fifo", progress)
-            with self.align(args, "fifo.1.fq", "fifo.2.fq") as align_proc:
-                for proc in (sra_proc, align_proc):
-                    proc.wait()
+        if args.dedup and not self.supports_dedup:
+            raise ValueError("--dedup is not supported by the {} pipeline".format(
+                args.pipeline))
+        with self.context(args), TempDir(dir=args.temp_dir) as workdir:
+            if args.dedup:
+                self.dedup = Dedup(
+                    os.path.join(str(workdir.absolute_path), 'dedup'),
+                    args.dedup_mem, args.dedup_partitions, args.batch_size)
+            transport_class = transports[args.transport]
+            with transport_class(
+                    str(workdir.absolute_path), args.buffer_mb) as transport:
+                self.transport = transport
+                sizer = batch_sizer(args, transport)
+                transport.start(ReaderSource(
+                    open_reads(args, show_progress(args), self.dedup, sizer),
+                    sizer, transport.max_batch_bytes))
+                with self.align(args, *transport.paths) as align_proc:
+                    align_proc.wait()
+    
+    @contextmanager
+    def context(self, args):
+        """Context in which the aligner runs, e.g. with its index loaded.
+        Raises ValueError if the pipeline does not support ``args``.
+        """
+        yield
     
     def align(self, args, fifo1, fifo2):
         raise NotImplementedError()
+    
+    def sorted_bam(self, args, bam):
+        """Stages that convert the aligner's SAM output to a sorted BAM
+        written to ``bam``, first expanding the alignments of deduplicated
+        reads if ``--dedup`` is on. With ``--sort native``, the BAM is sorted
+        within ``--sort-mem`` by evac.bamsort, which also writes the index
+        (and, if ``self.split`` is set, a BAM per contig, in which case the
+        full BAM is only written if the output is a file); otherwise, by
+        sambamba.
+        """
+        threads = str(args.threads)
+        if sort_method(args) != 'native':
+            stages = [
+                Stage('view', [
+                    'sambamba', 'view', '-S', '-t', threads, '-f', 'bam',
+                    '/dev/stdin']),
+                Stage('sort', [
+                    'sambamba', 'sort', '-t', threads, '-o', '/dev/stdout',
+                    '/dev/stdin'],
+                    stdout=bam)]
+        else:
+            cmd = [
+                sys.executable, '-m', 'evac.bamsort', '-m', args.sort_mem,
+                '-@', threads]
+            if self.split is None or args.output != '-':
+                cmd += ['-o', '-']
+            if self.split is not None:
+                cmd += [
+                    '--split', self.split,
+                    '--max-pending', str(args.max_pending_contigs)]
+            if args.temp_dir:
+                cmd += ['-T', args.temp_dir]
+            if args.output != '-':
+                cmd += ['--bai', args.output + '.bai']
+            stages = [Stage('sort', cmd, stdout=bam)]
+        if self.dedup is not None:
+            stages.insert(0, Stage('expand', self.dedup.expand_command()))
+        return stages
+    
+    def bam_outputs(self, args):
+        outputs = {"output": args.output}
+        if sort_method(args) == 'native':
+            outputs["bai"] = args.output + '.bai'
+        return outputs
+
+    @property
+    def pass_fds(self):
+        """File descriptors the aligner must inherit to read from the current
+        transport.
+        """
+        return self.transport.pass_fds if self.transport else ()
+
+    def execute(self, *stages):
+        """Start a chain of stages, each reading the previous stage's stdout.
+        Stage stderr goes to the logger, and per-stage metrics are logged when
+        the chain finishes.
+
+        Returns:
+            A started Executor
+        """
+        return chain(list(stages)).start()
+
+class HisatPipeline(SraPipeline):
+    """HISAT2 reads from SRA itself, so reads only go through a transport when
+    the input is local or the reads are filtered.
+    """
+    tools = (('hisat2', 'hisat2'), ('sambamba', 'sambamba'))
+    supports_dedup = True
+    supports_calling = True
+    
+    def outputs(self, args):
+        return self.bam_outputs(args)
+    
+    def __call__(self, args):
+        if args.input or prefetching(args) or filtering(args) or args.dedup:
+            super(HisatPipeline, self).__call__(args)
+        else:
+            with self.context(args), \
+                    self.align(args, None, None) as align_proc:
+                align_proc.wait()
+    
+    @contextmanager
+    def context(self, args):
+        if sort_method(args) == 'star':
+            raise ValueError("--sort star is only supported by STAR")
+        yield
+    
+    @contextmanager
+    def align(self, args, fifo1, fifo2):
+        if fifo1 is None:
+            reads = ['--sra-acc', args.sra_accession]
+        else:
+            reads = ['-1', fifo1, '-2', fifo2]
+        exe = args.hisat2 or "hisat2"
+        threads = str(args.threads)
+        with open_(args.output, 'wb') as bam:
+            yield self.execute(
+                Stage('hisat2', [
+                    exe, '-p', threads, '-x', args.index
+                ] + reads + shlex.split(args.aligner_args),
+                    pass_fds=self.pass_fds),
+                *self.sorted_bam(args, bam))
 
 class StarPipeline(SraPipeline):
+    """With ``--sort star`` (and without ``--dedup``), STAR sorts its own
+    output, holding it all in memory; otherwise its SAM output is sorted by a
+    separate stage.
+    """
+    tools = (('star', 'STAR'),)
+    supports_dedup = True
+    supports_calling = True
+    
+    def outputs(self, args):
+        return self.bam_outputs(args)
+    
+    @contextmanager
+    def context(self, args):
+        if args.share_index:
+            with star_index_manager(args).use(args.index):
+                yield
+        else:
+            yield
+    
     @contextmanager
     def align(self, args, fifo1, fifo2):
         with open_(args.output, 'wb') as bam:
             cmd = shlex.split("""
                 {exe} --runThreadN {threads} --genomeDir {index}
                     --readFilesIn {fifo1} {fifo2}
-                    --outSAMtype BAM SortedByCoordinate
-                    --outStd BAM_SortedByCoordinate
+                    {output}
                     --outMultimapperOrder Random
                     --outSAMunmapped Within KeepPairs
+                    {genome_load}
                     {extra}
             """.format(
                 exe=args.star or "STAR",
@@ -104,18 +377,45 @@ class StarPipeline(SraPipeline):
                 index=args.index,
                 fifo1=fifo1,
                 fifo2=fifo2,
+                output=(
+                    '--outSAMtype SAM --outStd SAM' if self.sorts(args) else
+                    '--outSAMtype BAM SortedByCoordinate '
+                    '--outStd BAM_SortedByCoordinate'),
+                genome_load=self.genome_load_args(args),
                 extra=args.aligner_args
             ))
-            log.info("Running command: {}".format(' '.join(cmd)))
-            yield Popen(cmd, stdout=bam)
+            if self.sorts(args):
+                yield self.execute(
+                    Stage('star', cmd, pass_fds=self.pass_fds),
+                    *self.sorted_bam(args, bam))
+            else:
+                yield self.execute(
+                    Stage('star', cmd, stdout=bam, pass_fds=self.pass_fds))
+
+    def sorts(self, args):
+        """Whether STAR's output is sorted by a separate stage.
+        """
+        return self.dedup is not None or sort_method(args) != 'star'
+
+    def genome_load_args(self, args):
+        """With --share-index, the genome is loaded into shared memory by the
+        index manager, and STAR attaches to it. STAR requires an explicit sort
+        memory limit in that case.
+        """
+        if not args.share_index:
+            return ''
+        return '--genomeLoad LoadAndKeep --limitBAMsortRAM {}'.format(
+            STAR_BAM_SORT_RAM)
 
 class KallistoPipeline(SraPipeline):
+    tools = (('kallisto', 'kallisto'),)
+    
     @contextmanager
     def align(self, args, fifo1, fifo2):
         libtype = ''
-        if 'F' in args.libtype:
+        if 'F' in args.library_type:
             libtype = '--fr-stranded'
-        elif 'R' in args.libtype:
+        elif 'R' in args.library_type:
             libtype = '--rf-stranded'
         cmd = shlex.split("""
             {exe} quant -t {threads} -i {index} -o {output}
@@ -129,10 +429,12 @@ class KallistoPipeline(SraPipeline):
             extra=args.aligner_args,
             fifo1=fifo1,
             fifo2=fifo2))
-        log.info("Running command: {}".format(' '.join(cmd)))
-        yield Popen(cmd)
+        yield self.execute(
+            Stage('kallisto', cmd, pass_fds=self.pass_fds))
 
 class SalmonPipeline(SraPipeline):
+    tools = (('salmon', 'salmon'),)
+    
     @contextmanager
     def align(self, args, fifo1, fifo2):
         cmd = shlex.split("""
@@ -142,35 +444,146 @@ class SalmonPipeline(SraPipeline):
             exe=args.salmon or 'salmon',
             threads=args.threads,
             index=args.index,
-            libtype=args.libtype,
+            libtype=args.library_type,
             output=args.output,
             extra=args.aligner_args,
             fifo1=fifo1,
             fifo2=fifo2))
-        log.info("Running command: {}".format(' '.join(cmd)))
-        yield Popen(cmd)
+        yield self.execute(
+            Stage('salmon', cmd, pass_fds=self.pass_fds))
+
+class FanoutPipeline(object):
+    """Runs several SraPipelines on one stream of reads (``-p star,salmon``).
+    The reads are read (and filtered) once, and every batch is written to all
+    of the aligners through a :class:`TeeTransport`, so the slowest aligner
+    sets the pace of the others.
+
+    ``--output`` and ``--index`` are comma-separated lists with one item per
+    pipeline, in the same order as ``--pipeline`` (a single index is used by
+    all of them). ``--aligner-args`` is passed to every aligner, unless
+    ``--tool-args NAME ARGS`` is given for that pipeline.
+
+    Args:
+        names: Names of the pipelines, in the order of the outputs
+    """
+    def __init__(self, names):
+        for name in names:
+            pipeline = pipelines[name]
+            if not (isclass(pipeline) and issubclass(pipeline, SraPipeline)):
+                raise ValueError(
+                    "The {} pipeline can't share its reads with other "
+                    "pipelines".format(name))
+        if len(set(names)) != len(names):
+            raise ValueError("Each pipeline can only be run once")
+        self.names = names
+    
+    def split_args(self, args):
+        """Returns a Namespace for each pipeline, with its own output, index
+        and aligner args.
+        """
+        if args.dedup:
+            raise ValueError("--dedup is not supported with several pipelines")
+        if args.output == '-':
+            raise ValueError(
+                "Several pipelines need an --output for each of them")
+        outputs = args.output.split(',')
+        indexes = args.index.split(',') if args.index else [None]
+        if len(indexes) == 1:
+            indexes = indexes * len(self.names)
+        if len(outputs) != len(self.names) or len(indexes) != len(self.names):
+            raise ValueError(
+                "--output and --index must have one item for each of the "
+                "pipelines {}".format(args.pipeline))
+        tool_args = dict(getattr(args, 'tool_args', None) or ())
+        pipeline_args = []
+        for name, output, index in zip(self.names, outputs, indexes):
+            pargs = Namespace(**vars(args))
+            pargs.pipeline = name
+            pargs.output = output
+            pargs.index = index
+            pargs.aligner_args = tool_args.get(name, args.aligner_args)
+            pipeline_args.append(pargs)
+        return pipeline_args
+    
+    def run(self, args):
+        """Run the pipelines whose outputs are not in the cache
+        (``--cache-dir``), each cached by the same key as if it ran alone.
+        """
+        cache = open_cache(args)
+        todo = []
+        for name, pargs in zip(self.names, self.split_args(args)):
+            pipeline = pipelines[name]()
+            key = pipeline.cache_key(cache, pargs)
+            if not cache.get(key, pipeline.outputs(pargs)):
+                todo.append((pipeline, pargs, key))
+        if len(todo) == 1:
+            pipeline, pargs, key = todo[0]
+            pipeline(pargs)
+        elif todo:
+            self.fanout(
+                args, [(pipeline, pargs) for pipeline, pargs, key in todo])
+        for pipeline, pargs, key in todo:
+            cache.put(key, pipeline.outputs(pargs))
+    
+    def __call__(self, args):
+        self.fanout(args, [
+            (pipelines[name](), pargs)
+            for name, pargs in zip(self.names, self.split_args(args))])
+    
+    def fanout(self, args, runs):
+        """Stream the reads to several pipelines at once.
+
+        Args:
+            args: a Namespace object
+            runs: List of (SraPipeline, Namespace) for each pipeline
+        """
+        with ExitStack() as stack:
+            for pipeline, pargs in runs:
+                stack.enter_context(pipeline.context(pargs))
+            workdir = str(stack.enter_context(
+                TempDir(dir=args.temp_dir)).absolute_path)
+            transport_class = transports[args.transport]
+            for pipeline, pargs in runs:
+                path = os.path.join(workdir, pargs.pipeline)
+                os.mkdir(path)
+                pipeline.transport = transport_class(
+                    path, args.buffer_mb, name=pargs.pipeline)
+            tee = stack.enter_context(TeeTransport(
+                [pipeline.transport for pipeline, pargs in runs]))
+            sizer = batch_sizer(args, tee)
+            tee.start(ReaderSource(
+                open_reads(args, show_progress(args), sizer=sizer), sizer,
+                tee.max_batch_bytes))
+            align_procs = [
+                stack.enter_context(
+                    pipeline.align(pargs, *pipeline.transport.paths))
+                for pipeline, pargs in runs]
+            for align_proc in align_procs:
+                align_proc.wait()
 
 def sra_to_fastq_pipeline(args):
-    """Just dump reads from SRA to fastq files.
+    """Just dump reads to fastq files.
     """
-    sra_dump(
-        args.sra_accession, args.output, compression=args.compression, 
-        batch_size=args.batch_size, max_reads=args.max_reads)
+    suffix = '.{}'.format(args.compression) if args.compression else ''
+    sizer = batch_sizer(args)
+    with open_('{}.1.fq{}'.format(args.output, suffix), 'wb') as out1, \
+            open_('{}.2.fq{}'.format(args.output, suffix), 'wb') as out2:
+        ReaderSource(open_reads(args, sizer=sizer), sizer)(out1, out2)
 
 def head_pipeline(args):
     """Just print the first ``max_reads`` reads.
     """
-    batcher = Batcher(
-        item_limit=args.max_reads or 10,
-        batch_size=args.batch_size,
-        progress=False)
-    for read1, read2 in SraReader(args.sra_accession, batcher):
-        print(read1[0] + ':')
-        print('  ' + '\t'.join(read1[1:]))
-        print('  ' + '\t'.join(read2[1:]))
+    for batch1, batch2 in open_reader(args, max_reads=args.max_reads or 10):
+        lines = []
+        for (name, seq1, qual1), (_, seq2, qual2) in zip(batch1, batch2):
+            lines.extend((
+                name + b':', b'  ' + seq1 + b'\t' + qual1,
+                b'  ' + seq2 + b'\t' + qual2))
+        if lines:
+            sys.stdout.write(b'\n'.join(lines).decode() + '\n')
 
 pipelines = dict(
-    hisat=hisat_pipeline,
+    hisat=HisatPipeline,
     star=StarPipeline,
     kallisto=KallistoPipeline,
     salmon=SalmonPipeline,
@@ -187,6 +600,34 @@ def list_pipelines():
     """
     return list(pipelines.keys())
 
+def pipeline_names(value):
+    """Parse the value of ``--pipeline``: a pipeline name, or a
+    comma-separated list of SRA pipelines to run on the same reads.
+
+    Returns:
+        ``value``
+
+    Raises:
+        ArgumentTypeError if a name is not a pipeline
+    """
+    for name in value.split(','):
+        if name not in pipelines:
+            raise ArgumentTypeError(
+                "invalid pipeline: {} (choose from {})".format(
+                    name, ', '.join(list_pipelines())))
+    return value
+
+def get_pipeline(name):
+    """Returns the pipeline for a value of ``--pipeline``: a pipeline class
+    instance or function, or a FanoutPipeline for a list of names.
+    """
+    if ',' in name:
+        return FanoutPipeline(name.split(','))
+    pipeline = pipelines[name]
+    if isclass(pipeline):
+        pipeline = pipeline()
+    return pipeline
+
 def run_pipeline(args):
     """Run a pipeline using a set of command-line args.
     
@@ -194,10 +635,35 @@ def run_pipeline(args):
         args: a Namespace object
     """
     setup_logging(args)
-    pipeline = pipelines[args.pipeline]
-    if isclass(pipeline):
-        pipeline = pipeline()
-    pipeline(args)
+    pipeline = get_pipeline(args.pipeline)
+    start_time = time.time()
+    with telemetry(args):
+        if getattr(args, 'caller', None):
+            align_and_call(pipeline, args)
+        elif isinstance(pipeline, (SraPipeline, FanoutPipeline)):
+            pipeline.run(args)
+        else:
+            pipeline(args)
+    log.info("{} pipeline -- {:.1f} seconds".format(
+        args.pipeline, time.time() - start_time))
+
+def sort_method(args):
+    """Returns how the BAM of ``args.pipeline`` is sorted: ``--sort`` if it
+    was given; otherwise 'native' when calling variants while aligning (which
+    needs it), and the pipeline's default (STAR's own sort, or sambamba)
+    when not.
+    """
+    if args.sort:
+        return args.sort
+    if getattr(args, 'caller', None):
+        return 'native'
+    return DEFAULT_SORT.get(args.pipeline, 'sambamba')
+
+def show_progress(args):
+    """Whether to show a progress bar while reading from SRA.
+    """
+    return args.progress and (
+        not args.quiet or args.log_level == 'ERROR' or args.log_file)
 
 def setup_logging(args):
     if not logging.root.handlers:
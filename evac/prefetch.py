@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+"""Prefetching of SRA reads over several connections, with a local cache.
+
+:class:`evac.readers.SraReads` pulls an accession as one sequential stream, so
+its throughput is that of a single connection. With ``--prefetch N``, the
+reads are instead split into chunks of ``--chunk-reads`` consecutive read
+indexes, which N threads (one connection each) fetch concurrently. Chunks are
+handed to the pipeline in order, and at most ``2 * N`` of them are held in
+memory, so a slow chunk only holds up the pipeline and not the fetches behind
+it.
+
+With ``--sra-cache DIR``, every chunk is also stored on disk, and a later run
+on the same accession reads its chunks from there instead of fetching them.
+Chunk boundaries are multiples of ``--chunk-reads`` whatever ``--max-reads``
+is, so a run on the first million reads reuses the chunks of an earlier run on
+all of them. The cache is kept within ``--sra-cache-size`` by deleting the
+least recently used chunks.
+
+Chunks come from a :class:`ReadSource`: :class:`NgsSource` reads from SRA
+with the NGS SDK, and :class:`ArchiveSource` reads from a local directory of
+FASTQ files laid out like the output of ``fastq-dump --split-files``, which
+stands in for SRA in tests and benchmarks.
+"""
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+from evac.readers import Reader, _fastq_batch
+from evac.reads import ReadBatch
+from evac.telemetry import active
+
+log = logging.getLogger()
+
+class ReadSource(object):
+    """Random access to the read pairs of an accession by read index. Methods
+    may be called from several threads at once.
+    """
+    # Identifies the reads in the chunk cache
+    key = None
+
+    def read_count(self):
+        """Returns the number of read pairs.
+        """
+        raise NotImplementedError()
+
+    def fetch(self, start, stop):
+        """Fetch the read pairs with (0-based) indexes in ``[start, stop)``.
+
+        Returns:
+            A tuple (batch1, batch2) of ReadBatches
+        """
+        raise NotImplementedError()
+
+class NgsSource(ReadSource):
+    """Reads an SRA accession with the NGS SDK. Each thread keeps its own
+    connection open.
+
+    Args:
+        accession: The SRA accession
+    """
+    def __init__(self, accession):
+        self.accession = self.key = accession
+        self.local = threading.local()
+
+    def _run(self):
+        run = getattr(self.local, 'run', None)
+        if run is None:
+            from ngs import NGS
+            run = self.local.run = NGS.openReadCollection(self.accession)
+        return run
+
+    def read_count(self):
+        return self._run().getReadCount()
+
+    def fetch(self, start, stop):
+        from ngs.Read import Read
+        records1 = []
+        records2 = []
+        # NGS read IDs are 1-based
+        with self._run().getReadRange(start + 1, stop - start, Read.all) as read:
+            while read.nextRead():
+                name = read.getReadName() or read.getReadId()
+                fragments = []
+                while read.nextFragment():
+                    fragments.append((
+                        name, read.getFragmentBases(),
+                        read.getFragmentQualities()))
+                if len(fragments) != 2:
+                    raise ValueError("{} is not paired-end: read {} has {} "
+                        "fragments".format(
+                            self.accession, read.getReadId(), len(fragments)))
+                records1.append(fragments[0])
+                records2.append(fragments[1])
+        return ReadBatch.from_records(records1), ReadBatch.from_records(records2)
+
+class ArchiveSource(ReadSource):
+    """Reads an accession from a local directory holding
+    ``<accession>_1.fastq`` and ``<accession>_2.fastq`` (uncompressed, so that
+    any range of reads can be read without reading what comes before it).
+
+    Args:
+        root: The archive directory
+        accession: The accession
+        latency: Seconds to wait before every fetch, to simulate the latency
+            of a remote archive
+    """
+    def __init__(self, root, accession, latency=0.0):
+        self.paths = tuple(
+            os.path.join(root, '{}_{}.fastq'.format(accession, mate))
+            for mate in (1, 2))
+        for path in self.paths:
+            if not os.path.exists(path):
+                raise ValueError("{} is not in the archive {}".format(
+                    accession, root))
+        self.key = accession
+        self.latency = latency
+        self.lock = threading.Lock()
+        self._offsets = None
+
+    def offsets(self):
+        """Returns, for each mate, an array of the file offset of every read
+        (plus the end of the file).
+        """
+        with self.lock:
+            if self._offsets is None:
+                self._offsets = tuple(
+                    _record_offsets(path) for path in self.paths)
+                if len(self._offsets[0]) != len(self._offsets[1]):
+                    raise ValueError(
+                        "FASTQ files have different numbers of reads")
+        return self._offsets
+
+    def read_count(self):
+        return len(self.offsets()[0]) - 1
+
+    def fetch(self, start, stop):
+        if self.latency:
+            time.sleep(self.latency)
+        batches = []
+        for path, offsets in zip(self.paths, self.offsets()):
+            with open(path, 'rb') as inp:
+                inp.seek(offsets[start])
+                data = inp.read(offsets[stop] - offsets[start])
+            batches.append(_fastq_batch(data.splitlines()))
+        return tuple(batches)
+
+def _record_offsets(path):
+    offsets = array('q')
+    offset = 0
+    with open(path, 'rb') as inp:
+        for i, line in enumerate(inp):
+            if i % 4 == 0:
+                offsets.append(offset)
+            offset += len(line)
+    offsets.append(offset)
+    return offsets
+
+class ChunkCache(object):
+    """On-disk cache of chunks of reads, evicting the least recently used
+    chunks to stay within a size limit. Several processes may share a cache
+    directory.
+
+    Args:
+        root: Cache directory
+        max_bytes: Size limit, or None for no limit
+    """
+    def __init__(self, root, max_bytes=None):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, key, start, stop):
+        return os.path.join(
+            self.root, key.replace(os.sep, '_'),
+            '{:012d}-{:012d}.chunk'.format(start, stop))
+
+    def get(self, key, start, stop):
+        """Returns the cached (batch1, batch2) for a range of reads, or None
+        if it is not cached.
+        """
+        path = self.path(key, start, stop)
+        try:
+            with open(path, 'rb') as inp:
+                batches = pickle.load(inp)
+        except FileNotFoundError:
+            return None
+        except (EOFError, pickle.UnpicklingError):
+            log.warning("Removing corrupt cache chunk {}".format(path))
+            _remove(path)
+            return None
+        # The modification time is the time of last use
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return batches
+
+    def put(self, key, start, stop, batches):
+        """Store (batch1, batch2) for a range of reads, then evict the least
+        recently used chunks if the cache is over its size limit.
+        """
+        path = self.path(key, start, stop)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(
+            prefix='.put.', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                pickle.dump(batches, out, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, path)
+        finally:
+            _remove(tmp)
+        self.evict()
+
+    def evict(self):
+        """Delete the least recently used chunks until the cache is within
+        its size limit.
+        """
+        if self.max_bytes is None:
+            return
+        with self.lock:
+            chunks = []
+            for dirpath, dirnames, filenames in os.walk(self.root):
+                for name in filenames:
+                    if not name.endswith('.chunk'):
+                        continue
+                    path = os.path.join(dirpath, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    chunks.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for mtime, size, path in chunks)
+            chunks.sort()
+            for mtime, size, path in chunks:
+                if total <= self.max_bytes:
+                    break
+                log.debug("Evicting cache chunk {}".format(path))
+                _remove(path)
+                total -= size
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+class Prefetcher(object):
+    """Fetches chunks of reads from a source concurrently and generates them
+    in order.
+
+    Args:
+        source: The ReadSource
+        cache: Optional ChunkCache
+        connections: Number of chunks to fetch at once
+        chunk_reads: Number of read pairs in each chunk
+        max_reads: Stop after the chunk that contains this many reads
+        retries: Number of times to retry a failed fetch
+    """
+    def __init__(
+            self, source, cache=None, connections=4, chunk_reads=100000,
+            max_reads=None, retries=3):
+        self.source = source
+        self.cache = cache
+        self.connections = connections
+        self.chunk_reads = chunk_reads
+        self.max_reads = max_reads
+        self.retries = retries
+
+    def ranges(self):
+        """Returns the (start, stop) of each chunk to fetch.
+        """
+        count = self.source.read_count()
+        if self.max_reads is not None:
+            end = min(count, self.max_reads)
+        else:
+            end = count
+        return [
+            (start, min(start + self.chunk_reads, count))
+            for start in range(0, end, self.chunk_reads)]
+
+    def chunks(self):
+        """Generate a tuple (batch1, batch2, cached) for each chunk, in
+        order, where ``cached`` is whether the chunk came from the cache.
+        """
+        ranges = iter(self.ranges())
+        pool = ThreadPoolExecutor(self.connections)
+        pending = []
+        try:
+            for start, stop in ranges:
+                pending.append(pool.submit(self._fetch, start, stop))
+                if len(pending) >= 2 * self.connections:
+                    break
+            while pending:
+                result = pending.pop(0).result()
+                for start, stop in ranges:
+                    pending.append(pool.submit(self._fetch, start, stop))
+                    break
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=True)
+
+    def _fetch(self, start, stop):
+        key = self.source.key
+        if self.cache is not None:
+            batches = self.cache.get(key, start, stop)
+            if batches is not None:
+                return batches + (True,)
+        for attempt in range(self.retries + 1):
+            try:
+                batches = self.source.fetch(start, stop)
+                break
+            except Exception as err:
+                if attempt == self.retries:
+                    raise
+                log.warning(
+                    "Fetching reads {}-{} of {} failed ({}); retrying".format(
+                        start, stop, key, err))
+                time.sleep(2 ** attempt)
+        if len(batches[0]) != stop - start:
+            raise ValueError("Expected {} reads from {}, got {}".format(
+                stop - start, key, len(batches[0])))
+        if self.cache is not None:
+            self.cache.put(key, start, stop, batches)
+        return tuple(batches) + (False,)
+
+class PrefetchReads(Reader):
+    """Reads pairs from a ReadSource through a Prefetcher. The number of
+    chunks fetched and read from the cache are counted in the
+    'chunks_fetched' and 'chunks_cached' telemetry counters.
+
+    Args:
+        source: The ReadSource
+        cache: Optional ChunkCache
+        connections: Number of chunks to fetch at once
+        chunk_reads: Number of read pairs in each chunk
+    """
+    def __init__(
+            self, source, cache=None, connections=4, chunk_reads=100000,
+            **kwargs):
+        super(PrefetchReads, self).__init__(**kwargs)
+        self.source = source
+        self.cache = cache
+        self.connections = connections
+        self.chunk_reads = chunk_reads
+        self.fetched = active().counter('chunks_fetched')
+        self.cached = active().counter('chunks_cached')
+
+    def batches(self):
+        prefetcher = Prefetcher(
+            self.source, self.cache, self.connections, self.chunk_reads,
+            self.max_reads)
+        fetched = cached = 0
+        try:
+            for chunk1, chunk2, from_cache in prefetcher.chunks():
+                if from_cache:
+                    cached += 1
+                    self.cached.add()
+                else:
+                    fetched += 1
+                    self.fetched.add()
+                start = 0
+                while start < len(chunk1):
+                    stop = start + self.batch_size
+                    yield chunk1[start:stop], chunk2[start:stop]
+                    start = stop
+        finally:
+            log.info(
+                "Fetched {} chunks of {} and read {} from the cache".format(
+                    fetched, self.source.key, cached))
+
+def prefetching(args):
+    """Whether a set of command-line args asks for prefetching.
+    """
+    return bool(
+        getattr(args, 'prefetch', 0) or getattr(args, 'sra_cache', None) or
+        getattr(args, 'sra_archive', None))
+
+def prefetch_reader(args, **kwargs):
+    """Create a PrefetchReads for ``args.sra_accession``, reading from
+    ``args.sra_archive`` if it is set, otherwise from SRA.
+
+    Args:
+        args: a Namespace object
+        kwargs: Additional arguments to the Reader
+
+    Returns:
+        A PrefetchReads
+    """
+    if args.sra_archive:
+        source = ArchiveSource(args.sra_archive, args.sra_accession)
+    else:
+        source = NgsSource(args.sra_accession)
+    cache = None
+    if args.sra_cache:
+        from evac.scheduler import parse_size
+        cache = ChunkCache(args.sra_cache, parse_size(args.sra_cache_size))
+    return PrefetchReads(
+        source, cache, max(1, args.prefetch), args.chunk_reads, **kwargs)
@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+"""Readers that stream batches of paired reads from SRA or local files.
+
+Every reader is an iterable of ``(batch1, batch2)`` tuples of
+:class:`evac.reads.ReadBatch`. Local files are read and decompressed in worker
+threads (one per file), so that decompression of both mates overlaps with
+parsing in the main thread.
+"""
+import gzip
+import logging
+from queue import Queue
+import struct
+from subprocess import Popen, PIPE, CalledProcessError
+from threading import Thread
+from xphyle import open_
+from evac.batching import FixedBatchSize
+from evac.reads import ReadBatch
+
+log = logging.getLogger()
+
+CHUNK_SIZE = 1024 * 1024
+
+class Reader(object):
+    """Base class for readers.
+
+    Args:
+        batch_size: Number of read pairs in each batch, or a batch sizer (see
+            :mod:`evac.batching`) that is asked for the size of every batch
+        max_reads: Maximum number of read pairs to read
+    """
+    def __init__(self, batch_size=1000, max_reads=None):
+        if isinstance(batch_size, int):
+            batch_size = FixedBatchSize(batch_size)
+        self.sizer = batch_size
+        self.max_reads = max_reads
+
+    @property
+    def batch_size(self):
+        """The size of the next batch.
+        """
+        return self.sizer.size
+
+    def __iter__(self):
+        remaining = self.max_reads
+        batches = self.batches()
+        try:
+            for batch1, batch2 in batches:
+                if remaining is not None:
+                    if len(batch1) >= remaining:
+                        if remaining > 0:
+                            yield batch1[:remaining], batch2[:remaining]
+                        return
+                    remaining -= len(batch1)
+                yield batch1, batch2
+        finally:
+            # Stop any work the reader does ahead of the batches it has
+            # generated, e.g. prefetching
+            batches.close()
+
+    def batches(self):
+        """Generate (batch1, batch2) tuples, ignoring ``max_reads``.
+        """
+        raise NotImplementedError()
+
+class SraReads(Reader):
+    """Reads pairs from an SRA accession.
+
+    Args:
+        accession: The SRA accession
+        progress: Whether to show a progress bar
+    """
+    def __init__(self, accession, progress=False, **kwargs):
+        super(SraReads, self).__init__(**kwargs)
+        self.accession = accession
+        self.progress = progress
+
+    def batches(self):
+        from srastream import SraReader
+        from srastream.utils import Batcher
+        batcher = Batcher(
+            item_limit=self.max_reads,
+            batch_size=self.sizer.initial,
+            progress=self.progress)
+        batch1 = []
+        batch2 = []
+        for read1, read2 in SraReader(self.accession, batcher):
+            batch1.append(read1)
+            batch2.append(read2)
+            if len(batch1) >= self.batch_size:
+                yield ReadBatch.from_records(batch1), ReadBatch.from_records(batch2)
+                batch1 = []
+                batch2 = []
+        if batch1:
+            yield ReadBatch.from_records(batch1), ReadBatch.from_records(batch2)
+
+class ChunkStream(object):
+    """Reads a binary file in a worker thread and hands over chunks through a
+    bounded queue.
+
+    Args:
+        opener: Callable that returns an open binary file
+        chunk_size: Size of chunks to read
+        queue_size: Maximum number of chunks to buffer
+    """
+    def __init__(self, opener, chunk_size=CHUNK_SIZE, queue_size=8):
+        self.opener = opener
+        self.chunk_size = chunk_size
+        self.queue = Queue(queue_size)
+        self.thread = Thread(target=self._read)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _read(self):
+        try:
+            with self.opener() as inp:
+                while True:
+                    chunk = inp.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    self.queue.put(chunk)
+        except Exception as err:
+            self.queue.put(err)
+        self.queue.put(None)
+
+    def __iter__(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+def _fastq_batches(stream, sizer, scale=1):
+    """Parse a stream of FASTQ chunks into ReadBatches of ``scale`` times the
+    size given by ``sizer``.
+    """
+    lines = []
+    partial = b''
+    for chunk in stream:
+        chunk_lines = (partial + chunk).split(b'\n')
+        partial = chunk_lines.pop()
+        lines.extend(chunk_lines)
+        size = 4 * scale * sizer.size
+        while len(lines) >= size:
+            yield _fastq_batch(lines[:size])
+            del lines[:size]
+            size = 4 * scale * sizer.size
+    if partial:
+        lines.append(partial)
+    # Ignore the empty lines at the end of the file
+    while lines and not lines[-1].strip():
+        lines.pop()
+    if len(lines) % 4 != 0:
+        raise ValueError("Truncated FASTQ record: {}".format(lines[-1]))
+    if lines:
+        yield _fastq_batch(lines)
+
+def _fastq_batch(lines):
+    if lines[0][:1] != b'@':
+        raise ValueError("Invalid FASTQ header: {}".format(lines[0]))
+    names = [line[1:].rstrip(b'\r') for line in lines[0::4]]
+    seqs = [line.rstrip(b'\r') for line in lines[1::4]]
+    quals = [line.rstrip(b'\r') for line in lines[3::4]]
+    return ReadBatch.from_lists(names, seqs, quals)
+
+class FastqReader(Reader):
+    """Reads pairs from local FASTQ files. Compression (gzip, bgzip, zstd,
+    ...) is detected from the file names.
+
+    Args:
+        path1: Path to the mate 1 FASTQ, or to an interleaved FASTQ if
+            ``path2`` is None
+        path2: Path to the mate 2 FASTQ
+    """
+    def __init__(self, path1, path2=None, **kwargs):
+        super(FastqReader, self).__init__(**kwargs)
+        self.path1 = path1
+        self.path2 = path2
+
+    def _stream(self, path):
+        return ChunkStream(lambda: open_(path, 'rb'))
+
+    def batches(self):
+        if self.path2 is None:
+            for batch in _fastq_batches(
+                    self._stream(self.path1), self.sizer, 2):
+                yield batch[0::2], batch[1::2]
+        else:
+            # The sizer only changes between pairs of batches, so both mates
+            # get the same size. Unlike zip(), stop only once both files are
+            # exhausted, so that extra reads in either one are an error.
+            batches1 = _fastq_batches(self._stream(self.path1), self.sizer)
+            batches2 = _fastq_batches(self._stream(self.path2), self.sizer)
+            while True:
+                batch1 = next(batches1, None)
+                batch2 = next(batches2, None)
+                if batch1 is None and batch2 is None:
+                    return
+                if (batch1 is None or batch2 is None or
+                        len(batch1) != len(batch2)):
+                    raise ValueError("FASTQ files have different numbers of reads")
+                yield batch1, batch2
+
+# BAM decoding
+
+BAM_MAGIC = b'BAM\1'
+BAM_SEQ = [
+    (a + b).encode()
+    for a in '=ACMGRSVTWYHKDBN'
+    for b in '=ACMGRSVTWYHKDBN']
+BAM_QUAL = bytes((q + 33) if q < 94 else 0x3f for q in range(256))
+BAM_CORE = struct.Struct('<iiBBHHHiiii')
+FLAG_REVERSE = 0x10
+FLAG_READ1 = 0x40
+FLAG_READ2 = 0x80
+FLAG_SKIP = 0x100 | 0x800 # secondary, supplementary
+COMPLEMENT = bytes.maketrans(b'ACGTNacgtn', b'TGCAntgcan')
+
+class BamParser(object):
+    """Parses reads from a stream of decompressed BAM chunks.
+    """
+    def __init__(self, stream):
+        self.chunks = iter(stream)
+        self.buf = b''
+        self.pos = 0
+
+    def _ensure(self, size):
+        """Make sure at least ``size`` bytes are available in the buffer.
+        Returns False at the end of the stream.
+        """
+        while len(self.buf) - self.pos < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return False
+            self.buf = self.buf[self.pos:] + chunk
+            self.pos = 0
+        return True
+
+    def _read(self, size):
+        if not self._ensure(size):
+            raise ValueError("Truncated BAM file")
+        start = self.pos
+        self.pos += size
+        return self.buf[start:self.pos]
+
+    def read_header(self):
+        if self._read(4) != BAM_MAGIC:
+            raise ValueError("Not a BAM file")
+        l_text = struct.unpack('<i', self._read(4))[0]
+        self._read(l_text)
+        n_ref = struct.unpack('<i', self._read(4))[0]
+        for i in range(n_ref):
+            l_name = struct.unpack('<i', self._read(4))[0]
+            self._read(l_name + 4)
+
+    def __iter__(self):
+        """Generate (flag, name, sequence, qualities) tuples.
+        """
+        self.read_header()
+        while self._ensure(4):
+            block_size = struct.unpack_from('<i', self.buf, self.pos)[0]
+            self.pos += 4
+            if not self._ensure(block_size):
+                raise ValueError("Truncated BAM record")
+            buf, pos = self.buf, self.pos
+            (refid, refpos, l_read_name, mapq, bin_, n_cigar, flag, l_seq,
+             next_refid, next_pos, tlen) = BAM_CORE.unpack_from(buf, pos)
+            offset = pos + BAM_CORE.size
+            name = buf[offset:offset + l_read_name - 1]
+            offset += l_read_name + 4 * n_cigar
+            seq_size = (l_seq + 1) // 2
+            seq = b''.join(
+                BAM_SEQ[b] for b in buf[offset:offset + seq_size])[:l_seq]
+            offset += seq_size
+            qual = buf[offset:offset + l_seq].translate(BAM_QUAL)
+            self.pos += block_size
+            if flag & FLAG_REVERSE:
+                seq = seq.translate(COMPLEMENT)[::-1]
+                qual = qual[::-1]
+            yield flag, name, seq, qual
+
+def _bam_batches(records, sizer):
+    """Pair up BAM records (which must be grouped by name, as in an unaligned
+    BAM) and generate batches of the size given by ``sizer``.
+    """
+    batch1 = ([], [], [])
+    batch2 = ([], [], [])
+    pending = None
+    for record in records:
+        flag = record[0]
+        if flag & FLAG_SKIP:
+            continue
+        if pending is None:
+            pending = record
+            continue
+        if pending[1] != record[1]:
+            raise ValueError("Unpaired read {}; the BAM file must be "
+                             "grouped by read name".format(pending[1]))
+        if flag & FLAG_READ1:
+            pending, record = record, pending
+        for lists, mate in ((batch1, pending), (batch2, record)):
+            for values, value in zip(lists, mate[1:]):
+                values.append(value)
+        pending = None
+        if len(batch1[0]) >= sizer.size:
+            yield ReadBatch.from_lists(*batch1), ReadBatch.from_lists(*batch2)
+            batch1 = ([], [], [])
+            batch2 = ([], [], [])
+    if pending is not None:
+        raise ValueError("Unpaired read {}".format(pending[1]))
+    if batch1[0]:
+        yield ReadBatch.from_lists(*batch1), ReadBatch.from_lists(*batch2)
+
+class BamReader(Reader):
+    """Reads pairs from a local unaligned (name-grouped) BAM file.
+
+    Args:
+        path: Path to the BAM file
+    """
+    def __init__(self, path, **kwargs):
+        super(BamReader, self).__init__(**kwargs)
+        self.path = path
+
+    def _open(self):
+        # BGZF is a series of gzip members, so the gzip module can read it
+        return gzip.open(self.path, 'rb')
+
+    def batches(self):
+        parser = BamParser(ChunkStream(self._open))
+        return _bam_batches(parser, self.sizer)
+
+class SamtoolsReader(BamReader):
+    """Reads pairs from a SAM or CRAM file, which samtools converts to
+    uncompressed BAM.
+
+    Args:
+        path: Path to the SAM/CRAM file
+        samtools: Path to the samtools executable
+    """
+    def __init__(self, path, samtools='samtools', **kwargs):
+        super(SamtoolsReader, self).__init__(path, **kwargs)
+        self.samtools = samtools
+
+    def _open(self):
+        cmd = [self.samtools, 'view', '-u', self.path]
+        log.info("Running command: {}".format(' '.join(cmd)))
+        return ProcessOutput(cmd, Popen(cmd, stdout=PIPE))
+
+class ProcessOutput(object):
+    """Binary file object over the BGZF-compressed stdout of a process. At the
+    end of the stream, raises CalledProcessError if the process failed, so
+    that a failed conversion (e.g. a CRAM whose reference is missing) is not
+    mistaken for the end of the reads.
+    """
+    def __init__(self, cmd, proc):
+        self.cmd = cmd
+        self.proc = proc
+        self.stream = gzip.GzipFile(fileobj=proc.stdout, mode='rb')
+
+    def read(self, size=-1):
+        try:
+            data = self.stream.read(size)
+        except (EOFError, OSError):
+            # A truncated stream, most likely because the process died
+            self._check()
+            raise
+        if not data and size != 0:
+            self._check()
+        return data
+
+    def _check(self):
+        self.close()
+        if self.proc.wait() != 0:
+            raise CalledProcessError(self.proc.returncode, self.cmd)
+
+    def close(self):
+        self.stream.close()
+        self.proc.stdout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def open_reader(args, progress=False, max_reads=None, sizer=None):
+    """Create a reader for the input specified by a set of command-line args:
+    local files if ``args.input`` is set, otherwise ``args.sra_accession``
+    (prefetched in chunks if ``args.prefetch``, ``args.sra_cache`` or
+    ``args.sra_archive`` is set; see :mod:`evac.prefetch`).
+
+    Args:
+        args: a Namespace object
+        progress: Whether to show a progress bar (SRA only)
+        max_reads: Maximum number of read pairs to read; defaults to
+            ``args.max_reads``
+        sizer: Batch sizer; defaults to a fixed ``args.batch_size``
+
+    Returns:
+        A Reader
+    """
+    kwargs = dict(
+        batch_size=sizer or args.batch_size,
+        max_reads=max_reads or args.max_reads)
+    paths = args.input
+    if not paths:
+        from evac.prefetch import prefetch_reader, prefetching
+        if prefetching(args):
+            return prefetch_reader(args, **kwargs)
+        return SraReads(args.sra_accession, progress=progress, **kwargs)
+    if len(paths) > 2:
+        raise ValueError("At most two input files may be specified")
+    ext = paths[0].lower().rsplit('.', 1)[-1]
+    if ext in ('bam', 'sam', 'cram') and len(paths) > 1:
+        raise ValueError("Only one {} file may be specified".format(ext))
+    if ext == 'bam':
+        return BamReader(paths[0], **kwargs)
+    if ext in ('sam', 'cram'):
+        return SamtoolsReader(
+            paths[0], samtools=args.samtools or 'samtools', **kwargs)
+    return FastqReader(*paths, **kwargs)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Compact representation of batches of reads.
+"""
+from array import array
+from itertools import accumulate, repeat
+from operator import sub
+
+class ReadBatch(object):
+    """A batch of reads from one mate. Names, sequences and qualities are
+    stored as three contiguous byte strings; ``name_offsets`` and
+    ``seq_offsets`` hold the start of each read (plus the end of the last read)
+    in the name and sequence/quality buffers, respectively.
+
+    Slicing a batch (with a step of 1) does not copy the reads: the slice
+    shares the original buffers, and its offsets (a slice of the original
+    offsets) still point into them, so they need not start at 0.
+
+    Args:
+        names: Concatenated read names
+        seqs: Concatenated read sequences
+        quals: Concatenated base qualities (phred+33)
+        name_offsets: array of ``len(batch) + 1`` offsets into ``names``
+        seq_offsets: array of ``len(batch) + 1`` offsets into ``seqs`` and
+            ``quals``
+    """
+    __slots__ = ('names', 'seqs', 'quals', 'name_offsets', 'seq_offsets')
+
+    def __init__(self, names, seqs, quals, name_offsets, seq_offsets):
+        self.names = names
+        self.seqs = seqs
+        self.quals = quals
+        self.name_offsets = name_offsets
+        self.seq_offsets = seq_offsets
+
+    @classmethod
+    def from_lists(cls, names, seqs, quals):
+        """Create a batch from parallel lists of names, sequences and qualities
+        (as bytes).
+        """
+        return cls(
+            b''.join(names), b''.join(seqs), b''.join(quals),
+            _offsets(names), _offsets(seqs))
+
+    @classmethod
+    def from_records(cls, records):
+        """Create a batch from an iterable of (name, sequence, qualities)
+        tuples, where each element is either str or bytes.
+        """
+        names = []
+        seqs = []
+        quals = []
+        for record in records:
+            name, seq, qual = (
+                field.encode() if isinstance(field, str) else field
+                for field in record[:3])
+            names.append(name)
+            seqs.append(seq)
+            quals.append(qual)
+        return cls.from_lists(names, seqs, quals)
+
+    def __len__(self):
+        return len(self.seq_offsets) - 1
+
+    def __reduce__(self):
+        # A batch sent to another process only copies its own reads
+        nbase, nend = self.name_offsets[0], self.name_offsets[-1]
+        sbase, send = self.seq_offsets[0], self.seq_offsets[-1]
+        return (ReadBatch, (
+            bytes(self.names[nbase:nend]), bytes(self.seqs[sbase:send]),
+            bytes(self.quals[sbase:send]),
+            _rebase(self.name_offsets, nbase),
+            _rebase(self.seq_offsets, sbase)))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return self.from_records(
+                    self[i] for i in range(start, stop, step))
+            return self._view(start, max(start, stop))
+        if index < 0:
+            index += len(self)
+        nstart, nend = self.name_offsets[index], self.name_offsets[index + 1]
+        sstart, send = self.seq_offsets[index], self.seq_offsets[index + 1]
+        return (
+            bytes(self.names[nstart:nend]),
+            bytes(self.seqs[sstart:send]),
+            bytes(self.quals[sstart:send]))
+
+    def _view(self, start, stop):
+        return ReadBatch(
+            self.names, self.seqs, self.quals,
+            self.name_offsets[start:stop + 1],
+            self.seq_offsets[start:stop + 1])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def to_fastq(self):
+        """Format the batch as FASTQ.
+
+        Returns:
+            The FASTQ text, as bytes
+        """
+        size = len(self)
+        if size == 0:
+            return b''
+        # Fill in the separators with slice assignment and only create
+        # objects for the fields: each record contributes [name, '\n', seq,
+        # '\n+\n', qual, '\n@'], and the final '\n@' becomes '\n'.
+        name_spans = list(zip(self.name_offsets, self.name_offsets[1:]))
+        seq_spans = list(zip(self.seq_offsets, self.seq_offsets[1:]))
+        names, seqs, quals = self.names, self.seqs, self.quals
+        pieces = [b'\n@'] * (6 * size + 1)
+        pieces[0] = b'@'
+        pieces[1::6] = [names[start:end] for start, end in name_spans]
+        pieces[2::6] = [b'\n'] * size
+        pieces[3::6] = [seqs[start:end] for start, end in seq_spans]
+        pieces[4::6] = [b'\n+\n'] * size
+        pieces[5::6] = [quals[start:end] for start, end in seq_spans]
+        pieces[-1] = b'\n'
+        return b''.join(pieces)
+
+    def fastq_offsets(self):
+        """Returns the offset of each record (plus the end of the last record)
+        in the FASTQ text of the batch, without formatting it.
+        """
+        # Each record is '@' name '\n' seq '\n+\n' qual '\n'
+        base = self.name_offsets[0] + 2 * self.seq_offsets[0]
+        return [
+            name_offset + 2 * seq_offset + 6 * i - base
+            for i, (name_offset, seq_offset) in enumerate(
+                zip(self.name_offsets, self.seq_offsets))]
+
+def _offsets(items):
+    offsets = array('q', [0])
+    offsets.extend(accumulate(len(item) for item in items))
+    return offsets
+
+def _rebase(offsets, base):
+    if not base:
+        return offsets
+    return array('q', map(sub, offsets, repeat(base)))
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""Genomic intervals: reading them from BED files and BAM headers, and
+splitting them into balanced shards for parallel variant calling.
+
+Intervals are (contig, start, end) tuples with 0-based, half-open coordinates
+(as in BED).
+"""
+import heapq
+import logging
+from subprocess import Popen, PIPE, DEVNULL
+from evac.bamslice import BamSlicer
+from evac.bamsort import record_extent
+
+log = logging.getLogger()
+
+# A cut between the pieces of a large interval is moved to the middle of a
+# stretch of at least MIN_GAP bases that no read covers, at most MAX_SHIFT
+# bases away; the search starts SEARCH_RADIUS bases either side of the cut and
+# widens from there
+MIN_GAP = 500
+MAX_SHIFT = 1000000
+SEARCH_RADIUS = 65536
+
+def read_bed(path):
+    """Read intervals from a BED file.
+
+    Returns:
+        A list of (contig, start, end) tuples
+    """
+    intervals = []
+    with open(path, 'rt') as inp:
+        for line in inp:
+            if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                continue
+            fields = line.split('\t', 3)
+            intervals.append(
+                (fields[0], int(fields[1]), int(fields[2].rstrip())))
+    return intervals
+
+def write_bed(intervals, path):
+    """Write intervals to a BED file.
+    """
+    with open(path, 'wt') as out:
+        for contig, start, end in intervals:
+            out.write('{}\t{}\t{}\n'.format(contig, start, end))
+
+def bam_header(bam, samtools='samtools'):
+    """Returns the SAM header of a BAM file as a string.
+    """
+    cmd = [samtools, 'view', '-H', bam]
+    log.info("Running command: {}".format(' '.join(cmd)))
+    with Popen(cmd, stdout=PIPE, universal_newlines=True) as proc:
+        header = proc.stdout.read()
+    return header
+
+def header_contigs(header):
+    """Parse the contigs and their lengths from a SAM header.
+
+    Returns:
+        A list of (name, length) tuples, in header order
+    """
+    contigs = []
+    for line in header.splitlines():
+        if line.startswith('@SQ'):
+            tags = dict(
+                field.split(':', 1) for field in line.split('\t')[1:]
+                if ':' in field)
+            contigs.append((tags['SN'], int(tags['LN'])))
+    return contigs
+
+def bam_read_counts(bam, samtools='samtools'):
+    """Returns the number of mapped reads on each contig, from the BAM index,
+    or None if the BAM is not indexed.
+    """
+    cmd = [samtools, 'idxstats', bam]
+    log.info("Running command: {}".format(' '.join(cmd)))
+    with Popen(
+            cmd, stdout=PIPE, stderr=DEVNULL,
+            universal_newlines=True) as proc:
+        output = proc.stdout.read()
+    if proc.returncode != 0:
+        log.info("No index for {}; weighting regions by size".format(bam))
+        return None
+    counts = {}
+    for line in output.splitlines():
+        contig, length, mapped, unmapped = line.split('\t')
+        if contig != '*':
+            counts[contig] = int(mapped)
+    return counts
+
+def normalize(intervals, contig_order=None):
+    """Sort intervals by contig (in ``contig_order`` if given, otherwise in
+    order of first appearance) and position, and merge overlapping intervals.
+    Intervals on contigs not in ``contig_order`` are dropped.
+    """
+    if contig_order is None:
+        contig_order = []
+        for contig, start, end in intervals:
+            if contig not in contig_order:
+                contig_order.append(contig)
+    rank = dict((contig, i) for i, contig in enumerate(contig_order))
+    dropped = set(
+        contig for contig, start, end in intervals if contig not in rank)
+    if dropped:
+        log.warning("Ignoring intervals on unknown contigs: {}".format(
+            ', '.join(sorted(dropped))))
+    merged = []
+    for contig, start, end in sorted(
+            (i for i in intervals if i[0] in rank and i[2] > i[1]),
+            key=lambda i: (rank[i[0]], i[1], i[2])):
+        if merged and merged[-1][0] == contig and start <= merged[-1][2]:
+            if end > merged[-1][2]:
+                merged[-1] = (contig, merged[-1][1], end)
+        else:
+            merged.append((contig, start, end))
+    return merged
+
+def interval_weights(intervals, contig_lengths=None, read_counts=None):
+    """Weight intervals by the number of bases they cover, scaled by the read
+    density of their contig if read counts (from the BAM index) are given.
+    """
+    if read_counts is None or contig_lengths is None:
+        return [end - start for contig, start, end in intervals]
+    return [
+        (end - start) * (1 + read_counts.get(contig, 0) /
+                         max(contig_lengths.get(contig, 1), 1))
+        for contig, start, end in intervals]
+
+def split_blocks(intervals, weights, block_weight, snap=None):
+    """Split intervals into blocks of at most ``block_weight``, assuming the
+    weight is uniform along each interval.
+
+    Args:
+        intervals: The intervals
+        weights: The weight of each interval
+        block_weight: The largest weight of a block
+        snap: If given, a function (contig, start, end, cuts) that returns the
+            positions to cut an interval at in place of the evenly spaced
+            ``cuts`` (e.g. a :class:`GapFinder`)
+
+    Returns:
+        A list of (interval, weight) tuples
+    """
+    blocks = []
+    for (contig, start, end), weight in zip(intervals, weights):
+        pieces = max(1, int(-(-weight // block_weight)))
+        step = -(-(end - start) // pieces)
+        cuts = list(range(start + step, end, step))
+        if snap is not None and cuts:
+            cuts = snap(contig, start, end, cuts)
+        bounds = [start] + cuts + [end]
+        for piece_start, piece_end in zip(bounds, bounds[1:]):
+            blocks.append((
+                (contig, piece_start, piece_end),
+                weight * (piece_end - piece_start) / (end - start)))
+    return blocks
+
+class GapFinder(object):
+    """Moves the cuts between the pieces of an interval into stretches that no
+    read of an indexed BAM covers. Cut anywhere else, a caller run on each
+    piece can emit records that straddle the cut (a deletion, or a reference
+    block, that starts in one piece and ends in the next), and then the
+    pieces' outputs can't simply be concatenated. Where there are no reads,
+    there is nothing to call.
+
+    Args:
+        bam: Path of a coordinate-sorted, indexed BAM file
+        min_gap: The shortest stretch without reads to cut in
+        max_shift: How far a cut may move; a cut with no gap that near is
+            dropped, joining the pieces on either side of it
+    """
+    def __init__(self, bam, min_gap=MIN_GAP, max_shift=MAX_SHIFT):
+        self.slicer = BamSlicer(bam)
+        self.min_gap = min_gap
+        self.max_shift = max_shift
+
+    def __call__(self, contig, start, end, cuts):
+        """Returns the cuts of the interval (contig, start, end), each moved
+        into the nearest gap, in order and without duplicates.
+        """
+        moved = set()
+        for cut in cuts:
+            gap = self.nearest(
+                contig, cut, max(start, cut - self.max_shift),
+                min(end, cut + self.max_shift))
+            if gap is None:
+                log.info("No gap in coverage near {}:{}; not cutting "
+                         "there".format(contig, cut))
+            elif start < gap < end:
+                moved.add(gap)
+        return sorted(moved)
+
+    def nearest(self, contig, pos, lo, hi):
+        """Returns the middle of the gap between ``lo`` and ``hi`` that is
+        nearest to ``pos``, or None if there is none.
+        """
+        radius = SEARCH_RADIUS
+        while True:
+            window_lo, window_hi = max(lo, pos - radius), min(hi, pos + radius)
+            middles = [
+                (gap_start + gap_end) // 2 for gap_start, gap_end in
+                self.gaps(contig, window_lo, window_hi)]
+            if middles:
+                return min(middles, key=lambda middle: abs(middle - pos))
+            if window_lo == lo and window_hi == hi:
+                return None
+            radius *= 4
+
+    def gaps(self, contig, lo, hi):
+        """Yields the stretches (start, end) of at least ``min_gap`` bases
+        between ``lo`` and ``hi`` that no mapped read covers. A spliced read
+        covers its introns too.
+        """
+        refid = self.slicer.refids.get(contig)
+        last = lo
+        for record in self.slicer.records([(contig, lo, hi)]):
+            record_refid, beg, stop, unmapped = record_extent(record)
+            if (record_refid != refid or unmapped or beg >= hi or
+                    stop <= last):
+                continue
+            if beg - last >= self.min_gap:
+                yield last, beg
+            last = stop
+        if hi - last >= self.min_gap:
+            yield last, hi
+
+def interleaved_shards(
+        intervals, nshards, weights=None, blocks_per_shard=64):
+    """Split coordinate-sorted, non-overlapping intervals into ``nshards``
+    shards of about equal total weight. The intervals are cut into blocks of
+    equal weight that are dealt out to the shards in turn, so every shard
+    walks the genome at the same pace. That keeps a streaming merge of the
+    shards' outputs from having to buffer one shard while it waits for
+    another.
+
+    Returns:
+        A list of shards, each a coordinate-sorted list of intervals
+    """
+    if weights is None:
+        weights = interval_weights(intervals)
+    total = sum(weights)
+    if not intervals or total <= 0:
+        return [list(intervals)] if intervals else []
+    block_weight = max(total / (nshards * blocks_per_shard), 1)
+    blocks = split_blocks(intervals, weights, block_weight)
+    nshards = min(nshards, len(blocks))
+    shards = [[] for i in range(nshards)]
+    loads = [0] * nshards
+    for interval, weight in blocks:
+        # Deal in turn, but skip ahead of shards that are already heavier
+        i = min(range(nshards), key=lambda s: (loads[s], s))
+        shards[i].append(interval)
+        loads[i] += weight
+    log.info("Split {} intervals into {} shards with weights {}".format(
+        len(intervals), nshards, ', '.join('{:.0f}'.format(w) for w in loads)))
+    return shards
+
+def split_large(intervals, weights, max_weight, snap=None):
+    """Split any interval heavier than ``max_weight`` into equal pieces (or,
+    with ``snap``, pieces cut where it says; see :func:`split_blocks`). Only
+    the heavy intervals are cut, so target intervals from a BED file (which
+    are usually small) are kept whole.
+
+    Returns:
+        A tuple (intervals, weights)
+    """
+    pieces = []
+    for interval, weight in zip(intervals, weights):
+        if weight > max_weight:
+            pieces.extend(
+                split_blocks([interval], [weight], max_weight, snap))
+        else:
+            pieces.append((interval, weight))
+    return [p[0] for p in pieces], [p[1] for p in pieces]
+
+def lpt_shards(intervals, weights, nshards, contig_order=None):
+    """Assign intervals to ``nshards`` shards with the longest-processing-time-
+    first rule: heaviest intervals first, each to the currently lightest
+    shard.
+
+    Returns:
+        A tuple (shards, loads), where each shard is a list of intervals in
+        coordinate order and loads are the total weights of the shards
+    """
+    nshards = max(1, min(nshards, len(intervals)))
+    heap = [(0, i) for i in range(nshards)]
+    shards = [[] for i in range(nshards)]
+    loads = [0] * nshards
+    for interval, weight in sorted(
+            zip(intervals, weights), key=lambda item: -item[1]):
+        load, i = heapq.heappop(heap)
+        shards[i].append(interval)
+        loads[i] = load + weight
+        heapq.heappush(heap, (loads[i], i))
+    rank = dict(
+        (contig, i) for i, contig in enumerate(contig_order or []))
+    for shard in shards:
+        shard.sort(key=lambda i: (rank.get(i[0], len(rank)), i[1]))
+    return shards, loads
+
+def plan_scatter(
+        intervals, weights, nshards, contig_order=None, pieces=4, snap=None):
+    """Plan a balanced scatter: split intervals that are heavier than
+    1/``pieces`` of an ideal shard (where ``snap`` says, if given; see
+    :class:`GapFinder`), then assign them with :func:`lpt_shards`.
+    """
+    total = sum(weights)
+    max_weight = max(total / (nshards * pieces), 1)
+    intervals, weights = split_large(intervals, weights, max_weight, snap)
+    return lpt_shards(intervals, weights, nshards, contig_order)
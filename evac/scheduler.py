@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""Run a pipeline over many SRA accessions at once, packing jobs into a core
+and memory budget.
+"""
+from argparse import Namespace
+from collections import deque
+import logging
+import multiprocessing
+import os
+import re
+import time
+from evac.index import star_index_manager
+from evac.pipeline import (
+    STAR_BAM_SORT_RAM, run_pipeline, setup_logging, sort_method)
+
+log = logging.getLogger()
+
+GB = 1024 ** 3
+
+SIZE_UNITS = dict(K=1024, M=1024 ** 2, G=GB, T=1024 ** 4)
+
+# Approximate resident memory of each pipeline's tool, as a multiple of the
+# on-disk size of its index, plus a fixed per-job overhead in bytes. STAR keeps
+# the whole genome and suffix array in memory, and needs room for sorting.
+FOOTPRINTS = dict(
+    star=(1.0, STAR_BAM_SORT_RAM + 2 * GB),
+    hisat=(1.1, 2 * GB),
+    kallisto=(1.5, 1 * GB),
+    salmon=(1.2, 2 * GB),
+    fastq=(0, GB // 2),
+    head=(0, GB // 2))
+
+# Pipelines whose index can be loaded once into shared memory and used by
+# every job.
+SHARED_INDEX = {'star'}
+
+def parse_size(size):
+    """Parse a memory size such as '256G' or '512M' into bytes.
+    """
+    match = re.match(r'^(\d+(?:\.\d+)?)\s*([KMGT]?)B?$', str(size).upper())
+    if not match:
+        raise ValueError("Invalid size: {}".format(size))
+    value, unit = match.groups()
+    return int(float(value) * SIZE_UNITS.get(unit, 1))
+
+def total_memory():
+    """Returns the physical memory of this machine, in bytes.
+    """
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+def index_size(index):
+    """Returns the on-disk size of an index, which may be a directory (STAR,
+    Salmon), a file (Kallisto) or a prefix of several files (HISAT2).
+    """
+    if index is None:
+        return 0
+    if os.path.isdir(index):
+        return sum(
+            os.path.getsize(os.path.join(root, name))
+            for root, dirs, files in os.walk(index)
+            for name in files)
+    if os.path.isfile(index):
+        return os.path.getsize(index)
+    parent, prefix = os.path.split(index)
+    parent = parent or '.'
+    if not os.path.isdir(parent):
+        return 0
+    return sum(
+        os.path.getsize(os.path.join(parent, name))
+        for name in os.listdir(parent)
+        if name.startswith(prefix))
+
+def read_accessions(path):
+    """Read accessions from a file, one per line. Blank lines and lines
+    starting with '#' are ignored.
+    """
+    with open(path, 'rt') as inp:
+        return [
+            line.split()[0] for line in inp
+            if line.strip() and not line.startswith('#')]
+
+class Job(object):
+    """A pipeline run on one accession.
+    """
+    def __init__(self, accession, args, cores, mem):
+        self.accession = accession
+        self.args = args
+        self.cores = cores
+        self.mem = mem
+        self.attempts = 0
+        self.proc = None
+        self.start_time = None
+
+    def start(self):
+        self.attempts += 1
+        self.start_time = time.time()
+        self.proc = multiprocessing.Process(
+            target=run_pipeline, args=(self.args,),
+            name=self.accession)
+        self.proc.start()
+
+    @property
+    def done(self):
+        return self.proc is not None and not self.proc.is_alive()
+
+    @property
+    def exitcode(self):
+        return self.proc.exitcode
+
+class BatchScheduler(object):
+    """Runs jobs concurrently without exceeding a core and memory budget.
+    Jobs are started in order, but a job that does not fit is skipped in
+    favour of later jobs that do (first fit). Failed jobs are retried.
+
+    Args:
+        max_cores: Total number of cores available to jobs
+        max_mem: Total memory available to jobs, in bytes
+        retries: Number of times to retry a failed job
+        reserved_mem: Memory (in bytes) already taken, e.g. by a shared index
+        poll_interval: Seconds between checks for finished jobs
+    """
+    def __init__(
+            self, max_cores, max_mem, retries=2, reserved_mem=0,
+            poll_interval=1):
+        self.max_cores = max_cores
+        self.max_mem = max_mem - reserved_mem
+        self.retries = retries
+        self.poll_interval = poll_interval
+
+    def run(self, jobs):
+        """Run jobs until all of them have succeeded or run out of retries.
+
+        Returns:
+            The list of jobs that failed
+        """
+        pending = deque(jobs)
+        for job in pending:
+            if job.cores > self.max_cores or job.mem > self.max_mem:
+                raise ValueError(
+                    "Job {} needs {} cores and {:.1f} GB, which exceeds the "
+                    "budget of {} cores and {:.1f} GB".format(
+                        job.accession, job.cores, job.mem / GB,
+                        self.max_cores, self.max_mem / GB))
+        running = []
+        failed = []
+        free_cores = self.max_cores
+        free_mem = self.max_mem
+        while pending or running:
+            for job in list(pending):
+                if job.cores <= free_cores and job.mem <= free_mem:
+                    pending.remove(job)
+                    log.info("Starting {} (attempt {}); {} running".format(
+                        job.accession, job.attempts + 1, len(running) + 1))
+                    job.start()
+                    running.append(job)
+                    free_cores -= job.cores
+                    free_mem -= job.mem
+            time.sleep(self.poll_interval)
+            for job in [job for job in running if job.done]:
+                running.remove(job)
+                free_cores += job.cores
+                free_mem += job.mem
+                elapsed = time.time() - job.start_time
+                if job.exitcode == 0:
+                    log.info("Finished {} in {:.1f} seconds".format(
+                        job.accession, elapsed))
+                elif job.attempts <= self.retries:
+                    log.warning("{} failed with exit code {}; retrying".format(
+                        job.accession, job.exitcode))
+                    pending.append(job)
+                else:
+                    log.error("{} failed with exit code {} after {} "
+                              "attempts".format(
+                                  job.accession, job.exitcode, job.attempts))
+                    failed.append(job)
+        return failed
+
+def job_output(output, accession, pipeline):
+    """Determine the output path for one accession: either substitute
+    '{accession}' in ``output``, or treat ``output`` as a directory.
+    """
+    if '{accession}' in output:
+        return output.format(accession=accession)
+    suffix = '.bam' if pipeline in ('star', 'hisat') else ''
+    return os.path.join(output, accession + suffix)
+
+def run_batch(args):
+    """Run a pipeline on every accession listed in ``args.accession_list``.
+
+    Args:
+        args: a Namespace object
+
+    Returns:
+        The number of accessions that failed
+    """
+    setup_logging(args)
+    if ',' in args.pipeline:
+        raise ValueError("Batch mode runs a single pipeline")
+    accessions = read_accessions(args.accession_list)
+    max_cores = args.max_cores or os.cpu_count()
+    max_mem = parse_size(args.max_mem) if args.max_mem else total_memory()
+    scale, overhead = FOOTPRINTS.get(args.pipeline, (1.0, GB))
+    if args.pipeline == 'star' and sort_method(args) != 'star':
+        overhead -= STAR_BAM_SORT_RAM
+    if args.pipeline in ('star', 'hisat') and sort_method(args) == 'native':
+        overhead += parse_size(args.sort_mem)
+    index_mem = int(scale * index_size(args.index))
+    share_index = args.share_index and args.pipeline in SHARED_INDEX
+    if args.job_mem:
+        job_mem = parse_size(args.job_mem)
+    elif share_index:
+        job_mem = overhead
+    else:
+        job_mem = index_mem + overhead
+    log.info(
+        "Running {} accessions with up to {} cores and {:.1f} GB; each job "
+        "needs {} cores and {:.1f} GB{}".format(
+            len(accessions), max_cores, max_mem / GB, args.threads,
+            job_mem / GB,
+            " (plus {:.1f} GB shared index)".format(index_mem / GB)
+            if share_index else ""))
+
+    jobs = []
+    for accession in accessions:
+        job_args = Namespace(**vars(args))
+        job_args.sra_accession = accession
+        job_args.accession_list = None
+        if args.caller:
+            # Only the VCF is written unless a BAM is asked for
+            if args.output != '-':
+                job_args.output = job_output(
+                    args.output, accession, args.pipeline)
+            vcf = args.vcf or '.'
+            job_args.vcf = (
+                vcf.format(accession=accession) if '{accession}' in vcf
+                else os.path.join(vcf, accession + '.vcf'))
+        else:
+            job_args.output = job_output(
+                args.output if args.output != '-' else '.', accession,
+                args.pipeline)
+        jobs.append(Job(accession, job_args, args.threads, job_mem))
+
+    scheduler = BatchScheduler(
+        max_cores, max_mem, retries=args.retries,
+        reserved_mem=index_mem if share_index else 0)
+    if share_index:
+        # Hold a reference for the whole batch so that the index stays loaded
+        # between jobs
+        with star_index_manager(args).use(args.index):
+            failed = scheduler.run(jobs)
+    else:
+        failed = scheduler.run(jobs)
+    if failed:
+        log.error("Failed accessions: {}".format(
+            ', '.join(job.accession for job in failed)))
+    return len(failed)
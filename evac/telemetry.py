@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+"""Periodic sampling of a run's processes, throughput and buffers.
+
+While a :class:`Telemetry` is active, a background thread samples, every
+``interval`` seconds:
+
+* the CPU usage, RSS and I/O of every watched process (the stages started by
+  :class:`evac.executor.Executor`, the transport's reader process, and the main
+  process), from /proc;
+* counters, such as the number of reads through the reader, which may be
+  incremented from forked child processes;
+* gauges, such as the fill level of transport buffers and of the pipes
+  between stages.
+
+Each sample is appended to a JSON-lines metrics file, followed by a summary at
+the end of the run, which can also be printed as a table. Components register
+with the active telemetry through :func:`active`, which returns a no-op object
+when telemetry is off, so nothing needs to be passed around.
+"""
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+import multiprocessing
+import os
+from array import array
+import sys
+import termios
+from threading import Event, Lock, Thread
+import time
+
+log = logging.getLogger()
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+# A process that uses less than this share of a core in a sample is idle
+IDLE_CPU = 0.05
+
+_mp = multiprocessing.get_context('fork')
+_active = None
+
+def read_proc(pid):
+    """Read the CPU time (seconds), RSS (bytes) and I/O counters of a process
+    from /proc.
+
+    Returns:
+        A dict, or None if the process does not exist (any more)
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid), 'rt') as inp:
+            stat = inp.read()
+    except (IOError, OSError):
+        return None
+    # The command name may contain spaces; the fields after it are fixed
+    fields = stat[stat.rindex(')') + 2:].split()
+    if fields[0] == 'Z':
+        return None
+    usage = dict(
+        cpu=(int(fields[11]) + int(fields[12])) / CLOCK_TICKS,
+        rss=int(fields[21]) * PAGE_SIZE)
+    try:
+        with open('/proc/{}/io'.format(pid), 'rt') as inp:
+            for line in inp:
+                key, value = line.split(':')
+                if key in ('rchar', 'wchar', 'read_bytes', 'write_bytes'):
+                    usage[key] = int(value)
+    except (IOError, OSError):
+        pass
+    return usage
+
+def pipe_level(fd):
+    """Returns the number of bytes buffered in a pipe (given either end), or
+    None if the descriptor is closed.
+    """
+    buf = array('i', [0])
+    try:
+        fcntl.ioctl(fd, termios.FIONREAD, buf)
+    except OSError:
+        return None
+    return buf[0]
+
+class Counter(object):
+    """A counter in shared memory, so that a child process forked after the
+    counter was created can increment it. Only one process should increment a
+    given counter.
+    """
+    def __init__(self):
+        self.value = _mp.RawValue('q', 0)
+
+    def add(self, count=1):
+        self.value.value += count
+
+    @property
+    def total(self):
+        return self.value.value
+
+class _Process(object):
+    def __init__(self, name, pid):
+        self.name = name
+        self.pid = pid
+        self.last = None
+        self.last_time = None
+        self.done = False
+        self.samples = 0
+        self.idle_samples = 0
+        self.cpu_sum = 0.0
+        self.max_cpu = 0.0
+        self.max_rss = 0
+        self.start = time.time()
+        self.end = None
+
+class Telemetry(object):
+    """Samples processes, counters and gauges and writes them to a
+    JSON-lines file.
+
+    Args:
+        path: Metrics file (appended to), or None to only keep the summary
+        interval: Seconds between samples
+        label: Label added to every record, to tell apart concurrent runs
+            that write to the same file
+    """
+    def __init__(self, path=None, interval=1.0, label=None):
+        self.path = path
+        self.interval = interval
+        self.label = label
+        self.processes = {}
+        self.counters = {}
+        self.counter_stats = {}
+        self.gauges = {}
+        self.gauge_stats = {}
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = None
+        self.out = None
+        self.start_time = None
+
+    def watch(self, name, pid):
+        """Sample a process until it exits.
+        """
+        with self.lock:
+            # Names are reused if a stage runs more than once
+            key = name
+            i = 1
+            while key in self.processes:
+                i += 1
+                key = '{}.{}'.format(name, i)
+            self.processes[key] = _Process(key, pid)
+
+    def counter(self, name):
+        """Returns the named Counter, creating it if necessary.
+        """
+        with self.lock:
+            if name not in self.counters:
+                self.counters[name] = Counter()
+                self.counter_stats[name] = dict(
+                    last=0, last_time=None, max_rate=0)
+            return self.counters[name]
+
+    def gauge(self, name, func):
+        """Sample the value returned by ``func`` (None when there is no value,
+        e.g. because the buffer has been closed).
+        """
+        with self.lock:
+            self.gauges[name] = func
+            self.gauge_stats[name] = dict(samples=0, sum=0, max=0)
+
+    def start(self):
+        global _active
+        self.start_time = time.time()
+        if self.path:
+            self.out = open(self.path, 'at')
+        self.watch('main', os.getpid())
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        _active = self
+        return self
+
+    def stop(self):
+        """Stop sampling, and write and return the summary.
+        """
+        global _active
+        if _active is self:
+            _active = None
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+        summary = self.summary()
+        self._write(dict(type='summary', **summary))
+        if self.out:
+            self.out.close()
+        return summary
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.sample()
+            except Exception:
+                log.exception("Error sampling telemetry")
+
+    def sample(self):
+        now = time.time()
+        record = dict(
+            type='sample', time=now, elapsed=now - self.start_time,
+            processes={}, counters={}, buffers={})
+        with self.lock:
+            processes = [p for p in self.processes.values() if not p.done]
+            counters = list(self.counters.items())
+            gauges = list(self.gauges.items())
+        for proc in processes:
+            usage = read_proc(proc.pid)
+            if usage is None:
+                proc.done = True
+                proc.end = now
+                continue
+            if proc.last is not None:
+                cpu = (usage['cpu'] - proc.last['cpu']) / (
+                    now - proc.last_time or 1)
+                usage['cpu_percent'] = 100 * cpu
+                proc.samples += 1
+                proc.cpu_sum += cpu
+                proc.max_cpu = max(proc.max_cpu, cpu)
+                if cpu < IDLE_CPU:
+                    proc.idle_samples += 1
+            proc.max_rss = max(proc.max_rss, usage['rss'])
+            proc.last = usage
+            proc.last_time = now
+            record['processes'][proc.name] = usage
+        for name, counter in counters:
+            stats = self.counter_stats[name]
+            total = counter.total
+            rate = None
+            if stats['last_time'] is not None:
+                rate = (total - stats['last']) / (
+                    now - stats['last_time'] or 1)
+                stats['max_rate'] = max(stats['max_rate'], rate)
+            stats['last'] = total
+            stats['last_time'] = now
+            record['counters'][name] = dict(total=total, rate=rate)
+        for name, func in gauges:
+            try:
+                value = func()
+            except Exception:
+                value = None
+            if value is None:
+                continue
+            stats = self.gauge_stats[name]
+            stats['samples'] += 1
+            stats['sum'] += value
+            stats['max'] = max(stats['max'], value)
+            record['buffers'][name] = value
+        self._write(record)
+
+    def _write(self, record):
+        if self.out is None:
+            return
+        if self.label is not None:
+            record['label'] = self.label
+        self.out.write(json.dumps(record) + '\n')
+        self.out.flush()
+
+    def summary(self):
+        """Returns a dict summarizing the run so far.
+        """
+        elapsed = time.time() - self.start_time
+        processes = {}
+        for proc in self.processes.values():
+            last = proc.last or {}
+            samples = proc.samples or None
+            processes[proc.name] = dict(
+                wall_time=(proc.end or time.time()) - proc.start,
+                cpu_time=last.get('cpu'),
+                mean_cpu_percent=samples and 100 * proc.cpu_sum / samples,
+                max_cpu_percent=100 * proc.max_cpu,
+                idle_fraction=samples and proc.idle_samples / samples,
+                max_rss=proc.max_rss,
+                read_bytes=last.get('rchar'),
+                write_bytes=last.get('wchar'))
+        counters = {}
+        for name, counter in self.counters.items():
+            stats = self.counter_stats[name]
+            counters[name] = dict(
+                total=counter.total, mean_rate=counter.total / (elapsed or 1),
+                max_rate=stats['max_rate'])
+        buffers = {}
+        for name, stats in self.gauge_stats.items():
+            if stats['samples']:
+                buffers[name] = dict(
+                    mean=stats['sum'] / stats['samples'], max=stats['max'])
+        return dict(
+            elapsed=elapsed, processes=processes, counters=counters,
+            buffers=buffers)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+def format_summary(summary):
+    """Format a summary as tables of processes, counters and buffers.
+    """
+    lines = [
+        "Run took {:.1f}s".format(summary['elapsed']),
+        "{:<20}{:>9}{:>9}{:>10}{:>10}{:>7}{:>9}{:>10}{:>10}".format(
+            'process', 'wall_s', 'cpu_s', 'mean_cpu%', 'max_cpu%', 'idle',
+            'rss_mb', 'read_mb', 'write_mb')]
+    for name, proc in sorted(
+            summary['processes'].items(), key=lambda p: -p[1]['wall_time']):
+        lines.append(
+            "{:<20}{:>9.1f}{:>9}{:>10}{:>10.0f}{:>7}{:>9.1f}{:>10}{:>10}"
+            .format(
+                name, proc['wall_time'], _fmt(proc['cpu_time']),
+                _fmt(proc['mean_cpu_percent'], '{:.0f}'),
+                proc['max_cpu_percent'],
+                _fmt(proc['idle_fraction'], '{:.0%}'),
+                proc['max_rss'] / 1024 ** 2,
+                _fmt(_mb(proc['read_bytes'])),
+                _fmt(_mb(proc['write_bytes']))))
+    for name, counter in sorted(summary['counters'].items()):
+        lines.append(
+            "{}: {} total, {:.0f}/s mean, {:.0f}/s max".format(
+                name, counter['total'], counter['mean_rate'],
+                counter['max_rate']))
+    for name, buf in sorted(summary['buffers'].items()):
+        lines.append("buffer {}: mean {:.0f}, max {}".format(
+            name, buf['mean'], buf['max']))
+    return '\n'.join(lines)
+
+def _fmt(value, spec='{:.1f}'):
+    return '-' if value is None else spec.format(value)
+
+def _mb(value):
+    return None if value is None else value / 1024 ** 2
+
+class NullTelemetry(object):
+    """Stands in for Telemetry when it is off.
+    """
+    def watch(self, name, pid):
+        pass
+
+    def counter(self, name):
+        return Counter()
+
+    def gauge(self, name, func):
+        pass
+
+NULL = NullTelemetry()
+
+def active():
+    """Returns the active Telemetry, or a no-op stand-in.
+    """
+    return _active or NULL
+
+@contextmanager
+def telemetry(args):
+    """Context manager that samples telemetry for the duration of a run if
+    ``--metrics`` or ``--metrics-summary`` was given.
+    """
+    path = getattr(args, 'metrics', None)
+    summary = getattr(args, 'metrics_summary', False)
+    if not (path or summary) or _active is not None:
+        yield None
+        return
+    run = Telemetry(
+        path, getattr(args, 'metrics_interval', 1.0),
+        label=getattr(args, 'sra_accession', None))
+    run.start()
+    try:
+        yield run
+    finally:
+        result = run.stop()
+        if summary:
+            sys.stderr.write(format_summary(result) + '\n')
@@ -0,0 +1,488 @@
+# -*- coding: utf-8 -*-
+"""Transports that move reads from a reader process to an aligner.
+
+A transport owns a pair of paths (one per mate) that the aligner opens for
+reading, and a producer process that writes FASTQ text into them. The source of
+the reads is any callable that takes two binary writers (one per mate), so the
+same transport can be fed from SRA, local files or synthetic data. A
+:class:`TeeTransport` feeds one source to several aligners, each through a
+transport of its own.
+"""
+import fcntl
+import logging
+import mmap
+import multiprocessing
+import os
+from threading import Thread
+from evac.telemetry import active, pipe_level
+
+log = logging.getLogger()
+
+# Linux-specific fcntl commands; exposed by the fcntl module only in Python 3.10+.
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+F_GETPIPE_SZ = getattr(fcntl, 'F_GETPIPE_SZ', 1032)
+
+# The fork context is required: the shared-memory transport relies on the
+# anonymous mmap being inherited by the producer process.
+_mp = multiprocessing.get_context('fork')
+
+def _produce(source, outputs):
+    try:
+        source(*outputs)
+    finally:
+        for out in outputs:
+            out.close()
+
+def _produce_to(source, transports):
+    writers = [transport.open_writers() for transport in transports]
+    if len(writers) == 1:
+        outputs = writers[0]
+    else:
+        outputs = [TeeWriter([mates[i] for mates in writers]) for i in (0, 1)]
+    _produce(source, outputs)
+
+class Transport(object):
+    """Base class for transports.
+
+    Args:
+        workdir: Directory in which to create any files the transport needs
+        buffer_mb: Size of the transport buffer (for both mates), in MB
+        name: Optional name that prefixes the transport's telemetry gauges,
+            to tell apart the transports of a :class:`TeeTransport`
+    """
+    # The largest write of one mate that can't deadlock the aligner, if there
+    # is a limit
+    max_batch_bytes = None
+    
+    def __init__(self, workdir, buffer_mb=None, name=None):
+        self.workdir = workdir
+        self.buffer_mb = buffer_mb
+        self.name = name
+        self.producer = None
+
+    @property
+    def paths(self):
+        """Paths from which the aligner reads mate 1 and mate 2.
+        """
+        raise NotImplementedError()
+
+    @property
+    def pass_fds(self):
+        """File descriptors the aligner process must inherit to be able to open
+        ``paths``.
+        """
+        return ()
+
+    def start(self, source):
+        """Start the producer process.
+
+        Args:
+            source: Callable that takes two binary writers (mate 1 and mate 2)
+                and writes FASTQ records to them.
+        """
+        producer = _mp.Process(target=_produce_to, args=(source, [self]))
+        producer.start()
+        active().watch('reader', producer.pid)
+        self.started(producer)
+
+    def open_writers(self):
+        """Called in the producer process to open the binary writers of mate 1
+        and mate 2.
+        """
+        raise NotImplementedError()
+
+    def started(self, producer):
+        """Called in the parent process once the producer has started.
+        """
+        self.producer = producer
+
+    def wait(self):
+        """Wait for the producer to finish.
+
+        Returns:
+            The producer's exit code
+        """
+        if self.producer is None:
+            return None
+        self.producer.join()
+        return self.producer.exitcode
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.producer is not None:
+            self.producer.terminate()
+        exitcode = self.wait()
+        self.close()
+        # Otherwise a reader that fails part of the way through would look
+        # like the end of the reads
+        if exc_type is None and exitcode:
+            raise IOError("The reader failed with exit code {}".format(
+                exitcode))
+
+class FifoTransport(Transport):
+    """Transport through a pair of named pipes. Every write goes through the
+    kernel pipe buffer, so the producer blocks whenever the aligner falls
+    behind by more than one buffer, and a write of one mate must fit in the
+    buffer (larger batches are split by :class:`evac.pipeline.ReaderSource`).
+    """
+    def __init__(self, workdir, buffer_mb=None, name=None):
+        super(FifoTransport, self).__init__(workdir, buffer_mb, name)
+        self._paths = tuple(
+            os.path.join(workdir, 'fifo.{}.fq'.format(mate))
+            for mate in (1, 2))
+        for path in self._paths:
+            os.mkfifo(path)
+        # Leave room for the data that the aligner has read ahead on the
+        # other mate
+        self.max_batch_bytes = pipe_max_size() // 2
+
+    @property
+    def paths(self):
+        return self._paths
+
+    def open_writers(self):
+        # Opening a FIFO for writing blocks until the reader opens it, so the
+        # files must be opened in the child.
+        outputs = [open(path, 'wb') for path in self._paths]
+        # Aligners read the two mates in lock-step, so a single write larger
+        # than the pipe buffer deadlocks the pair; enlarge the buffers so that
+        # batches are split into fewer writes.
+        for out in outputs:
+            _set_pipe_size(out.fileno())
+        return outputs
+
+class RingBuffer(object):
+    """Byte stream through a ring of fixed-size slots in anonymous shared
+    memory. With the default of two slots this is a double buffer: the writer
+    fills one slot while the reader drains the other.
+
+    Args:
+        size: Total size of the buffer, in bytes
+        slots: Number of slots
+    """
+    def __init__(self, size, slots=2):
+        self.slots = slots
+        self.slot_size = max(size // slots, mmap.PAGESIZE)
+        self.buffer = mmap.mmap(-1, self.slot_size * slots)
+        self.lengths = _mp.Array('q', slots, lock=False)
+        self.free = _mp.Semaphore(slots)
+        self.full = _mp.Semaphore(0)
+        # Set by the reader while it is blocked waiting for data, so that the
+        # writer hands over a partially filled slot rather than leaving the
+        # consumer idle.
+        self.starved = _mp.Value('b', 0, lock=False)
+
+    def writer(self):
+        return RingWriter(self)
+
+    def fill(self):
+        """Returns the number of slots that are full (waiting for the
+        reader).
+        """
+        return self.full.get_value()
+
+    def drain(self, fd, alive=None):
+        """Copy the contents of the buffer to a file descriptor until the
+        writer closes the stream. If the reader of ``fd`` goes away, the rest of
+        the stream is discarded.
+
+        Args:
+            fd: The file descriptor to write to
+            alive: Optional callable that returns False if the writer has died
+                without closing the stream
+
+        Returns:
+            The number of bytes copied
+        """
+        index = 0
+        total = 0
+        while True:
+            if not self.full.acquire(False):
+                self.starved.value = 1
+                while not self.full.acquire(timeout=1):
+                    if alive is not None and not alive():
+                        return total
+            self.starved.value = 0
+            length = self.lengths[index]
+            if length == 0:
+                self.free.release()
+                return total
+            start = index * self.slot_size
+            if fd is not None:
+                try:
+                    with memoryview(self.buffer) as view:
+                        chunk = view[start:start + length]
+                        while chunk:
+                            chunk = chunk[os.write(fd, chunk):]
+                        del chunk
+                    total += length
+                except BrokenPipeError:
+                    # Keep consuming so that the writer is not blocked forever
+                    log.error(
+                        "Reader closed its input before the end of the stream")
+                    fd = None
+            self.free.release()
+            index = (index + 1) % self.slots
+
+    def close(self):
+        self.buffer.close()
+
+class RingWriter(object):
+    """Binary writer for the producer end of a :class:`RingBuffer`.
+
+    The writers of the two mates are partners: before a writer blocks waiting
+    for a free slot, it hands over its partners' partially filled slots.
+    Otherwise the aligner, which reads both mates in lock-step, could be
+    waiting for data of the other mate that is held back in a slot that is
+    only handed over when the blocked writer gets to it.
+    """
+    def __init__(self, ring):
+        self.ring = ring
+        self.index = 0
+        self.offset = 0
+        self.acquired = False
+        self.partners = []
+
+    def write(self, data):
+        ring = self.ring
+        with memoryview(data) as remaining:
+            while remaining:
+                if not self.acquired:
+                    self._acquire()
+                start = self.index * ring.slot_size + self.offset
+                count = min(len(remaining), ring.slot_size - self.offset)
+                ring.buffer[start:start + count] = remaining[:count]
+                self.offset += count
+                remaining = remaining[count:]
+                if self.offset == ring.slot_size:
+                    self._commit()
+        if ring.starved.value:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.acquired and self.offset:
+            self._commit()
+
+    def close(self):
+        self.flush()
+        if not self.acquired:
+            self._acquire()
+        self._commit()
+
+    def _acquire(self):
+        if not self.ring.free.acquire(False):
+            for partner in self.partners:
+                partner.flush()
+            self.ring.free.acquire()
+        self.acquired = True
+        self.offset = 0
+
+    def _commit(self):
+        ring = self.ring
+        ring.lengths[self.index] = self.offset
+        ring.full.release()
+        self.acquired = False
+        self.index = (self.index + 1) % ring.slots
+
+class ShmTransport(Transport):
+    """Transport through a shared-memory ring buffer per mate. The producer
+    writes into the rings without ever touching the kernel; a pump thread per
+    mate drains each ring into an anonymous pipe (enlarged to the maximum
+    allowed size) whose read end is handed to the aligner as ``/dev/fd/N``.
+
+    The rings can hold far more reads than a pipe, so a bursty producer (such
+    as an SRA stream) runs ahead of the aligner between stalls, and the
+    aligner is not starved during a stall. The pump adds a copy, so with a
+    steady producer the 'fifo' transport is faster (see tests/fifo_vs_shm.py).
+    """
+    def __init__(self, workdir, buffer_mb=512, name=None):
+        super(ShmTransport, self).__init__(workdir, buffer_mb, name)
+        mate_size = (buffer_mb or 512) * 1024 * 1024 // 2
+        self.rings = [RingBuffer(mate_size) for _ in range(2)]
+        # A batch of one mate must fit in its ring for the same reason as
+        # with FIFOs. A slot handed over early to a starved reader may hold
+        # only a little data, so only one slot can be relied on.
+        self.max_batch_bytes = self.rings[0].slot_size
+        self.pipes = [os.pipe() for _ in range(2)]
+        for read_fd, write_fd in self.pipes:
+            _set_pipe_size(write_fd)
+        self.pumps = []
+        self.closed = False
+
+    @property
+    def paths(self):
+        return tuple('/dev/fd/{}'.format(r) for r, w in self.pipes)
+
+    @property
+    def pass_fds(self):
+        return tuple(r for r, w in self.pipes)
+
+    def open_writers(self):
+        writers = [ring.writer() for ring in self.rings]
+        writers[0].partners = [writers[1]]
+        writers[1].partners = [writers[0]]
+        return writers
+
+    def started(self, producer):
+        self.producer = producer
+        telemetry = active()
+        prefix = '{}.'.format(self.name) if self.name else ''
+        for mate, (ring, (read_fd, write_fd)) in enumerate(
+                zip(self.rings, self.pipes), 1):
+            telemetry.gauge('{}ring{}'.format(prefix, mate), ring.fill)
+            telemetry.gauge(
+                '{}pipe{}'.format(prefix, mate),
+                lambda fd=read_fd: None if self.closed else pipe_level(fd))
+            pump = Thread(
+                target=self._pump,
+                args=(ring, write_fd, producer.is_alive))
+            pump.daemon = True
+            pump.start()
+            self.pumps.append(pump)
+
+    @staticmethod
+    def _pump(ring, fd, alive):
+        try:
+            ring.drain(fd, alive)
+        finally:
+            os.close(fd)
+
+    def wait(self):
+        exitcode = super(ShmTransport, self).wait()
+        for pump in self.pumps:
+            pump.join()
+        return exitcode
+
+    def close(self):
+        # The aligner has its own copies of the read ends.
+        self.closed = True
+        for read_fd, write_fd in self.pipes:
+            _close_quietly(read_fd)
+        for ring in self.rings:
+            ring.close()
+
+class TeeWriter(object):
+    """Binary writer that writes everything to several writers, one after the
+    other, so that it blocks for as long as the fullest of them.
+    """
+    def __init__(self, writers):
+        self.writers = writers
+
+    def write(self, data):
+        for writer in self.writers:
+            writer.write(data)
+        return len(data)
+
+    def flush(self):
+        for writer in self.writers:
+            writer.flush()
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+class TeeTransport(Transport):
+    """Feeds one stream of reads to several aligners. Every consumer has a
+    transport of its own, which buffers the reads it has yet to read; one
+    producer process writes each batch to all of them in turn. The producer
+    blocks on the fullest buffer, so the reads are read once, at the pace of
+    the slowest consumer, and the others wait for it by at most their own
+    buffer.
+
+    Args:
+        transports: The transport of each consumer, which have not been
+            started
+    """
+    def __init__(self, transports):
+        super(TeeTransport, self).__init__(None)
+        self.transports = transports
+        limits = [
+            transport.max_batch_bytes for transport in transports
+            if transport.max_batch_bytes]
+        self.max_batch_bytes = min(limits) if limits else None
+
+    @property
+    def paths(self):
+        raise ValueError(
+            "A TeeTransport has no paths of its own; each consumer reads from "
+            "the paths of its transport")
+
+    def start(self, source):
+        producer = _mp.Process(
+            target=_produce_to, args=(source, self.transports))
+        producer.start()
+        active().watch('reader', producer.pid)
+        self.started(producer)
+        for transport in self.transports:
+            transport.started(producer)
+
+    def wait(self):
+        exitcode = super(TeeTransport, self).wait()
+        for transport in self.transports:
+            transport.wait()
+        return exitcode
+
+    def close(self):
+        for transport in self.transports:
+            transport.close()
+
+def pipe_max_size():
+    """Returns the largest size a pipe buffer can be set to.
+    """
+    try:
+        with open('/proc/sys/fs/pipe-max-size', 'rt') as inp:
+            return int(inp.read())
+    except (IOError, ValueError):
+        return 1024 * 1024
+
+def _set_pipe_size(fd):
+    size = pipe_max_size()
+    try:
+        fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except OSError:
+        log.debug("Could not increase pipe size to {}".format(size))
+
+def fill_level(out):
+    """Returns the fraction of the buffer between a transport writer and the
+    aligner that is full, or None if it can't be measured (e.g. for a regular
+    file). For a :class:`TeeWriter`, this is the level of the fullest buffer.
+    """
+    if isinstance(out, TeeWriter):
+        levels = [fill_level(writer) for writer in out.writers]
+        levels = [level for level in levels if level is not None]
+        return max(levels) if levels else None
+    if isinstance(out, RingWriter):
+        return out.ring.fill() / out.ring.slots
+    try:
+        fd = out.fileno()
+        level = pipe_level(fd)
+        size = fcntl.fcntl(fd, F_GETPIPE_SZ)
+    except (AttributeError, OSError, ValueError):
+        return None
+    if level is None or not size:
+        return None
+    return min(1.0, level / size)
+
+def _close_quietly(fd):
+    try:
+        os.close(fd)
+    except OSError:
+        pass
+
+transports = dict(
+    fifo=FifoTransport,
+    shm=ShmTransport)
+
+def list_transports():
+    """Returns the currently supported transports.
+
+    Returns:
+        A list of transport names
+    """
+    return list(transports.keys())
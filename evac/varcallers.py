@@ -1,35 +1,189 @@
 #!/bin/env python3
 import sys
 import os.path
+import shlex
 import subprocess
-import re
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from xphyle import open_
 from xphyle.paths import TempDir
+from evac.bamslice import MERGE_GAP, BamSlicer, find_index
+from evac.cache import open_cache
+from evac.executor import Executor, Stage
+from evac.telemetry import active, telemetry
+from evac.regions import (
+    GapFinder, bam_header, bam_read_counts, header_contigs, interleaved_shards,
+    interval_weights, normalize, plan_scatter, read_bed, write_bed)
+from evac.vcf import OverlapError, combine_disjoint, merge_streams
 
 log = logging.getLogger()
 
 def proccall(cmd_seq):
         log.info("Running command: {}".format(' '.join(cmd_seq)))
         with subprocess.Popen(cmd_seq,stdout=sys.stdout,bufsize=1) as proc:
+            active().watch(os.path.basename(cmd_seq[0]), proc.pid)
             proc.wait()
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd_seq)
 
-def mpileup_pipeline(args):
-    REF=args.index
-    samtools=args.samtools
-    caller_args=args.caller_args
-    regions=args.regions
+def mpileup_pipeline(args, script_dir):
+    """Call variants with samtools mpileup. The regions (from ``--regions``, or
+    all contigs in the BAM header) are split into ``--threads`` shards of about
+    equal weight, which are called in parallel and merged into a single
+    coordinate-sorted VCF as they stream out. If the BAM is indexed, each shard
+    is fed only the parts of the BAM that overlap its regions (see
+    evac.bamslice). With ``--cache-dir``, the VCF is cached by the content of
+    the BAM, reference and regions.
+    """
+    cache = open_cache(args)
+    key = None
+    if args.bam != '-' and args.output != '-':
+        key = cache.key(
+            "mpileup", [args.bam, args.index, args.regions], [args.samtools],
+            dict(args=args.caller_args))
+        if cache.get(key, {"vcf": args.output}):
+            return
+    call_mpileup(args)
+    if key:
+        cache.put(key, {"vcf": args.output})
 
-    CMD=[samtools, "mpileup",
-        "-f", REF,
-        "-l", regions,
-        "-v", "-u", "-t DP,AD", caller_args, "-"]
-    log.info("Running command: {}".format(' '.join(CMD)))
-    with open_(args.bam, 'rb') as BAM:
-        with open_(args.output, 'wb') as OUT:
-            with subprocess.Popen(CMD,stdin=BAM, stdout=OUT) as proc:
-                proc.wait()
+def known_sites_pipeline(args, script_dir):
+    """Genotype the known sites in ``--sites`` (a VCF or BED; defaults to
+    ``--regions``) by counting the alleles of the reads at each of them,
+    without calling variants elsewhere (see evac.genotype). With
+    ``--cache-dir``, the VCF is cached by the content of the BAM, sites and
+    reference.
+    """
+    from evac.genotype import KnownSiteGenotyper, read_sites
+    sites_path = args.sites or args.regions
+    if sites_path is None:
+        raise ValueError("The 'known' caller needs --sites (or --regions)")
+    cache = open_cache(args)
+    key = None
+    if args.bam != '-' and args.output != '-':
+        key = cache.key(
+            "known", [args.bam, sites_path, args.index], [],
+            dict(
+                min_base_quality=args.min_base_quality,
+                min_mapping_quality=args.min_mapping_quality,
+                min_depth=args.min_depth,
+                min_allele_fraction=args.min_allele_fraction))
+        if cache.get(key, {"vcf": args.output}):
+            return
+    sites = read_sites(sites_path, args.index)
+    log.info("Genotyping {} known sites".format(
+        sum(len(contig_sites) for contig_sites in sites.values())))
+    genotyper = KnownSiteGenotyper(
+        sites, args.min_base_quality, args.min_mapping_quality,
+        args.min_depth, args.min_allele_fraction)
+    with open_(args.output, 'wb') as out:
+        genotyper.genotype_bam(args.bam, out)
+    if key:
+        cache.put(key, {"vcf": args.output})
 
+def mpileup_command(samtools, reference, caller_args=""):
+    """The mpileup command, without regions or input.
+    """
+    return [
+        samtools, "mpileup",
+        "-f", reference,
+        "-v", "-u", "-t", "DP,AD"] + shlex.split(caller_args)
 
+def call_mpileup(args):
+    samtools = args.samtools
+    cmd = mpileup_command(samtools, args.index, args.caller_args)
+    index = None if args.bam == '-' else find_index(args.bam)
+    
+    if index is None:
+        # A stream can only be read once, from start to end, so it can't be
+        # sharded or sliced. Without an index, each shard would have to read
+        # and decompress the whole BAM to find its regions.
+        if args.threads > 1 and args.bam != '-':
+            log.info("{} has no index; calling it in a single process".format(
+                args.bam))
+        if args.regions:
+            cmd += ["-l", args.regions]
+        cmd.append("-")
+        log.info("Running command: {}".format(' '.join(cmd)))
+        with open_(args.bam, 'rb') as BAM:
+            with open_(args.output, 'wb') as OUT:
+                with subprocess.Popen(cmd, stdin=BAM, stdout=OUT) as proc:
+                    active().watch('mpileup', proc.pid)
+                    proc.wait()
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+        return
+    
+    contigs = header_contigs(bam_header(args.bam, samtools))
+    lengths = dict(contigs)
+    if args.regions:
+        intervals = read_bed(args.regions)
+    else:
+        intervals = [(name, 0, length) for name, length in contigs]
+    intervals = normalize(intervals, [name for name, length in contigs])
+    weights = interval_weights(
+        intervals, lengths, bam_read_counts(args.bam, samtools))
+    shards = interleaved_shards(intervals, max(1, args.threads), weights)
+    # The shards are interleaved, so what lies between two chunks of one
+    # shard belongs to the others; reading through it would read it twice
+    slicer = BamSlicer(
+        args.bam, index, gap=MERGE_GAP if len(shards) == 1 else 0)
+    
+    with TempDir(dir=args.temp_dir) as workdir:
+        stages = []
+        pipes = []
+        for i, shard in enumerate(shards):
+            bed = os.path.join(
+                str(workdir.absolute_path), "shard{}.bed".format(i))
+            write_bed(shard, bed)
+            read_fd, write_fd = os.pipe()
+            pipes.append((read_fd, write_fd))
+            stages.append(Stage(
+                "mpileup{}".format(i), cmd + ["-l", bed, "-"],
+                stdin=read_fd, stdout=subprocess.PIPE))
+        executor = Executor(stages)
+        try:
+            executor.start()
+        finally:
+            # mpileup has its own copy of the read end
+            for read_fd, write_fd in pipes:
+                os.close(read_fd)
+        with ThreadPoolExecutor(max(1, len(pipes))) as pool:
+            slices = [
+                pool.submit(write_slice, slicer, shard, write_fd)
+                for shard, (read_fd, write_fd) in zip(shards, pipes)]
+            try:
+                with open_(args.output, 'wb') as OUT:
+                    count = merge_streams(
+                        [stage.proc.stdout for stage in stages], OUT)
+            except BaseException:
+                # Nothing reads the shards any more, so the stages and the
+                # slice writers feeding them would block forever (and the
+                # pool with them). Kill the stages, and report the shard that
+                # failed, if any, along with the merge error.
+                executor.kill()
+                for stage in stages:
+                    stage.proc.stdout.close()
+                executor.wait()
+                raise
+            executor.wait()
+            if slices:
+                total = sum(future.result() for future in slices)
+                log.info("Read {:.1f} MB of the {:.1f} MB BAM".format(
+                    total / 1e6, os.path.getsize(args.bam) / 1e6))
+    log.info("Wrote {} records from {} shards".format(count, len(shards)))
+
+def write_slice(slicer, intervals, fd):
+    """Write the parts of a BAM that overlap ``intervals`` to a pipe.
+
+    Returns:
+        The number of compressed bytes read from the BAM
+    """
+    try:
+        return slicer.write(intervals, os.fdopen(fd, 'wb'))
+    except BrokenPipeError:
+        # The caller failed, which executor.wait() reports
+        return 0
 
 def gatk_pipeline(args, script_dir):
     JAVA=args.java          #sys.argv[1]
@@ -45,102 +199,172 @@ def gatk_pipeline(args, script_dir):
     samtools=args.samtools  #sys.argv[11]
     caller_args=args.caller_args
 
-    OUTNAME=os.path.splitext(BAM)[0]
-    interval_files=[]
-
-    #get the header of the bam file
-
-    CMD=[samtools, "view", "-H", BAM]
-    log.info("Running command: {}".format(' '.join(CMD)))
-    proc=subprocess.Popen(CMD,stdout=subprocess.PIPE,universal_newlines=True)
-    header=""
-    contigs=[]
-    contig_count=0
-    #pull the header from the bam with the contigs and their length
-    while True:
-        line = proc.stdout.readline()
-        if line != '':
-            header+=line
-            m = re.match('^@SQ.*SN:(.*)\s+LN:(.*)\s*.*', line)
-            if m:
-                contig_count+=1
-                contigs.append("\t".join([m.group(1), "1", m.group(2), "+", m.group(1)]))
-        else:
-            break
+    OUTNAME=os.path.splitext(os.path.basename(BAM))[0]
 
-    #create interval files for GATK parallelizing
-    #we create Picard-format files instead of providing on the command line because
-    #GRCh38 has contigs with colons : in them, which GATK will choke on
+    #get the header of the bam file, with the contigs and their lengths
+    header=bam_header(BAM, samtools)
+    contigs=header_contigs(header)
+    contig_order=[name for name, length in contigs]
+
+    #plan the scatter: weight each interval by the bases it covers (the -L
+    #targets, or whole contigs), scaled by read density from the BAM index,
+    #split the heaviest intervals, and assign them longest-first so that all
+    #shards finish at about the same time. With an index, the splits are put
+    #where no read is, so no record can straddle two shards
+    if INTERVALS:
+        intervals=normalize(read_bed(INTERVALS), contig_order)
+    else:
+        intervals=[(name, 0, length) for name, length in contigs]
+    weights=interval_weights(
+        intervals, dict(contigs), bam_read_counts(BAM, samtools))
+    snap=GapFinder(BAM) if find_index(BAM) else None
+    shards, loads=plan_scatter(
+        intervals, weights, THREADS, contig_order, snap=snap)
+
+    CMD=haplotype_caller_command(
+        JAVA, GATK_JAR, GATK_MEM, REF, BAM, DBSNP_VCF, caller_args)
+
+    #every shard, the combined gVCF and the final VCF are cached by the content
+    #of their inputs (with --cache-dir), so that a rerun only calls the shards
+    #that did not finish
+    cache=open_cache(args)
+    tools=[JAVA, GATK_JAR]
+    shard_keys=[
+        cache.key("HaplotypeCaller", [BAM, REF, DBSNP_VCF], tools,
+                  dict(args=caller_args, intervals=shard))
+        for shard in shards]
+    final_gvcf=os.path.join(OUTDIR,OUTNAME+".g.vcf.gz")
+    combined_key=cache.key("CombineGVCFs", params=shard_keys)
+    combined={"g.vcf.gz": final_gvcf, "g.vcf.gz.tbi": final_gvcf+".tbi"}
+
+    if not cache.get(combined_key, combined):
+        with TempDir(dir=args.temp_dir) as workdir:
+            gvcf_files=call_shards(
+                CMD, header, shards, loads, shard_keys, cache,
+                str(workdir.absolute_path), OUTNAME)
+
+            #Combine the separate GVCFs together. The shards of a single sample
+            #cover disjoint intervals, so this is just an ordered merge, which we
+            #do in-process (writing bgzip+tabix directly); CombineGVCFs is only
+            #needed if the shards turn out to overlap
+            try:
+                count=combine_disjoint(gvcf_files, final_gvcf)
+                log.info("Merged {} gVCF records from {} shards".format(count, len(gvcf_files)))
+            except OverlapError as err:
+                log.warning("{}; falling back to CombineGVCFs".format(err))
+                CMD=[ JAVA, "-Xmx{}g".format(GATK_MEM), "-jar", GATK_JAR,
+                    "-R", REF,
+                    "-T", "CombineGVCFs",
+                    "-o", final_gvcf ]
+                for f in gvcf_files:
+                    CMD.append("--variant")
+                    CMD.append(f)
+                proccall(CMD)
+        if all(os.path.exists(path) for path in combined.values()):
+            cache.put(combined_key, combined)
+
+    final_vcf=os.path.join(OUTDIR,OUTNAME+".vcf")
+    genotype_key=cache.key("GenotypeGVCFs", [REF], tools, dict(gvcf=combined_key))
+    if cache.get(genotype_key, {"vcf": final_vcf}):
+        return
+    genotype_gvcfs(JAVA, GATK_JAR, GATK_MEM, REF, final_gvcf, final_vcf)
+    cache.put(genotype_key, {"vcf": final_vcf})
 
-    from math import ceil
-
-    parallelize=ceil(contig_count/int(THREADS))
-    log.info("splitting into chunks of {} contigs".format(str(parallelize)))
-    with TempDir() as workdir:
-        incount=1
-        while len(contigs)>0:
-            outfile=workdir.make_path(OUTNAME+str(incount)+".list")
-            interval_files.append(outfile)
-            with open_(outfile, 'w') as i:
-                i.write(header)
-                for x in range(0,parallelize):
-                    line=contigs.pop()
-                    i.write(line+"\n")
-                    if len(contigs)==0:
-                        break
-            incount+=1
-
-    CMD=[JAVA, "-jar", "-Xmx"+GATK_MEM, GATK_JAR,
+def haplotype_caller_command(JAVA, GATK_JAR, GATK_MEM, REF, BAM, DBSNP_VCF, caller_args):
+    """The HaplotypeCaller command (in GVCF mode), without intervals or output.
+    """
+    CMD=[JAVA, "-Xmx{}g".format(GATK_MEM), "-jar", GATK_JAR,
         "-R", REF,
         "-T", "HaplotypeCaller",
         "-I", BAM,
         "--emitRefConfidence", "GVCF",
-        "--dbsnp", DBSNP_VCF,
-        "-L",INTERVALS,
-        "-U","ALLOW_N_CIGAR_READS","-nct", THREADS,
-        caller_args]
-    #Call variants by splitting using those interval files
-    gvcf_files=[]
-    cmds=[]
-    for f in interval_files:
-        gvcf=workdir.make_path(OUTNAME+str(len(gvcf_files))+".g.vcf")
-        gvcf_files.append(gvcf)
-        hc_cmd=list(CMD)
-        hc_cmd.append("-o")
-        hc_cmd.append(gvcf)
-        hc_cmd.append("-L")
-        hc_cmd.append(f)
-        cmds.append(hc_cmd)
-
-    from multiprocessing import Pool
-    p = Pool(int(THREADS))
-    p.map(proccall,cmds)
- 
-    final_gvcf=os.path.join(OUTDIR,OUTNAME+".g.vcf")
-    #Combine the separate GVCFs together
-    #if necessary
-    CMD=[ JAVA, "-jar", "-Xmx"+GATK_MEM, GATK_JAR,
-        "-R", REF,
-        "-T", "CombineGVCFs",
-        "-o", final_gvcf ]
-    for f in gvcf_files:
-        CMD.append("--variant")
-        CMD.append(f)
-    proccall(CMD)
+        "-U","ALLOW_N_CIGAR_READS"] + shlex.split(caller_args)
+    if DBSNP_VCF:
+        CMD += ["--dbsnp", DBSNP_VCF]
+    return CMD
 
-    final_vcf=os.path.join(OUTDIR,OUTNAME+".vcf")
-    CMD=[ JAVA, "-jar", "-Xmx"+GATK_MEM, GATK_JAR,
+def genotype_gvcfs(JAVA, GATK_JAR, GATK_MEM, REF, gvcf, vcf):
+    CMD=[ JAVA, "-Xmx{}g".format(GATK_MEM), "-jar", GATK_JAR,
         "-R", REF,
         "-T", "GenotypeGVCFs",
-        "-V", final_gvcf,
-        "-o", final_vcf ]
+        "-V", gvcf,
+        "-o", vcf ]
     proccall(CMD)
 
+def call_shards(CMD, header, shards, loads, shard_keys, cache, workdir, OUTNAME):
+    """Run HaplotypeCaller on every shard that is not in the cache, in
+    parallel, and cache the shards that succeed (even if others fail).
+
+    Returns:
+        The paths of the shard gVCFs
+    """
+    #create interval files for GATK parallelizing
+    #we create Picard-format files instead of providing on the command line because
+    #GRCh38 has contigs with colons : in them, which GATK will choke on
+    sam_header="".join(
+        line+"\n" for line in header.splitlines() if line.startswith(("@HD", "@SQ")))
+    stages=[]
+    pending=[]
+    gvcf_files=[]
+    for i, shard in enumerate(shards):
+        gvcf=os.path.join(workdir, "{}.{}.g.vcf".format(OUTNAME, i))
+        gvcf_files.append(gvcf)
+        if cache.get(shard_keys[i], {"g.vcf": gvcf}):
+            continue
+        interval_file=os.path.join(
+            workdir, "{}.{}.interval_list".format(OUTNAME, i))
+        write_interval_list(sam_header, shard, interval_file)
+        #Each shard gets one core; the shards are the parallelism
+        stages.append(Stage(
+            "HaplotypeCaller{}".format(i),
+            CMD + ["-nct", "1", "-L", interval_file, "-o", gvcf]))
+        pending.append(i)
+    if len(pending) < len(shards):
+        log.info("Reusing {} of {} shards from the cache".format(
+            len(shards) - len(pending), len(shards)))
+    if not stages:
+        return gvcf_files
+
+    #Call variants in parallel on the shards
+    executor=Executor(stages).start()
+    try:
+        executor.wait()
+    finally:
+        for i, stage in zip(pending, stages):
+            if stage.proc.returncode == 0:
+                cache.put(shard_keys[i], {"g.vcf": gvcf_files[i]})
+        log_scatter(
+            [shards[i] for i in pending], [loads[i] for i in pending], stages)
+    return gvcf_files
+
+def write_interval_list(sam_header, intervals, path):
+    """Write 0-based, half-open intervals as a Picard interval list.
+    """
+    with open_(path, 'w') as out:
+        out.write(sam_header)
+        for contig, start, end in intervals:
+            out.write("\t".join([contig, str(start + 1), str(end), "+", "."]) + "\n")
+
+def log_scatter(shards, loads, stages):
+    """Log the planned and actual share of the work done by each shard.
+    """
+    total_load=sum(loads) or 1
+    times=[stage.metrics.wall_time or 0 for stage in stages]
+    total_time=sum(times) or 1
+    log.info("shard\tintervals\tplanned_weight\tplanned_share\tactual_seconds\tactual_share")
+    for i, (shard, load, seconds) in enumerate(zip(shards, loads, times)):
+        log.info("{}\t{}\t{:.0f}\t{:.3f}\t{:.1f}\t{:.3f}".format(
+            i, len(shard), load, load / total_load, seconds, seconds / total_time))
+    if times:
+        log.info("Slowest shard took {:.1f}s; mean {:.1f}s".format(
+            max(times), total_time / len(times)))
+
 
 ###### Running code, largely copied from pipeline.py
 
 callers = dict(
-    gatk=gatk_pipeline
+    gatk=gatk_pipeline,
+    known=known_sites_pipeline,
     mpileup=mpileup_pipeline
     )
 
@@ -162,8 +386,9 @@ def run_caller(args, script_dir):
     caller = callers[args.caller]
     import time
     start_time = time.time()
-    caller(args, script_dir)
-    log.info("{} caller -- {} seconds ---".format(args.caller, str(time.time() - start_time))
+    with telemetry(args):
+        caller(args, script_dir)
+    log.info("{} caller -- {} seconds ---".format(args.caller, str(time.time() - start_time)))
 
 def setup_logging(args):
     if not logging.root.handlers:
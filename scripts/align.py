@@ -3,7 +3,11 @@
 """
 from argparse import ArgumentParser
 import os
-from evac.pipeline import run_pipeline, list_pipelines
+import sys
+from evac.fusion import list_callers
+from evac.pipeline import run_pipeline, list_pipelines, pipeline_names
+from evac.scheduler import run_batch
+from evac.transport import list_transports
 
 # Main
 
@@ -13,6 +17,20 @@ def main(script_dir):
         '-a', '--sra-accession',
         default=None, metavar="SRRXXXXXXX",
         help="Accession number of SRA run to align")
+    parser.add_argument(
+        '-A', '--accession-list',
+        default=None, metavar="FILE",
+        help="File with one SRA accession per line. Runs the pipeline on all "
+            "of them concurrently, within the limits set by --max-cores and "
+            "--max-mem. In this mode, --output is a directory, or a path "
+            "containing '{accession}'.")
+    parser.add_argument(
+        '-i', '--input',
+        nargs='+', default=None, metavar="PATH",
+        help="Local input file(s) to use instead of an SRA accession: one or "
+            "two FASTQ files (optionally compressed with gzip, bgzip or zstd; "
+            "a single FASTQ is treated as interleaved), or one unaligned "
+            "SAM/BAM/CRAM file grouped by read name.")
     parser.add_argument(
         '-l', '--library-type',
         default="SF", metavar="LIBTYPE",
@@ -28,15 +46,20 @@ def main(script_dir):
         default="-", metavar="PATH",
         help="Path to output. For 'star' and 'histat' pipelines, this must be "
             "a file (including '-' for stdout). For 'kallisto', this must be a "
-            "directory.")
+            "directory. With several pipelines, a comma-separated list of "
+            "one output per pipeline.")
     parser.add_argument(
         '-p', '--pipeline',
-        choices=list_pipelines(), default='star',
-        help="The alignment pipeline to use")
+        type=pipeline_names, default='star', metavar="PIPELINE",
+        help="The alignment pipeline to use, from: {}. A comma-separated "
+            "list of the alignment and quantification pipelines (e.g. "
+            "star,salmon) runs them all on a single stream of reads.".format(
+                ', '.join(list_pipelines())))
     parser.add_argument(
         '-r', '--index',
         default=None, metavar="PATH",
-        help="Genome idex to use for alignment")
+        help="Genome idex to use for alignment. With several pipelines, a "
+            "comma-separated list of one index per pipeline.")
     parser.add_argument(
         '-t', '--threads',
         type=int, default=1, metavar="N",
@@ -45,10 +68,60 @@ def main(script_dir):
         '--aligner-args',
         default="", metavar="ARGS",
         help="String of additional arguments to pass to the aligner")
+    parser.add_argument(
+        '--tool-args',
+        nargs=2, action='append', default=None, metavar=("PIPELINE", "ARGS"),
+        help="Additional arguments for the aligner of one pipeline, instead "
+            "of --aligner-args, when several pipelines are run. May be given "
+            "once per pipeline.")
     parser.add_argument(
         '--batch-size',
         type=int, default=1000, metavar="N",
-        help="Number of reads to process in each batch.")
+        help="Number of reads to process in each batch (the initial number "
+            "with --batch-sizing adaptive).")
+    parser.add_argument(
+        '--batch-sizing',
+        choices=('adaptive', 'fixed'), default='adaptive',
+        help="Keep --batch-size fixed, or adapt it to how fast the aligner "
+            "takes reads ('adaptive'): larger while the aligner waits for "
+            "reads, smaller while the reader waits for the aligner.")
+    parser.add_argument(
+        '--batch-mem',
+        type=int, default=64, metavar="MB",
+        help="With --batch-sizing adaptive, the most memory one batch (both "
+            "mates, as FASTQ) may take up.")
+    parser.add_argument(
+        '--transport',
+        choices=list_transports(), default='fifo',
+        help="How reads are passed from the reader to the aligner: through a "
+            "pair of named pipes ('fifo') or through a shared-memory ring "
+            "buffer per mate ('shm').")
+    parser.add_argument(
+        '--buffer-mb',
+        type=int, default=512, metavar="MB",
+        help="Size of the 'shm' transport buffer (for both mates), in MB.")
+    parser.add_argument(
+        '--sort',
+        choices=('native', 'sambamba', 'star'), default=None,
+        help="How the BAM from 'star' and 'hisat' is sorted: by evac within "
+            "--sort-mem, writing a BAI index alongside ('native'; the default "
+            "with --caller); by sambamba (the default for 'hisat'); or by "
+            "STAR itself, in memory ('star'; the default for 'star').")
+    parser.add_argument(
+        '--sort-mem',
+        default='768M', metavar="SIZE",
+        help="Memory for sorted runs with --sort native, e.g. 2G; larger "
+            "outputs are spilled to temporary files and merged.")
+    parser.add_argument(
+        '--share-index',
+        action='store_true', default=False,
+        help="Keep one copy of the genome index in shared memory, shared by "
+            "all concurrent and later runs until it has been unused for "
+            "--index-idle-timeout seconds (STAR only).")
+    parser.add_argument(
+        '--index-idle-timeout',
+        type=float, default=600, metavar="SECONDS",
+        help="With --share-index, how long to keep an unused index loaded.")
     parser.add_argument(
         '--temp-dir',
         default=None, metavar="DIR",
@@ -64,6 +137,27 @@ def main(script_dir):
     parser.add_argument(
         "--compression",
         default="gz", help="Type of compression to use on the output files.")
+    parser.add_argument(
+        '--cache-dir',
+        default=None, metavar="DIR",
+        help="Cache the outputs of completed stages in DIR, keyed by the "
+            "content of their inputs, the tool executables and the arguments, "
+            "so that a rerun skips the stages that already completed.")
+    parser.add_argument(
+        '--metrics',
+        default=None, metavar="FILE",
+        help="Append telemetry (CPU, memory and I/O of every stage, read "
+            "throughput, and buffer fill levels, sampled every "
+            "--metrics-interval seconds) to FILE as JSON lines.")
+    parser.add_argument(
+        '--metrics-interval',
+        type=float, default=1.0, metavar="SECONDS",
+        help="Seconds between telemetry samples.")
+    parser.add_argument(
+        '--metrics-summary',
+        action='store_true', default=False,
+        help="Print a summary of the telemetry to stderr at the end of the "
+            "run.")
     group = parser.add_mutually_exclusive_group()
     group.add_argument(
         '--log-level',
@@ -75,14 +169,210 @@ def main(script_dir):
         help="Only write error messages (equivalent to "
             "--log-level ERROR --no-progress)")
     
+    batch = parser.add_argument_group("Batch mode (--accession-list)")
+    batch.add_argument(
+        '--max-cores',
+        type=int, default=None, metavar="N",
+        help="Maximum number of cores used by all jobs (defaults to all). "
+            "Each job uses --threads cores.")
+    batch.add_argument(
+        '--max-mem',
+        default=None, metavar="SIZE",
+        help="Maximum memory used by all jobs, e.g. 256G (defaults to all "
+            "physical memory).")
+    batch.add_argument(
+        '--job-mem',
+        default=None, metavar="SIZE",
+        help="Memory needed by each job, e.g. 32G (defaults to an estimate "
+            "based on the size of the index).")
+    batch.add_argument(
+        '--retries',
+        type=int, default=2, metavar="N",
+        help="Number of times to retry a failed accession.")
+    
+    prefetch = parser.add_argument_group("Prefetching SRA reads")
+    prefetch.add_argument(
+        '--prefetch',
+        type=int, default=0, metavar="N",
+        help="Fetch the reads in chunks over N connections at once, instead "
+            "of as one stream.")
+    prefetch.add_argument(
+        '--chunk-reads',
+        type=int, default=100000, metavar="N",
+        help="Number of read pairs in each prefetched chunk.")
+    prefetch.add_argument(
+        '--sra-cache',
+        default=None, metavar="DIR",
+        help="Keep prefetched chunks in DIR, so that later runs on the same "
+            "accession read them from disk (implies --prefetch 1 or more).")
+    prefetch.add_argument(
+        '--sra-cache-size',
+        default='50G', metavar="SIZE",
+        help="Maximum size of --sra-cache; the least recently used chunks "
+            "are deleted to stay within it.")
+    prefetch.add_argument(
+        '--sra-archive',
+        default=None, metavar="DIR",
+        help="Read accessions from a local directory of "
+            "<accession>_1.fastq/<accession>_2.fastq files instead of SRA "
+            "(for testing).")
+    
+    filters = parser.add_argument_group(
+        "Read filters (applied between the reader and the aligner)")
+    filters.add_argument(
+        '--downsample',
+        type=float, default=None, metavar="FRACTION",
+        help="Keep this fraction of the read pairs, selected by a hash of the "
+            "read name (so the same pairs are kept on every run).")
+    filters.add_argument(
+        '--target-depth',
+        type=float, default=None, metavar="DEPTH",
+        help="Downsample to this mean depth of coverage of a genome of "
+            "--genome-size bases, from --input-bases bases.")
+    filters.add_argument(
+        '--genome-size',
+        type=float, default=None, metavar="BASES",
+        help="Size of the genome (or transcriptome), for --target-depth.")
+    filters.add_argument(
+        '--input-bases',
+        type=float, default=None, metavar="BASES",
+        help="Total number of bases in the input (e.g. the 'bases' of the "
+            "SRA run), for --target-depth.")
+    filters.add_argument(
+        '--seed',
+        type=int, default=0, metavar="N",
+        help="Seed for the downsampling hash.")
+    filters.add_argument(
+        '--min-quality',
+        type=float, default=None, metavar="Q",
+        help="Drop pairs in which either mate has a mean base quality below Q.")
+    filters.add_argument(
+        '--max-n',
+        type=float, default=None, metavar="FRACTION",
+        help="Drop pairs in which either mate has a greater fraction of N "
+            "bases.")
+    filters.add_argument(
+        '--screen',
+        nargs='+', default=None, metavar="FASTA",
+        help="Drop pairs in which either mate matches the sequences in these "
+            "FASTA files (e.g. rRNA and adapters).")
+    filters.add_argument(
+        '--screen-k',
+        type=int, default=25, metavar="K",
+        help="K-mer size for --screen.")
+    filters.add_argument(
+        '--screen-fraction',
+        type=float, default=0.5, metavar="FRACTION",
+        help="Fraction of the k-mers sampled from a read that must match for "
+            "the read to be screened out.")
+    filters.add_argument(
+        '--filter-workers',
+        type=int, default=1, metavar="N",
+        help="Number of processes that filter batches of reads.")
+    
+    dedup = parser.add_argument_group("Deduplication (--dedup)")
+    dedup.add_argument(
+        '--dedup',
+        action='store_true', default=False,
+        help="Align each distinct pair of read sequences only once, and copy "
+            "its alignments to the identical pairs (STAR and HISAT2 only).")
+    dedup.add_argument(
+        '--dedup-mem',
+        type=int, default=1024, metavar="MB",
+        help="Memory for the table of distinct pairs; the pairs that do not "
+            "fit are deduplicated from temporary files at the end.")
+    dedup.add_argument(
+        '--dedup-partitions',
+        type=int, default=16, metavar="N",
+        help="Number of temporary files that duplicates and alignments are "
+            "partitioned into.")
+    
+    calling = parser.add_argument_group(
+        "Variant calling while aligning (--caller)")
+    calling.add_argument(
+        '-c', '--caller',
+        choices=list_callers(), default=None,
+        help="Call variants on each contig of the sorted alignments as soon "
+            "as it is complete, instead of writing a BAM and calling it "
+            "afterwards (STAR and HISAT2). This always uses --sort native, "
+            "which is slower than STAR's sort or sambamba, and spills the "
+            "alignments to temporary files beyond --sort-mem. The BAM is "
+            "only written if --output is a file.")
+    calling.add_argument(
+        '--vcf',
+        default=None, metavar="PATH",
+        help="Output VCF for --caller. In batch mode, a directory or a path "
+            "containing '{accession}'.")
+    calling.add_argument(
+        '--reference',
+        default=None, metavar="FASTA",
+        help="Reference genome (indexed FASTA) for --caller.")
+    calling.add_argument(
+        '--regions',
+        default=None, metavar="BED",
+        help="A BED file to limit the calling space.")
+    calling.add_argument(
+        '--caller-args',
+        default="", metavar="ARGS",
+        help="String of additional arguments to pass to the caller")
+    calling.add_argument(
+        '--sites',
+        default=None, metavar="PATH",
+        help="VCF or BED file of the known sites to genotype with 'known' "
+            "(defaults to --regions)")
+    calling.add_argument(
+        '--min-base-quality',
+        type=int, default=13, metavar="Q",
+        help="Skip bases with a lower quality in 'known'")
+    calling.add_argument(
+        '--min-mapping-quality',
+        type=int, default=0, metavar="Q",
+        help="Skip reads with a lower mapping quality in 'known'")
+    calling.add_argument(
+        '--min-depth',
+        type=int, default=1, metavar="N",
+        help="Leave the genotype of sites with a lower depth missing in "
+            "'known'")
+    calling.add_argument(
+        '--min-allele-fraction',
+        type=float, default=0.2, metavar="F",
+        help="Minimum fraction of the depth of an allele in a genotype in "
+            "'known'")
+    calling.add_argument(
+        '--max-pending-contigs',
+        type=int, default=4, metavar="N",
+        help="Pause the sort while N contigs are waiting to be called, to "
+            "bound the temporary space their BAMs take up.")
+    calling.add_argument(
+        '--java',
+        default="java", metavar="PATH",
+        help="The 'java' executable for 'gatk'")
+    calling.add_argument(
+        '--gatk',
+        default="GenomeAnalysisTK.jar", metavar="PATH",
+        help="The GATK jar for 'gatk'")
+    calling.add_argument(
+        '--gatk-mem',
+        type=int, default=4, metavar="GB",
+        help="Memory for each GATK process, in GB")
+    calling.add_argument(
+        '--dbsnp',
+        default=None, metavar="PATH",
+        help="Path to the dbsnp VCF file for 'gatk'")
+    
     # Paths to aligners
     # TODO: move this into a config file
     parser.add_argument('--star')
     parser.add_argument('--hisat2')
     parser.add_argument('--kallisto')
     parser.add_argument('--salmon')
+    parser.add_argument('--samtools')
     
-    run_pipeline(parser.parse_args(), script_dir)
+    args = parser.parse_args()
+    if args.accession_list:
+        sys.exit(1 if run_batch(args) else 0)
+    else:
+        run_pipeline(args)
 
 if __name__ == "__main__":
     main(os.path.dirname(__file__))
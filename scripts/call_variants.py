@@ -26,7 +26,7 @@ def main(script_dir):
     parser.add_argument(
         '-t', '--threads',
         type=int, default=10, metavar="N",
-        help="Number of threads to use for 'gatk'")
+        help="Number of threads (parallel shards) to use")
     parser.add_argument(
         '-m', '--mem',
         type=int, default=1, metavar="N",
@@ -35,6 +35,29 @@ def main(script_dir):
         '-L', '--regions',
         default=None, metavar="PATH",
         help="A BED file to limit the calling space")
+    parser.add_argument(
+        '--sites',
+        default=None, metavar="PATH",
+        help="VCF or BED file of the known sites to genotype with 'known' "
+            "(defaults to --regions)")
+    parser.add_argument(
+        '--min-base-quality',
+        type=int, default=13, metavar="Q",
+        help="Skip bases with a lower quality in 'known'")
+    parser.add_argument(
+        '--min-mapping-quality',
+        type=int, default=0, metavar="Q",
+        help="Skip reads with a lower mapping quality in 'known'")
+    parser.add_argument(
+        '--min-depth',
+        type=int, default=1, metavar="N",
+        help="Leave the genotype of sites with a lower depth missing in "
+            "'known'")
+    parser.add_argument(
+        '--min-allele-fraction',
+        type=float, default=0.2, metavar="F",
+        help="Minimum fraction of the depth of an allele in a genotype in "
+            "'known'")
     parser.add_argument(
         '--dbsnp',
         default=None, metavar="PATH",
@@ -67,6 +90,27 @@ def main(script_dir):
         '--log-file',
         default=None, metavar="FILE",
         help="File for log messages (defaults to stdout)")
+    parser.add_argument(
+        '--cache-dir',
+        default=None, metavar="DIR",
+        help="Cache the outputs of completed stages in DIR, keyed by the "
+            "content of their inputs, the tool executables and the arguments, "
+            "so that a rerun skips the stages that already completed.")
+    parser.add_argument(
+        '--metrics',
+        default=None, metavar="FILE",
+        help="Append telemetry (CPU, memory and I/O of every stage, read "
+            "throughput, and buffer fill levels, sampled every "
+            "--metrics-interval seconds) to FILE as JSON lines.")
+    parser.add_argument(
+        '--metrics-interval',
+        type=float, default=1.0, metavar="SECONDS",
+        help="Seconds between telemetry samples.")
+    parser.add_argument(
+        '--metrics-summary',
+        action='store_true', default=False,
+        help="Print a summary of the telemetry to stderr at the end of the "
+            "run.")
     group = parser.add_mutually_exclusive_group()
     group.add_argument(
         '--log-level',
@@ -83,7 +127,7 @@ def main(script_dir):
     parser.add_argument('--gatk')
     parser.add_argument('--mpileup')
     
-    run_pipeline(parser.parse_args(), script_dir)
+    run_caller(parser.parse_args(), script_dir)
 
 if __name__ == "__main__":
     main(os.path.dirname(__file__))
@@ -0,0 +1,68 @@
+"""Compare fixed and adaptive batch sizes on synthetic paired reads.
+
+The consumer reads both mates line by line in lock-step, like an aligner does.
+Use ``--delay`` to make it slow (seconds of sleep per 10,000 read pairs), so
+that the aligner is the bottleneck, and ``--read-length`` to see the memory
+bound on batches of long reads. For each batch sizing, the wall time and the
+largest batch (in pairs and MB of FASTQ per mate) are reported.
+"""
+from argparse import ArgumentParser
+import logging
+import tempfile
+import time
+from evac.batching import AdaptiveBatchSize, FixedBatchSize, MB
+from evac.pipeline import ReaderSource
+from evac.transport import transports
+from synthetic import SyntheticReader, run_consumer
+
+def run(transport_name, create_sizer, args):
+    record_bytes = 2 * args.read_length + 20
+    with tempfile.TemporaryDirectory() as workdir:
+        start = time.time()
+        with transports[transport_name](workdir, args.buffer_mb) as transport:
+            sizer = create_sizer(transport)
+            reader = SyntheticReader(
+                args.reads, args.read_length, batch_size=sizer)
+            # The largest batch is only known in the reader process, so
+            # report it through the shared size
+            largest = FixedBatchSize(0)
+            def source(out1, out2):
+                ReaderSource(
+                    reader, sizer, transport.max_batch_bytes)(out1, out2)
+                largest.size = reader.largest
+            transport.start(source)
+            run_consumer(transport, args.delay)
+        return time.time() - start, largest.size, largest.size * record_bytes
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--reads', type=int, default=1000000)
+    parser.add_argument('-l', '--read-length', type=int, default=100)
+    parser.add_argument('--delay', type=float, default=0)
+    parser.add_argument('--transport', choices=sorted(transports), default='shm')
+    parser.add_argument('--buffer-mb', type=int, default=512)
+    parser.add_argument('--batch-mem', type=int, default=64)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help="Log every change of the adaptive batch size")
+    args = parser.parse_args()
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+    sizers = [
+        ('fixed {}'.format(size),
+         lambda transport, size=size: FixedBatchSize(size))
+        for size in args.sizes]
+    def adaptive(transport):
+        max_bytes = args.batch_mem * MB // 2
+        if transport.max_batch_bytes:
+            max_bytes = min(max_bytes, transport.max_batch_bytes)
+        return AdaptiveBatchSize(args.sizes[0], max_bytes=max_bytes)
+    sizers.append(('adaptive', adaptive))
+    for name, create in sizers:
+        seconds, largest, nbytes = run(args.transport, create, args)
+        print("{}\t{:.3f}s\tlargest batch {} pairs, {:.1f} MB per mate".format(
+            name, seconds, largest, nbytes / MB))
+
+if __name__ == '__main__':
+    main()
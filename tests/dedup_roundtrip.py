@@ -0,0 +1,115 @@
+"""Check that deduplicating reads before a stand-in aligner, and expanding its
+output afterwards, gives the same records as aligning every read.
+
+The aligner is a stub that turns each read pair into a pair of SAM records
+that depend only on the sequences (so duplicates align the same way), with
+the qualities reversed for the mates it puts on the reverse strand. Use
+``--mem`` and ``--expand-mem`` (in MB; tiny by default) to force the distinct
+pairs to spill, and the duplicates to be split for the join. The time of each
+route and the number of records are reported.
+"""
+from argparse import ArgumentParser
+import io
+import random
+import sys
+import tempfile
+import time
+import zlib
+from evac.dedup import (
+    Dedup, SAM_FLAG_READ2, SAM_FLAG_REVERSE, expand, read_name)
+from evac.readers import Reader
+from evac.reads import ReadBatch
+from synthetic import random_read
+
+class PoolReader(Reader):
+    """Generates read pairs drawn at random from a pool of ``distinct``
+    sequence pairs, each with its own qualities.
+    """
+    def __init__(self, n, distinct, read_length, seed=0, **kwargs):
+        super(PoolReader, self).__init__(**kwargs)
+        self.n = n
+        rng = random.Random(seed)
+        pool = [
+            (random_read(read_length, rng), random_read(read_length, rng))
+            for i in range(distinct)]
+        self.pairs = []
+        for i in range(n):
+            seq1, seq2 = rng.choice(pool)
+            self.pairs.append((
+                b'read' + str(i).encode(), seq1, random_qual(read_length, rng),
+                seq2, random_qual(read_length, rng)))
+
+    def batches(self):
+        for start in range(0, self.n, self.batch_size):
+            pairs = self.pairs[start:start + self.batch_size]
+            names = [pair[0] for pair in pairs]
+            yield (
+                ReadBatch.from_lists(
+                    names, [pair[1] for pair in pairs],
+                    [pair[2] for pair in pairs]),
+                ReadBatch.from_lists(
+                    names, [pair[3] for pair in pairs],
+                    [pair[4] for pair in pairs]))
+
+def random_qual(n, rng):
+    return bytes(rng.choices(range(33, 75), k=n))
+
+def align(batches, out):
+    """Stub aligner: writes a header and two SAM records per read pair.
+    """
+    out.write(b'@HD\tVN:1.6\tSO:unsorted\n')
+    for batch1, batch2 in batches:
+        for (name, seq1, qual1), (_, seq2, qual2) in zip(batch1, batch2):
+            name = read_name(name)
+            for flag, seq, qual in (
+                    (0x41, seq1, qual1), (0x81 | SAM_FLAG_READ2, seq2, qual2)):
+                pos = zlib.crc32(seq)
+                if pos & 1:
+                    flag |= SAM_FLAG_REVERSE
+                    qual = qual[::-1]
+                out.write(b'\t'.join((
+                    name, str(flag).encode(), b'chr1', str(pos).encode(),
+                    b'60', b'%dM' % len(seq), b'=', b'0', b'0', seq, qual)) +
+                    b'\n')
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--reads', type=int, default=100000)
+    parser.add_argument('-d', '--distinct', type=int, default=10000)
+    parser.add_argument('-l', '--read-length', type=int, default=100)
+    parser.add_argument('--partitions', type=int, default=4)
+    parser.add_argument('--mem', type=float, default=0.1)
+    parser.add_argument('--expand-mem', type=float, default=0.1)
+    args = parser.parse_args()
+    reader = PoolReader(
+        args.reads, args.distinct, args.read_length, batch_size=1000)
+
+    start = time.time()
+    plain = io.BytesIO()
+    align(reader, plain)
+    plain_time = time.time() - start
+
+    with tempfile.TemporaryDirectory() as workdir:
+        start = time.time()
+        dedup = Dedup(workdir, args.mem, args.partitions, batch_size=1000)
+        aligned = io.BytesIO()
+        align(dedup.reads(reader), aligned)
+        aligned.seek(0)
+        expanded = io.BytesIO()
+        added = expand(
+            workdir, args.partitions, aligned, expanded, args.expand_mem)
+        dedup_time = time.time() - start
+
+    expected = sorted(plain.getvalue().splitlines())
+    found = sorted(expanded.getvalue().splitlines())
+    print("plain\t{:.3f}s\t{} records".format(plain_time, len(expected)))
+    print("dedup\t{:.3f}s\t{} records ({} aligned, {} added)".format(
+        dedup_time, len(found), len(found) - added, added))
+    if found != expected:
+        print("MISMATCH: {} records differ".format(
+            len(set(found).symmetric_difference(expected))))
+        sys.exit(1)
+    print("OK")
+
+if __name__ == '__main__':
+    main()
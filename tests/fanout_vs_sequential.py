@@ -0,0 +1,77 @@
+"""Compare running several consumers on the same reads one after the other
+(reading the reads once for each) with running them at once on a single
+stream through a TeeTransport.
+
+Each consumer reads both mates line by line in lock-step, like an aligner does,
+and prints a digest of what it read, which must be the same for every
+consumer. Use ``--delays`` to give each consumer its own pace (seconds of sleep
+per 10,000 read pairs): with the tee, the slowest consumer sets the pace, and
+the wall time is that of the slowest one rather than the sum of all of them.
+"""
+from argparse import ArgumentParser
+import os
+import subprocess
+import tempfile
+import time
+from evac.batching import FixedBatchSize
+from evac.pipeline import ReaderSource
+from evac.transport import TeeTransport, transports
+from synthetic import SyntheticReader, start_consumer
+
+def source(args, transport):
+    sizer = FixedBatchSize(args.batch_size)
+    return ReaderSource(
+        SyntheticReader(args.reads, args.read_length, batch_size=sizer),
+        max_bytes=transport.max_batch_bytes)
+
+def sequential(transport_class, args, workdir):
+    digests = []
+    for i, delay in enumerate(args.delays):
+        path = os.path.join(workdir, 'sequential{}'.format(i))
+        os.mkdir(path)
+        with transport_class(path, args.buffer_mb) as transport:
+            transport.start(source(args, transport))
+            consumer = start_consumer(
+                transport, delay, digest=True, stdout=subprocess.PIPE,
+                universal_newlines=True)
+            digests.append(consumer.communicate()[0].strip())
+    return digests
+
+def tee(transport_class, args, workdir):
+    consumers = []
+    for i, delay in enumerate(args.delays):
+        path = os.path.join(workdir, 'tee{}'.format(i))
+        os.mkdir(path)
+        consumers.append(transport_class(path, args.buffer_mb))
+    with TeeTransport(consumers) as transport:
+        transport.start(source(args, transport))
+        procs = [
+            start_consumer(
+                consumer, delay, digest=True, stdout=subprocess.PIPE,
+                universal_newlines=True)
+            for delay, consumer in zip(args.delays, consumers)]
+        return [proc.communicate()[0].strip() for proc in procs]
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--reads', type=int, default=1000000)
+    parser.add_argument('-l', '--read-length', type=int, default=100)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument(
+        '--delays', type=float, nargs='+', default=[0, 0.05],
+        help="The delay of each consumer")
+    parser.add_argument('--transport', choices=sorted(transports), default='shm')
+    parser.add_argument('--buffer-mb', type=int, default=64)
+    args = parser.parse_args()
+    transport_class = transports[args.transport]
+    for name, run in (('sequential', sequential), ('tee', tee)):
+        with tempfile.TemporaryDirectory() as workdir:
+            start = time.time()
+            digests = run(transport_class, args, workdir)
+            seconds = time.time() - start
+        print("{}\t{:.3f}s\t{} consumers{}".format(
+            name, seconds, len(digests),
+            "" if len(set(digests)) == 1 else "\tMISMATCH"))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Exercise the shared index lifecycle (load, reuse, idle unload) with a stub
+STAR executable that takes a fixed time to load a genome, and report load time
+vs. reuse time. Then check that a user that is terminated (SIGTERM) releases
+the index, and that one that is killed (SIGKILL) is dropped, so the index is
+still unloaded after the idle timeout.
+"""
+from argparse import ArgumentParser
+import json
+import multiprocessing
+import os
+import signal
+import stat
+import tempfile
+import time
+from evac.index import IndexManager, StarIndexLoader
+
+def hold(manager, index, acquired):
+    with manager.use(index):
+        acquired.set()
+        time.sleep(60)
+
+def killed_user(manager, index, signum):
+    """Start a process that uses the index, and kill it with ``signum`` once
+    it has acquired it.
+
+    Returns:
+        The number of users of the index in its state file afterwards
+    """
+    context = multiprocessing.get_context('fork')
+    acquired = context.Event()
+    proc = context.Process(target=hold, args=(manager, index, acquired))
+    proc.start()
+    acquired.wait()
+    os.kill(proc.pid, signum)
+    proc.join()
+    with open(manager.state_path(index)) as inp:
+        return len(json.load(inp)['holders'])
+
+STUB_STAR = """#!/bin/sh
+# Stub STAR: records each --genomeLoad call and simulates the load time
+echo "$2" >> {log}
+[ "$2" = LoadAndExit ] && sleep {load_time}
+exit 0
+"""
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--load-time', type=float, default=2)
+    parser.add_argument('--idle-timeout', type=float, default=1)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as workdir:
+        calls = os.path.join(workdir, 'calls.log')
+        star = os.path.join(workdir, 'STAR')
+        with open(star, 'wt') as out:
+            out.write(STUB_STAR.format(log=calls, load_time=args.load_time))
+        os.chmod(star, os.stat(star).st_mode | stat.S_IEXEC)
+        index = os.path.join(workdir, 'index')
+        os.mkdir(index)
+        manager = IndexManager(
+            StarIndexLoader(star, workdir), args.idle_timeout,
+            os.path.join(workdir, 'state'))
+
+        for run in ('first', 'second'):
+            start = time.time()
+            manager.acquire(index)
+            print("{} run: acquired in {:.3f}s".format(run, time.time() - start))
+        manager.release(index)
+        manager.release(index)
+        with open(manager.state_path(index)) as inp:
+            state = json.load(inp)
+        print("after release: loaded={loaded} refcount={refcount}".format(**state))
+
+        time.sleep(args.idle_timeout + 1)
+        with open(manager.state_path(index)) as inp:
+            state = json.load(inp)
+        print("after idle timeout: loaded={loaded} loads={loads} reuses={reuses}"
+              .format(**state))
+        with open(calls) as inp:
+            print("STAR calls: " + ', '.join(inp.read().split()))
+
+        for signum in (signal.SIGTERM, signal.SIGKILL):
+            users = killed_user(manager, index, signum)
+            time.sleep(args.idle_timeout + 2)
+            with open(manager.state_path(index)) as inp:
+                state = json.load(inp)
+            print("user killed with {}: {} users left; after idle timeout: "
+                  "loaded={}".format(
+                      signal.Signals(signum).name, users, state['loaded']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Compare joining variants to featureCounts counts in-process (evac.intersect)
+with the chain of the old convert_formats_*.sh scripts (grep, awk, vcf2bed,
+intersectBed and cut, with an intermediate file at every step).
+
+Synthetic inputs are written to a temporary directory: a VCF with a variant
+every ``--step`` bases, and a featureCounts table of ``--genes`` single-exon
+genes (the chain can't parse the coordinate lists of multi-exon genes). The
+chain is skipped if vcf2bed or intersectBed is not on the PATH. The chain reads
+featureCounts' 1-based starts as 0-based, so the two outputs can differ by the
+variants on the first base of a gene.
+"""
+from argparse import ArgumentParser
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+from evac.intersect import join_counts
+
+CHAIN = """
+grep -v "#" {counts} | grep -v "Geneid" > {counts}.bed
+awk '{{printf("%s\\t%s\\t%s\\t%s\\t%s\\t%s\\t%s\\n",$2,$3,$4,$5,$6,$7,$1)}}' {counts}.bed > {counts}.mod.bed
+grep -v "chrX;chrY" {counts}.mod.bed > {counts}.mod2.bed
+vcf2bed < {vcf} > {vcf}.bed
+grep -v "<\\*>" {vcf}.bed > {vcf}.bed.tmp && mv {vcf}.bed.tmp {vcf}.bed
+intersectBed -a {vcf}.bed -b {counts}.mod2.bed -wa -wb > {workdir}/intersect.bed
+cut -f 1,2,3,17,18 {workdir}/intersect.bed > {output}
+"""
+
+def write_inputs(workdir, contigs, length, step, genes):
+    vcf = os.path.join(workdir, 'calls.vcf')
+    with open(vcf, 'wt') as out:
+        out.write('##fileformat=VCFv4.2\n')
+        out.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+        for name in contigs:
+            out.write('##contig=<ID={},length={}>\n'.format(name, length))
+        out.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t'
+                  'sample\n')
+        for name in contigs:
+            for pos in range(step, length, step):
+                alt = '<*>' if pos % (10 * step) == 0 else 'C'
+                out.write('{}\t{}\t.\tA\t{}\t50\tPASS\tDP=20\tGT\t0/1\n'.format(
+                    name, pos, alt))
+    counts = os.path.join(workdir, 'counts.txt')
+    with open(counts, 'wt') as out:
+        out.write('# Program:featureCounts v1.5.1\n')
+        out.write('Geneid\tChr\tStart\tEnd\tStrand\tLength\tsample.bam\n')
+        for i in range(genes):
+            name = random.choice(contigs)
+            start = random.randrange(1, length - 5000)
+            end = start + random.randrange(100, 5000)
+            out.write('gene{}\t{}\t{}\t{}\t+\t{}\t{}\n'.format(
+                i, name, start, end, end - start + 1, random.randrange(1000)))
+    return vcf, counts
+
+def count_lines(path):
+    with open(path, 'rb') as inp:
+        return sum(1 for line in inp)
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--contigs', type=int, default=4)
+    parser.add_argument('--length', type=int, default=10000000)
+    parser.add_argument('--step', type=int, default=100)
+    parser.add_argument('--genes', type=int, default=20000)
+    args = parser.parse_args()
+    contigs = ['chr{}'.format(i + 1) for i in range(args.contigs)]
+    with tempfile.TemporaryDirectory() as workdir:
+        vcf, counts = write_inputs(
+            workdir, contigs, args.length, args.step, args.genes)
+        output = os.path.join(workdir, 'evac.txt')
+        start = time.time()
+        with open(vcf, 'rb') as inp1, open(counts, 'rb') as inp2, \
+                open(output, 'wb') as out:
+            join_counts(inp1, inp2, out)
+        print("evac.intersect\t{:.3f}s\t{} lines".format(
+            time.time() - start, count_lines(output)))
+        if not (shutil.which('vcf2bed') and shutil.which('intersectBed')):
+            print("chain\tskipped (vcf2bed and intersectBed are needed)")
+            return
+        output = os.path.join(workdir, 'chain.txt')
+        start = time.time()
+        subprocess.check_call(CHAIN.format(
+            counts=counts, vcf=vcf, workdir=workdir, output=output),
+            shell=True)
+        print("chain\t{:.3f}s\t{} lines".format(
+            time.time() - start, count_lines(output)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""Compare counting the alleles at known sites with evac.genotype (a bisect
+into the sites, and NumPy bincounts) with a naive pileup that decodes every
+base of every read into a dict.
+
+A coordinate-sorted, indexed BAM of synthetic reads and a VCF of known SNVs
+are written to a temporary directory. Both ways must find the same depth and
+allele counts at every site. The genotyper is run on the whole BAM stream, and
+on a slice of the indexed BAM with ``--sites`` sites only (sparse sites, such
+as a gene panel).
+"""
+from argparse import ArgumentParser
+import os
+import struct
+import tempfile
+import time
+from evac.bamsort import bam_records
+from evac.bench import Fixtures
+from evac.genotype import (
+    BASES, RECORD_HEAD, SKIP_FLAGS, KnownSiteGenotyper, read_sites)
+
+SEQ_CODES = '=ACMGRSVTWYHKDBN'
+
+def naive_pileup(bam, min_base_quality, min_mapping_quality):
+    """Returns a dict {(refid, pos): {base: count}} of every base of every
+    read.
+    """
+    pileup = {}
+    with open(bam, 'rb') as inp:
+        header, records = bam_records(inp)
+        for record in records:
+            (size, refid, pos, l_read_name, mapq, bin_, n_cigar, flag,
+             l_seq) = RECORD_HEAD.unpack_from(record)
+            if flag & SKIP_FLAGS or mapq < min_mapping_quality:
+                continue
+            at = RECORD_HEAD.size + 12 + l_read_name
+            cigar = struct.unpack_from('<{}I'.format(n_cigar), record, at)
+            at += 4 * n_cigar
+            packed = record[at:at + (l_seq + 1) // 2]
+            seq = ''.join(
+                SEQ_CODES[byte >> 4] + SEQ_CODES[byte & 0xf]
+                for byte in packed)
+            qual = record[at + len(packed):at + len(packed) + l_seq]
+            qpos = 0
+            for op in cigar:
+                kind, length = op & 0xf, op >> 4
+                if kind in (0, 7, 8):
+                    for i in range(length):
+                        if qual[qpos + i] >= min_base_quality:
+                            counts = pileup.setdefault((refid, pos + i), {})
+                            base = seq[qpos + i]
+                            counts[base] = counts.get(base, 0) + 1
+                    pos += length
+                    qpos += length
+                elif kind in (2, 3):
+                    pos += length
+                elif kind in (1, 4):
+                    qpos += length
+    return header, pileup
+
+def site_counts(by_refid):
+    """Returns a dict {(refid, pos): (depth, A, C, G, T)} of the sites with
+    any reads.
+    """
+    found = {}
+    for refid, contig in enumerate(by_refid):
+        if contig is None:
+            continue
+        for pos, counts in zip(contig.positions, contig.counts.tolist()):
+            if sum(counts):
+                found[(refid, pos)] = (sum(counts),) + tuple(counts[:4])
+    return found
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--reads', type=int, default=100000)
+    parser.add_argument('--contigs', type=int, default=4)
+    parser.add_argument('--contig-length', type=int, default=1000000)
+    parser.add_argument('--sites', type=int, default=200)
+    parser.add_argument('--min-base-quality', type=int, default=13)
+    parser.add_argument('--min-mapping-quality', type=int, default=0)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as workdir:
+        fixtures = Fixtures(
+            workdir, args.reads, contigs=args.contigs,
+            contig_length=args.contig_length)
+        os.makedirs(fixtures.index, exist_ok=True)
+        fixtures.create()
+        bam = fixtures.aligned_bam
+        sites = read_sites(fixtures.known_sites)
+
+        start = time.time()
+        header, pileup = naive_pileup(
+            bam, args.min_base_quality, args.min_mapping_quality)
+        names = [name.decode() for name, length in header.refs]
+        expected = {}
+        for refid, name in enumerate(names):
+            for site in sites.get(name, ()):
+                counts = pileup.get((refid, site.pos))
+                if counts:
+                    expected[(refid, site.pos)] = (
+                        sum(counts.values()),) + tuple(
+                            counts.get(chr(base), 0) for base in BASES)
+        print("naive\t{:.3f}s\t{} sites with reads".format(
+            time.time() - start, len(expected)))
+
+        genotyper = KnownSiteGenotyper(
+            sites, args.min_base_quality, args.min_mapping_quality)
+        start = time.time()
+        header, by_refid = genotyper.count_bam(bam, slice_indexed=False)
+        found = site_counts(by_refid)
+        print("genotype\t{:.3f}s\t{} sites with reads{}".format(
+            time.time() - start, len(found),
+            "" if found == expected else "\tMISMATCH"))
+
+        # A sparse panel, read from a slice of the indexed BAM
+        step = max(1, sum(len(s) for s in sites.values()) // args.sites)
+        panel = dict(
+            (name, contig_sites[::step])
+            for name, contig_sites in sites.items())
+        panel_sites = set(
+            (refid, site.pos) for refid, name in enumerate(names)
+            for site in panel.get(name, ()))
+        genotyper = KnownSiteGenotyper(
+            panel, args.min_base_quality, args.min_mapping_quality)
+        panel_expected = dict(
+            (key, value) for key, value in expected.items()
+            if key in panel_sites)
+        for slice_indexed in (False, True):
+            start = time.time()
+            header, by_refid = genotyper.count_bam(
+                bam, slice_indexed=slice_indexed)
+            found = site_counts(by_refid)
+            print("genotype (panel of {}{})\t{:.3f}s\t{} sites with "
+                  "reads{}".format(
+                      len(panel_sites), ", sliced" if slice_indexed else "",
+                      time.time() - start, len(found),
+                      "" if found == panel_expected else "\tMISMATCH"))
+
+if __name__ == '__main__':
+    main()
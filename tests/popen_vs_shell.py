@@ -0,0 +1,50 @@
+"""Compare a shell=True pipe chain with the same chain run by
+evac.executor, with and without byte counting on the edges.
+"""
+from argparse import ArgumentParser
+import os
+from subprocess import Popen
+import time
+from evac.executor import Stage, chain
+
+def commands(size):
+    return [
+        ['head', '-c', str(size), '/dev/zero'],
+        ['tr', '\\0', 'A'],
+        ['gzip', '-1'],
+        ['wc', '-c']]
+
+def run_shell(size, out):
+    cmd = ' | '.join(
+        ' '.join("'{}'".format(arg) for arg in cmd) for cmd in commands(size))
+    with Popen(cmd, stdout=out, shell=True) as proc:
+        proc.wait()
+
+def run_executor(size, out, count_bytes):
+    stages = [
+        Stage(cmd[0], cmd)
+        for cmd in commands(size)]
+    stages[-1].stdout = out
+    chain(stages, count_bytes=count_bytes).start().wait()
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-s', '--size', type=int, default=500 * 1024 * 1024)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+    runs = [
+        ('shell', lambda out: run_shell(args.size, out)),
+        ('executor', lambda out: run_executor(args.size, out, False)),
+        ('executor+count', lambda out: run_executor(args.size, out, True))]
+    with open(os.devnull, 'wb') as out:
+        for name, run in runs:
+            times = []
+            for i in range(args.repeats):
+                start = time.time()
+                run(out)
+                times.append(time.time() - start)
+            print("{}\tbest {:.3f}s\tmean {:.3f}s".format(
+                name, min(times), sum(times) / len(times)))
+
+if __name__ == '__main__':
+    main()
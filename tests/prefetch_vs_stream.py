@@ -0,0 +1,77 @@
+"""Compare fetching an accession over one and several connections, and from a
+warm chunk cache, using a local fake archive.
+
+Every fetch from the archive waits ``--latency`` seconds first, to stand in
+for a round trip to SRA. With one connection, the latency of every chunk adds
+up; with N connections, N chunks wait at once. The reads of every run are
+checked against the FASTQ files of the archive.
+"""
+from argparse import ArgumentParser
+import hashlib
+import os
+import tempfile
+import time
+from evac.prefetch import ArchiveSource, ChunkCache, PrefetchReads
+from synthetic import random_read
+
+ACCESSION = 'SRR0000001'
+
+def write_archive(root, n, read_length):
+    qual = 'I' * read_length
+    for mate in (1, 2):
+        path = os.path.join(root, '{}_{}.fastq'.format(ACCESSION, mate))
+        with open(path, 'wt') as out:
+            for i in range(n):
+                out.write('@read{}/{}\n{}\n+\n{}\n'.format(
+                    i, mate, random_read(read_length).decode(), qual))
+
+def digest(paths):
+    sha = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as inp:
+            sha.update(inp.read())
+    return sha.hexdigest()
+
+def run(source, cache, connections, chunk_reads):
+    reader = PrefetchReads(
+        source, cache, connections, chunk_reads, batch_size=1000)
+    shas = [hashlib.sha1(), hashlib.sha1()]
+    start = time.time()
+    for batch1, batch2 in reader:
+        shas[0].update(batch1.to_fastq())
+        shas[1].update(batch2.to_fastq())
+    return time.time() - start, shas
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--reads', type=int, default=200000)
+    parser.add_argument('-l', '--read-length', type=int, default=100)
+    parser.add_argument('--chunk-reads', type=int, default=10000)
+    parser.add_argument('--latency', type=float, default=0.1)
+    parser.add_argument(
+        '--connections', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument(
+        '--cache-mb', type=int, default=None,
+        help="Size limit of the chunk cache (default: no limit)")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as root:
+        write_archive(root, args.reads, args.read_length)
+        expected = [
+            digest([os.path.join(root, '{}_{}.fastq'.format(ACCESSION, mate))])
+            for mate in (1, 2)]
+        source = ArchiveSource(root, ACCESSION, latency=args.latency)
+        source.offsets()
+        max_bytes = args.cache_mb and args.cache_mb * 1024 * 1024
+        for connections in args.connections:
+            cache = ChunkCache(
+                os.path.join(root, 'cache{}'.format(connections)), max_bytes)
+            for label in ('cold', 'warm'):
+                seconds, shas = run(
+                    source, cache, connections, args.chunk_reads)
+                ok = [sha.hexdigest() for sha in shas] == expected
+                print("{} connections, {} cache\t{:.3f}s\t{:.0f} pairs/s{}".format(
+                    connections, label, seconds, args.reads / seconds,
+                    "" if ok else "\tMISMATCH"))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Compare reading the records that overlap a panel of regions from a whole
+BAM stream with reading them from a slice of an indexed BAM (evac.bamslice).
+
+A coordinate-sorted, indexed BAM of synthetic reads and a BED of ``--regions``
+random regions are written to a temporary directory. Both ways must find the
+same records overlapping the regions; the slice also holds the other records
+of the blocks it reads. For each, the time and the number of compressed bytes
+read are reported.
+"""
+from argparse import ArgumentParser
+import io
+import os
+import random
+import tempfile
+import time
+from evac.bamslice import BamSlicer
+from evac.bamsort import bam_records, record_extent
+from evac.bench import Fixtures
+
+def overlapping(records, refids, intervals):
+    """Returns the records that overlap any of the intervals.
+    """
+    by_ref = {}
+    for contig, start, end in intervals:
+        by_ref.setdefault(refids[contig], []).append((start, end))
+    found = []
+    for record in records:
+        refid, beg, end, unmapped = record_extent(record)
+        for start, stop in by_ref.get(refid, ()):
+            if beg < stop and end > start:
+                found.append(record)
+                break
+    return found
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--reads', type=int, default=500000)
+    parser.add_argument('--contigs', type=int, default=4)
+    parser.add_argument('--contig-length', type=int, default=10000000)
+    parser.add_argument('--regions', type=int, default=50)
+    parser.add_argument('--region-size', type=int, default=500)
+    parser.add_argument(
+        '--gap-kb', type=int, nargs='+', default=[0, 64, 1024],
+        help="Gaps between chunks that are read through rather than seeked")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as workdir:
+        fixtures = Fixtures(
+            workdir, args.reads, contigs=args.contigs,
+            contig_length=args.contig_length)
+        os.makedirs(fixtures.index, exist_ok=True)
+        fixtures.create()
+        bam = fixtures.aligned_bam
+        rng = random.Random(0)
+        intervals = sorted(
+            (name, start, start + args.region_size)
+            for name in fixtures.contig_names
+            for start in (
+                rng.randrange(args.contig_length - args.region_size)
+                for i in range(args.regions // args.contigs)))
+
+        start = time.time()
+        with open(bam, 'rb') as inp:
+            header, records = bam_records(inp)
+            refids = dict(
+                (name.decode(), i) for i, (name, length) in enumerate(
+                    header.refs))
+            expected = overlapping(records, refids, intervals)
+        print("stream\t{:.3f}s\t{:.1f} MB read\t{} records".format(
+            time.time() - start, os.path.getsize(bam) / 1e6, len(expected)))
+
+        for gap in args.gap_kb:
+            start = time.time()
+            slicer = BamSlicer(bam, gap=gap * 1024)
+            out = io.BytesIO()
+            out.close = lambda: None
+            nbytes = slicer.write(intervals, out)
+            header, records = bam_records(io.BytesIO(out.getvalue()))
+            records = list(records)
+            found = overlapping(records, refids, intervals)
+            print("slice (gap {} KB)\t{:.3f}s\t{:.1f} MB read\t{} records "
+                  "({} in the slice){}".format(
+                      gap, time.time() - start, nbytes / 1e6, len(found),
+                      len(records), "" if found == expected else "\tMISMATCH"))
+
+if __name__ == '__main__':
+    main()
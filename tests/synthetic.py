@@ -0,0 +1,78 @@
+"""Synthetic reads and a stand-in aligner, shared by the comparison scripts.
+"""
+import random
+import subprocess
+import sys
+from evac.readers import Reader
+from evac.reads import ReadBatch
+
+def random_read(n, rng=random):
+    """Returns a random sequence of ``n`` bases, as bytes.
+    """
+    return ''.join(rng.choices('ACGT', k=n)).encode()
+
+class SyntheticReader(Reader):
+    """Generates batches of the size given by the sizer from a small pool of
+    reads (the same for every reader with the same ``seed``), and records the
+    largest batch. Both mates are the same.
+    """
+    def __init__(self, n, read_length, pool=100, seed=0, **kwargs):
+        super(SyntheticReader, self).__init__(**kwargs)
+        self.n = n
+        rng = random.Random(seed)
+        self.pool = [random_read(read_length, rng) for i in range(pool)]
+        self.qual = b'I' * read_length
+        self.largest = 0
+
+    def batches(self):
+        produced = 0
+        while produced < self.n:
+            size = min(self.batch_size, self.n - produced)
+            self.largest = max(self.largest, size)
+            seqs = [
+                self.pool[(produced + i) % len(self.pool)]
+                for i in range(size)]
+            names = [b'read' + str(produced + i).encode() for i in range(size)]
+            batch = ReadBatch.from_lists(names, seqs, [self.qual] * size)
+            yield batch, batch
+            produced += size
+
+CONSUMER = """
+import hashlib, sys, time
+delay = float(sys.argv[1])
+sha = hashlib.sha1() if sys.argv[2] == 'digest' else None
+with open(sys.argv[3], 'rb') as in1, open(sys.argv[4], 'rb') as in2:
+    for i, (line1, line2) in enumerate(zip(in1, in2), 1):
+        if sha:
+            sha.update(line1)
+            sha.update(line2)
+        if delay and i % 40000 == 0:
+            time.sleep(delay)
+if sha:
+    print(sha.hexdigest())
+"""
+
+def consumer_cmd(delay, digest=False):
+    """The command of a consumer that reads both mates line by line in
+    lock-step, like an aligner does, sleeping ``delay`` seconds per 10,000
+    read pairs. With ``digest``, it prints a digest of what it read. The
+    paths of the two mates are appended to the command.
+    """
+    return [
+        sys.executable, '-c', CONSUMER, str(delay),
+        'digest' if digest else '-']
+
+def start_consumer(transport, delay=0, digest=False, **kwargs):
+    """Start a consumer (see :func:`consumer_cmd`) on a started transport.
+    """
+    return subprocess.Popen(
+        consumer_cmd(delay, digest) + list(transport.paths),
+        pass_fds=transport.pass_fds, **kwargs)
+
+def run_consumer(transport, delay=0):
+    """Run a consumer (see :func:`consumer_cmd`) on a started transport until
+    it has read all the reads.
+    """
+    subprocess.check_call(
+        consumer_cmd(delay) + list(transport.paths),
+        pass_fds=transport.pass_fds)